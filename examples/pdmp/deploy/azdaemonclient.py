@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+# Sends commands from az-vm-pool.py, az-queue.py and az-storage.py to
+# az-daemon.py. When the daemon is running, commands are run there rather
+# than in the script's own process, so the daemon's warm imports, Azure
+# logins and connections are reused. Set AZ_DAEMON_SOCKET to an empty string
+# to always run commands in the script's own process.
+#
+# Keep this file alongside the scripts. Each script calls forward_to_daemon()
+# near the top, before its Azure and other heavy imports, as avoiding those
+# imports is much of the time a forwarded command saves. The daemon loads the
+# script itself, where the call is skipped as the script is not '__main__'.
+#
+# The daemon runs the command in the script's own process instead when it is
+# already running a command, or when the script lists the command in its
+# DAEMON_LOCAL_COMMANDS. The daemon checks this after parsing the arguments
+# with the script's own parser, so that only the command itself is matched.
+
+import json
+import os
+import socket
+import stat
+import sys
+
+DEFAULT_DAEMON_SOCKET = os.path.join(os.path.expanduser("~"), ".az-daemon", "daemon.sock")
+
+def daemon_socket_path():
+    return os.environ.get("AZ_DAEMON_SOCKET", DEFAULT_DAEMON_SOCKET)
+
+def stdin_has_input():
+    # The daemon does not forward stdin, so a command given input on a pipe
+    # or from a file runs in the script's own process in case it reads it
+    try:
+        mode = os.fstat(sys.stdin.fileno()).st_mode
+    except (AttributeError, ValueError, OSError):
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISREG(mode) or stat.S_ISSOCK(mode)
+
+def forward_to_daemon(start_time=None):
+    # Exits with the command's exit status once the daemon has run it.
+    # Returns if there is no daemon to run it, or the command has to run in
+    # the script's own process.
+    socket_path = daemon_socket_path()
+    if(not(socket_path) or not(os.path.exists(socket_path)) or stdin_has_input()):
+        return
+    daemon = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        daemon.connect(socket_path)
+    except socket.error:
+        # Socket left behind by a daemon that is no longer running
+        return
+    request = {"request": "run", "script": os.path.abspath(sys.argv[0]), "argv": sys.argv[1:],
+               "cwd": os.getcwd(), "env": dict(os.environ)}
+    if(start_time is not None):
+        request["start_time"] = start_time
+    daemon.sendall((json.dumps(request) + "\n").encode("utf-8"))
+    exit_code = None
+    for line in daemon.makefile("rb"):
+        message = json.loads(line.decode("utf-8"))
+        if("local" in message):
+            daemon.close()
+            return
+        if("exit" in message):
+            exit_code = message["exit"]
+            break
+        stream = sys.stdout if message["stream"] == "stdout" else sys.stderr
+        stream.write(message["data"])
+        stream.flush()
+    daemon.close()
+    if(exit_code is None):
+        sys.exit("az-daemon.py stopped before the command finished.")
+    sys.exit(exit_code)
@@ -46,11 +46,17 @@ resourcegroup = "mortest42"
 
 queuename = "tasks"
 queuesaspath  = "secrets/azure_vm_pool_mortest42_sas_servicebus_management.txt"
-queuecommand = `python az-queue.py $resourcegroup $queuename fill -i $taskfile --sas-path $queuesaspath`
-run(queuecommand)
-
 storagesaspath  = "secrets/azure_vm_pool_mortest42_sas_storage_container_data.txt"
-storagecommand = `python az-storage.py $resourcegroup put -i $taskfile --sas-path $storagesaspath`
-run(storagecommand)
+# Queue the tasks and upload the task file in a single Python process with
+# azpool.py, rather than starting az-queue.py and az-storage.py in turn
+pythonscript = """
+import sys, azpool
+resourcegroup, queuename, queuesaspath, storagesaspath, taskfile = sys.argv[1:]
+with open(taskfile) as f:
+    if azpool.TaskQueue(resourcegroup, queuename, sas_path=queuesaspath).put_all(f.readlines()) is False:
+        sys.exit("Could not find queue '{:s}'.".format(queuename))
+azpool.BlobStore(resourcegroup, sas_path=storagesaspath).put(taskfile)
+"""
+run(`python -c $pythonscript $resourcegroup $queuename $queuesaspath $storagesaspath $taskfile`)
 
 rm(taskfile)
@@ -1,3 +1,5 @@
 #! /bin/bash
 DIR=`dirname "$BASH_SOURCE"`
+# Convert the ratings to a binary dataset once, rather than every task parsing the CSV
+eval "python $DIR/az-storage.py mortest42 stage-dataset -i $DIR/../task/data/ratings.csv -b datasets/ratings --sas-path $DIR/secrets/azure_vm_pool_mortest42_sas_storage_container_data.txt"
 eval "/Applications/Julia-0.5.app/Contents/Resources/julia/bin/julia $DIR/generatetasks.jl"
\ No newline at end of file
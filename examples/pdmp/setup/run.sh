@@ -17,4 +17,5 @@ julia -e 'Pkg.clone("git://github.com/alan-turing-institute/PDMP.jl.git")'
 julia -e 'Pkg.update("PDMP")'
 
 sudo apt-get --yes --force-yes install hdf5-tools
-julia -e 'Pkg.add("JLD")'
\ No newline at end of file
+julia -e 'Pkg.add("JLD")'
+julia -e 'Pkg.add("JSON")'
\ No newline at end of file
@@ -0,0 +1,352 @@
+#! /usr/bin/env python
+
+import argparse
+import errno
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    import importlib.util as importlib_util
+except ImportError:
+    # Python 2
+    importlib_util = None
+    import imp
+
+from azdaemonclient import DEFAULT_DAEMON_SOCKET
+
+SOCKET_BACKLOG = 128
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description=__name__)
+    parser.add_argument('command', choices=['start', 'stop', 'status'])
+    parser.add_argument('--socket-path', '-s',
+        default=os.environ.get("AZ_DAEMON_SOCKET") or DEFAULT_DAEMON_SOCKET,
+        help="Path of the Unix socket the daemon listens on. Defaults to the AZ_DAEMON_SOCKET environment variable if set, or '{:s}'. The other scripts forward commands to the daemon on the same socket.".format(DEFAULT_DAEMON_SOCKET))
+
+    args = parser.parse_args()
+
+    if(args.command == 'start'):
+        serve(args)
+    elif(args.command == 'stop'):
+        stop(args)
+    elif(args.command == 'status'):
+        status(args)
+    else:
+        print("Unsupported command")
+
+## ----------------
+## HELPER FUNCTIONS
+## ----------------
+def log(message):
+    sys.__stderr__.write("{:%Hh%Mm%Ss}: {:s}\n".format(datetime.now(), message))
+    sys.__stderr__.flush()
+
+def ensure_exists(directory):
+    if(directory and not os.path.exists(directory)):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            # Another process may have created the directory in the meantime
+            if(e.errno != errno.EEXIST):
+                raise
+
+def send_message(connection, message):
+    connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+def read_message(connection_file):
+    line = connection_file.readline()
+    if not(line):
+        return None
+    return json.loads(line.decode("utf-8"))
+
+def send_request(request, args):
+    # Returns the daemon's reply, or None if the daemon is not running
+    if not(os.path.exists(args.socket_path)):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(args.socket_path)
+    except socket.error:
+        # Socket left behind by a daemon that is no longer running
+        return None
+    try:
+        send_message(connection, request)
+        return read_message(connection.makefile("rb"))
+    finally:
+        connection.close()
+
+## ------------------
+## RUNNING COMMANDS
+## ------------------
+# Commands are run one at a time, in the daemon's main thread. Each command
+# changes the process working directory, environment and sys.argv, so
+# commands cannot share the process. Connections are accepted on a separate
+# thread, so that a client that connects while a command is running is told
+# to run its command in its own process rather than wait for the daemon.
+loaded_scripts = {}
+daemon_stats = {"start": time.time(), "commands": 0, "busy": False}
+daemon_stats_lock = threading.Lock()
+
+class Client(object):
+    # Connection to the script that forwarded the command being run. Output
+    # is sent from any thread the command starts, so sends are serialised.
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+        self._connected = True
+
+    def send(self, message):
+        with self._lock:
+            if not(self._connected):
+                return
+            try:
+                send_message(self._connection, message)
+            except socket.error:
+                # The client has gone away (e.g. Ctrl+C). Let the command
+                # finish, but stop sending it output.
+                self._connected = False
+
+current_client = {"client": None}
+
+class CommandOutput(object):
+    # Replaces sys.stdout and sys.stderr in the daemon. Anything written
+    # while a command is running is sent to the client that forwarded it.
+    # This also catches log handlers, which keep the stream they were
+    # created with. Subprocesses that inherit the daemon's output (rather
+    # than having it piped back to the script) still write to the daemon's
+    # own terminal, so commands that run them are kept out of the daemon by
+    # the scripts' DAEMON_LOCAL_COMMANDS.
+    def __init__(self, stream_name, stream):
+        self._stream_name = stream_name
+        self._stream = stream
+
+    def write(self, data):
+        client = current_client["client"]
+        if(client is None):
+            self._stream.write(data)
+        else:
+            client.send({"stream": self._stream_name, "data": data})
+
+    def flush(self):
+        if(current_client["client"] is None):
+            self._stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def load_script(path):
+    # Each script is imported once and kept, along with the modules it has
+    # imported, its Azure login, connections and caches, until the script
+    # file changes
+    modified = os.path.getmtime(path)
+    if(path not in loaded_scripts or loaded_scripts[path][0] != modified):
+        module_name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+        # As when running the script, its own directory is searched for the
+        # helper modules it imports
+        script_directory = os.path.dirname(path)
+        if(script_directory not in sys.path):
+            sys.path.insert(0, script_directory)
+        if(importlib_util is not None):
+            spec = importlib_util.spec_from_file_location(module_name, path)
+            module = importlib_util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            module = imp.load_source(module_name, path)
+        loaded_scripts[path] = (modified, module)
+    return loaded_scripts[path][1]
+
+def exit_status(code):
+    # Mirrors how Python turns the argument to sys.exit() into an exit status
+    if(code is None):
+        return 0
+    if(isinstance(code, int)):
+        return code
+    sys.stderr.write("{}\n".format(code))
+    return 1
+
+def run_command(request, client):
+    # The working directory and environment belong to the whole process, so
+    # they are only safe to change here because no thread started by one
+    # command is still running when the next starts. Every worker pool in
+    # the scripts (run_vm_operations(), get_vm_bundle_versions() and the
+    # az-storage.py transfers) is closed and joined before main() returns.
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    saved_environ = dict(os.environ)
+    current_client["client"] = client
+    exit_code = 0
+    try:
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        sys.argv = [request["script"]] + request["argv"]
+        module = load_script(request["script"])
+        # Parsed with the script's own parser, so that only the command
+        # itself, and not an argument with the same name, is matched
+        if(module.parse_args(request["argv"]).command in getattr(module, "DAEMON_LOCAL_COMMANDS", [])):
+            client.send({"local": True})
+            return
+        if("start_time" in request):
+            module.SCRIPT_START_TIME = request["start_time"]
+        module.main()
+    except SystemExit as e:
+        exit_code = exit_status(e.code)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        current_client["client"] = None
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+    daemon_stats["commands"] = daemon_stats["commands"] + 1
+    client.send({"exit": exit_code})
+    log("{:s} {:s} finished with exit status {:d}.".format(os.path.basename(request["script"]), " ".join(request["argv"]), exit_code))
+
+def handle_connection(connection, commands):
+    # Runs on the thread accepting connections. Commands are passed to the
+    # main thread along with their connection, which it then closes. Returns
+    # False once the daemon has been asked to stop.
+    request = read_message(connection.makefile("rb"))
+    client = Client(connection)
+    keep_connection = False
+    try:
+        if(request is None):
+            return True
+        if(request["request"] == "run"):
+            with daemon_stats_lock:
+                busy = daemon_stats["busy"]
+                daemon_stats["busy"] = True
+            if(busy):
+                client.send({"local": True})
+            else:
+                commands.put((request, connection))
+                keep_connection = True
+        elif(request["request"] == "status"):
+            client.send({"pid": os.getpid(), "start": daemon_stats["start"], "commands": daemon_stats["commands"],
+                         "busy": daemon_stats["busy"], "scripts": sorted(loaded_scripts.keys())})
+        elif(request["request"] == "stop"):
+            client.send({"stopping": True})
+            return False
+        return True
+    finally:
+        if not(keep_connection):
+            connection.close()
+
+def accept_connections(server, commands):
+    while(True):
+        try:
+            connection, _ = server.accept()
+        except socket.error:
+            # The server socket has been closed
+            return
+        try:
+            running = handle_connection(connection, commands)
+        except Exception:
+            log("Failed to handle request:\n{:s}".format(traceback.format_exc()))
+            running = True
+        if not(running):
+            commands.put(None)
+            return
+
+def run_commands(commands):
+    # Runs the commands passed by accept_connections() until asked to stop
+    while(True):
+        try:
+            # Waits with a timeout, as Python 2 does not interrupt an
+            # untimed wait for Ctrl+C
+            job = commands.get(timeout=1)
+        except queue.Empty:
+            continue
+        if(job is None):
+            return
+        (request, connection) = job
+        try:
+            run_command(request, Client(connection))
+        except Exception:
+            log("Failed to run command:\n{:s}".format(traceback.format_exc()))
+        finally:
+            connection.close()
+            with daemon_stats_lock:
+                daemon_stats["busy"] = False
+
+## ------------------
+## TOP-LEVEL COMMANDS
+## ------------------
+def serve(args):
+    if(send_request({"request": "status"}, args) is not None):
+        sys.exit("az-daemon.py is already running on socket '{:s}'.".format(args.socket_path))
+    ensure_exists(os.path.dirname(args.socket_path))
+    if(os.path.exists(args.socket_path)):
+        # Left behind by a daemon that did not shut down cleanly
+        os.remove(args.socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The daemon runs any script it is sent as the user running it, so only
+    # that user may connect
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(args.socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(SOCKET_BACKLOG)
+    # Clients do not forward their stdin, so commands and the subprocesses
+    # they start read end of file rather than the daemon's own stdin
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.close(devnull)
+    sys.stdout = CommandOutput("stdout", sys.stdout)
+    sys.stderr = CommandOutput("stderr", sys.stderr)
+    log("Serving commands on socket '{:s}' (pid {:d}). Stop with 'az-daemon.py stop'.".format(args.socket_path, os.getpid()))
+    commands = queue.Queue()
+    acceptor = threading.Thread(target=accept_connections, args=(server, commands))
+    acceptor.daemon = True
+    acceptor.start()
+    try:
+        run_commands(commands)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if(os.path.exists(args.socket_path)):
+            os.remove(args.socket_path)
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+    log("Stopped after running {:d} commands.".format(daemon_stats["commands"]))
+
+def stop(args):
+    if(send_request({"request": "stop"}, args) is None):
+        sys.exit("az-daemon.py is not running on socket '{:s}'.".format(args.socket_path))
+    log("az-daemon.py on socket '{:s}' stopped.".format(args.socket_path))
+
+def status(args):
+    reply = send_request({"request": "status"}, args)
+    if(reply is None):
+        sys.exit("az-daemon.py is not running on socket '{:s}'.".format(args.socket_path))
+    print("Running on socket '{:s}' (pid {:d}) since {:%Y-%m-%d %H:%M:%S}, {:d} commands run.".format(
+        args.socket_path, reply["pid"], datetime.fromtimestamp(reply["start"]), reply["commands"]))
+    if(reply["busy"]):
+        print("Running a command. Commands sent meanwhile run in their own process.")
+    for script in reply["scripts"]:
+        print("Loaded: {:s}".format(script))
+
+if __name__ == "__main__":
+    main()
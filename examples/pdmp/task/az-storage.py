@@ -1,22 +1,126 @@
 #! /usr/bin/env python
 
 import argparse
+import calendar
+import collections
+import csv
+import datetime
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import io
+import json
 import os
+import select
+import shutil
+import signal
+import sqlite3
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-from azure.storage import CloudStorageAccount
+## -----------------
+## DAEMON FORWARDING
+## -----------------
+# Commands are sent to az-daemon.py when it is running, see azdaemonclient.py
+# Commands that read stdin, handle signals or run until stopped
+DAEMON_LOCAL_COMMANDS = ['tee', 'tail', 'uploader']
+
+if(__name__ == "__main__"):
+    import azdaemonclient
+    azdaemonclient.forward_to_daemon()
+
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob import AppendBlobService, BlockBlobService, Include
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed to collect blobs into a '.tar.zst' archive
+    zstandard = None
 
 DEFAULT_SAS_DIRECTORY = 'secrets'
 DEFAULT_POOL_FILE_PREFIX = "azure_vm_pool"
 DEFAULT_STORAGE_SAS_PREFIX = "sas_storage"
 DEFAULT_DATA_CONTAINER_NAME = "data"
 DEFAULT_CONTAINER_SAS_PREFIX = "sas_storage_container"
+DEFAULT_CACHE_SIZE_MB = 10240
+CACHE_LOCK_SUFFIX = ".lock"
+CACHE_DATA_SUFFIX = ".data"
+CACHE_META_SUFFIX = ".json"
+CACHE_EVICT_LOCK = ".evict.lock"
+HTTP_NOT_MODIFIED = 304
+HTTP_NOT_FOUND = 404
+HTTP_CONFLICT = 409
+HTTP_PRECONDITION_FAILED = 412
+STORAGE_BACKENDS = ['azure', 'local']
+DEFAULT_LOCAL_STORAGE_DIRECTORY = 'local-storage'
+LOCAL_METADATA_DIRECTORY = '.metadata'
+LOCAL_COPY_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_LIST_PAGE_SIZE = 5000
+LIST_FORMATS = ['text', 'jsonl', 'csv']
+LIST_FIELDS = ['name', 'size', 'etag', 'last_modified']
+DEFAULT_INDEX_PREFIX = "blob_index"
+INDEX_QUERIES = ['count', 'list', 'missing']
+DEFAULT_PARALLEL_OPERATIONS = 16
+GLOB_SPECIAL_CHARACTERS = '*?['
+DEFAULT_POLL_INTERVAL_SECONDS = 5
+DEFAULT_RETRIES = 5
+MAX_RETRY_DELAY_SECONDS = 60
+OUTBOX_IGNORED_SUFFIXES = ('.tmp', '.part')
+DEFAULT_LOG_FLUSH_BYTES = 1024 * 1024
+DEFAULT_LOG_FLUSH_INTERVAL_SECONDS = 10
+LOG_READ_SIZE = 64 * 1024
+# Output 'tee' keeps to retry after failed appends. Beyond this, the oldest
+# output is dropped so a long outage cannot exhaust memory.
+LOG_MAX_BACKLOG_BYTES = 8 * 1024 * 1024
+CONTENT_OBJECT_PREFIX = "sha256/"
+CONTENT_HASH_METADATA_KEY = "sha256"
+DEFAULT_HASH_CACHE_PREFIX = "content_hashes"
+HASH_READ_SIZE = 1024 * 1024
+DATASET_FORMAT = "az-storage-dataset"
+DATASET_FORMAT_VERSION = 1
+DATASET_HEADER_SUFFIX = ".json"
+DATASET_DATA_SUFFIX = ".bin"
+DATASET_META_SUFFIX = ".meta"
+DATASET_LOCK_SUFFIX = ".lock"
+DATASET_COLUMN_ALIGNMENT = 64
+DATASET_WRITE_ROWS = 65536
+METRICS_PERCENTILES = [50, 95, 99]
+# Upper bounds of the latency histogram buckets in milliseconds
+METRICS_HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+# Column types with their little-endian array type string and struct format
+DATASET_COLUMN_TYPES = {
+    "int64": ("<i8", "q"),
+    "float64": ("<f8", "d")
+}
+DATASET_INT64_MIN = -2**63
+DATASET_INT64_MAX = 2**63 - 1
+ARCHIVE_TAR_MODES = [
+    ('.tar.gz', 'w|gz'),
+    ('.tgz', 'w|gz'),
+    ('.tar.bz2', 'w|bz2'),
+    ('.tar.xz', 'w|xz'),
+    ('.tar.zst', 'w|'),
+    ('.tar', 'w|')
+]
 
 def main():
-    # Parse command line arguments
+    run(parse_args())
+
+def parse_args(argv=None):
+    # Also used by azpool.py to build the arguments for its BlobStore objects
     parser = argparse.ArgumentParser(description=__name__)
     parser.add_argument('resource_group',
         help='Name of VM pool resource group.')
-    parser.add_argument('command', choices=['list', 'put', 'fetch', 'delete'])
+    parser.add_argument('command', choices=['list', 'put', 'fetch', 'delete', 'index', 'query', 'collect', 'uploader', 'tee', 'tail', 'stage-dataset', 'fetch-dataset'])
     parser.add_argument('--container', '-c',
         default=DEFAULT_DATA_CONTAINER_NAME,
         help='Name of container.')
@@ -25,31 +129,150 @@ def main():
     parser.add_argument('--input-path', '-i',
         help='Path of file to upload.')
     parser.add_argument('--output-path', '-o',
-        help='Destination path for downloaded file.')
+        help="Destination path for downloaded file. For 'collect', the archive to write, with the archive type taken from the extension ('.tar', '.tar.gz', '.tar.bz2', '.tar.xz' or '.tar.zst'). Any other extension concatenates the blob contents into a single file.")
     parser.add_argument('--sas-path', '-t',
         help='Path to Shared Access Signature (SAS) token with full access to the storage account')
+    parser.add_argument('--backend',
+        choices=STORAGE_BACKENDS, default='azure',
+        help="Storage backend. 'azure' uses the pool storage account. 'local' stores each container as a directory under '--local-root', for testing and benchmarking without a storage account.")
+    parser.add_argument('--local-root',
+        help="Root directory for the 'local' storage backend. Defaults to a directory named after the resource group in '{:s}'.".format(DEFAULT_LOCAL_STORAGE_DIRECTORY))
+    parser.add_argument('--prefix',
+        help="Only list, delete, collect or tail blobs whose names begin with this prefix.")
+    parser.add_argument('--glob',
+        help="Only delete, collect or tail blobs whose names match this shell-style wildcard pattern (e.g. 'results/*.csv').")
+    parser.add_argument('--parallel', type=int,
+        default=DEFAULT_PARALLEL_OPERATIONS,
+        help="Number of storage operations to run concurrently when operating on many blobs.")
+    parser.add_argument('--content-addressed', action='store_true',
+        help="Store 'put' uploads once per distinct content, under '{:s}<SHA-256 of content>', with the blob name as an empty reference blob pointing at the content. Uploads whose content is already stored are skipped. 'fetch' resolves blobs stored this way.".format(CONTENT_OBJECT_PREFIX))
+    parser.add_argument('--hash-cache',
+        help="Path of the local file of content hashes known to be stored, used by 'put --content-addressed' to skip uploads without asking the storage account. Defaults to a file named after the resource group and container in the current directory. Delete it after deleting any '{:s}' blobs.".format(CONTENT_OBJECT_PREFIX))
+    parser.add_argument('--csv-header', action='store_true',
+        help="Treat the first row of the CSV file converted by 'stage-dataset' as column names.")
+    parser.add_argument('--outbox-dir',
+        help="Directory watched by 'uploader'. Files moved into this directory are uploaded in the background, using their path relative to the directory (after '--prefix', if given) as the blob name, and deleted locally once uploaded. Write files elsewhere (or with a '.tmp' or '.part' suffix) and rename them into the directory once complete, so partially written files are never uploaded.")
+    parser.add_argument('--poll-interval', type=float,
+        default=DEFAULT_POLL_INTERVAL_SECONDS,
+        help="Seconds between scans of the outbox directory by 'uploader'.")
+    parser.add_argument('--drain', action='store_true',
+        help="Make 'uploader' upload every file in the outbox directory and exit once it is empty, rather than watching it indefinitely.")
+    parser.add_argument('--retries', type=int,
+        default=DEFAULT_RETRIES,
+        help="Number of times to retry a failed upload, with exponential backoff between attempts.")
+    parser.add_argument('--flush-bytes', type=int,
+        default=DEFAULT_LOG_FLUSH_BYTES,
+        help="Number of bytes of output 'tee' buffers before appending them to the log blob.")
+    parser.add_argument('--flush-interval', type=float,
+        default=DEFAULT_LOG_FLUSH_INTERVAL_SECONDS,
+        help="Maximum number of seconds 'tee' holds buffered output before appending it to the log blob. Also the number of seconds between checks for new output by 'tail'.")
+    parser.add_argument('--append', action='store_true',
+        help="Make 'tee' append to an existing log blob rather than replacing it.")
+    parser.add_argument('--from-start', action='store_true',
+        help="Make 'tail' print the existing contents of each log blob, rather than only output appended after it starts.")
+    parser.add_argument('--skip-header', action='store_true',
+        help="When 'collect' concatenates blobs into a single file, drop the first line of every blob after the first (e.g. to merge CSV files that each have a header row).")
+    parser.add_argument('--dry-run', action='store_true',
+        help="Count the blobs that would be deleted without deleting them.")
+    parser.add_argument('--delimiter',
+        help="List blobs as a virtual directory hierarchy using this delimiter (e.g. '/'). Blobs below the first delimiter after the prefix are rolled up into a single virtual directory entry.")
+    parser.add_argument('--max-results', type=int,
+        help="Stop listing after this many entries. The continuation marker to resume the listing from is written to stderr.")
+    parser.add_argument('--marker',
+        help="Continuation marker returned by an earlier listing stopped by '--max-results'.")
+    parser.add_argument('--format',
+        choices=LIST_FORMATS, default='text',
+        help="Output format for 'list'. 'text' prints one blob name per line. 'jsonl' and 'csv' also include blob size, ETag and last modified time.")
+    parser.add_argument('--index-path',
+        help="Path of the local SQLite blob index built by 'index' and read by 'query'. Defaults to a file named after the resource group and container in the current directory.")
+    parser.add_argument('--query',
+        choices=INDEX_QUERIES, default='count',
+        help="Query to run against the local blob index. 'count' prints the number and total size of indexed blobs, 'list' prints indexed blobs and 'missing' prints the names listed in '--manifest' that have no indexed blob. All queries are restricted to '--prefix' if given.")
+    parser.add_argument('--manifest',
+        help="File listing one expected blob name per line, for the 'missing' query.")
+    parser.add_argument('--metrics',
+        help="Time every storage operation and count the bytes it transfers, writing one JSON record per operation to this file. A summary of latency percentiles and histogram, throughput and retries per operation type is appended to the file and written to stderr when the command finishes.")
+    parser.add_argument('--cache-dir',
+        help="Directory for a local read-through cache of fetched blobs, shared by all processes on the machine (e.g. a directory on the VM resource disk such as '/mnt/az-storage-cache'). Cached copies are revalidated against the blob ETag on each fetch.")
+    parser.add_argument('--cache-size', type=int,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help='Maximum size of the local blob cache in MB. Least recently used blobs are evicted once the cache grows beyond this.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # Add some default arguments that we won't clutter up the command line with
     args.pool_file_prefix = DEFAULT_POOL_FILE_PREFIX
     args.container_sas_prefix = DEFAULT_CONTAINER_SAS_PREFIX
+    args.metrics_recorder = None
 
     # Enforce conditional required arguments
-    if(args.command in ['fetch', 'delete'] and args.blob == None):
+    if(args.command in ['fetch'] and args.blob == None):
+        parser.error("Blob name required for command '{:s}'. Please provide using '-b' or '--blob'".format(args.command))
+    if(args.command in ['delete'] and args.blob == None and not(args.prefix) and not(args.glob)):
+        parser.error("Blob name, prefix or glob required for command '{:s}'. Please provide using '-b' or '--blob', '--prefix' or '--glob'".format(args.command))
+    if(args.parallel < 1):
+        parser.error("'--parallel' must be a positive number")
+    if(args.max_results is not None and args.max_results <= 0):
+        parser.error("'--max-results' must be a positive number")
+    if(args.command in ['query'] and args.query == 'missing' and args.manifest == None):
+        parser.error("Manifest file required for query 'missing'. Please provide using '--manifest'")
+    if(args.command in ['collect'] and args.output_path == None):
+        parser.error("Output path required for command '{:s}'. Please provide using '-o' or '--output-path'".format(args.command))
+    if(args.command in ['collect'] and not(args.prefix) and not(args.glob)):
+        parser.error("Prefix or glob required for command '{:s}'. Please provide using '--prefix' or '--glob'".format(args.command))
+    if(args.command in ['collect'] and args.output_path.endswith('.zst') and zstandard is None):
+        parser.error("The 'zstandard' package is required to write '.zst' archives. Install it using 'pip install zstandard'.")
+    if(args.command in ['uploader'] and args.outbox_dir == None):
+        parser.error("Outbox directory required for command '{:s}'. Please provide using '--outbox-dir'".format(args.command))
+    if(args.command in ['stage-dataset', 'fetch-dataset'] and args.blob == None):
+        parser.error("Dataset blob name required for command '{:s}'. Please provide using '-b' or '--blob'".format(args.command))
+    if(args.command in ['stage-dataset'] and args.input_path == None):
+        parser.error("Input CSV path required for command '{:s}'. Please provide using '-i' or '--input-path'".format(args.command))
+    if(args.command in ['tee'] and args.blob == None):
         parser.error("Blob name required for command '{:s}'. Please provide using '-b' or '--blob'".format(args.command))
+    if(args.command in ['tail'] and args.blob == None and not(args.prefix) and not(args.glob)):
+        parser.error("Blob name, prefix or glob required for command '{:s}'. Please provide using '-b' or '--blob', '--prefix' or '--glob'".format(args.command))
     if(args.command in ['put'] and args.input_path == None):
         parser.error("Input path required for command '{:s}'. Please provide using '-i' or '--input-path'".format(args.command))
+    return args
 
-    if(args.command == 'list'):
-        list_blobs(args)
-    elif(args.command == 'put'):
-        put_blob(args)
-    elif(args.command == 'fetch'):
-        fetch_blob(args)
-    elif(args.command == 'delete'):
-        delete_blob(args)
-    else:
-        print("Unsupported command")
+def run(args):
+    if(args.metrics != None):
+        args.metrics_recorder = MetricsRecorder(args.metrics)
+
+    try:
+        if(args.command == 'list'):
+            list_blobs(args)
+        elif(args.command == 'put'):
+            put_blob(args)
+        elif(args.command == 'fetch'):
+            fetch_blob(args)
+        elif(args.command == 'delete' and args.blob == None):
+            delete_blobs(args)
+        elif(args.command == 'delete'):
+            delete_blob(args)
+        elif(args.command == 'index'):
+            index_blobs(args)
+        elif(args.command == 'query'):
+            query_index(args)
+        elif(args.command == 'collect'):
+            collect_blobs(args)
+        elif(args.command == 'uploader'):
+            run_uploader(args)
+        elif(args.command == 'stage-dataset'):
+            stage_dataset(args)
+        elif(args.command == 'fetch-dataset'):
+            fetch_dataset(args)
+        elif(args.command == 'tee'):
+            tee_log(args)
+        elif(args.command == 'tail'):
+            tail_logs(args)
+        else:
+            print("Unsupported command")
+    finally:
+        # Closed here, rather than by atexit, so the summary is written
+        # however the command exits, including when az-daemon.py runs it
+        if(args.metrics_recorder is not None):
+            args.metrics_recorder.close()
 
 ## ----------------
 ## HELPER FUNCTIONS
@@ -58,27 +281,1190 @@ def container_sas_filename(args):
     container_name = args.container
     return "{:s}_{:s}_{:s}_{:s}.txt".format(args.pool_file_prefix, args.resource_group, args.container_sas_prefix, container_name)
 
-def get_storage_sas(args):
+def storage_sas_path(args):
     if(args.sas_path != None):
-        filepath = args.sas_path
-    else:
-        filepath = os.path.join(DEFAULT_SAS_DIRECTORY, container_sas_filename(args))
-    with open(filepath, 'r') as f:
+        return args.sas_path
+    return os.path.join(DEFAULT_SAS_DIRECTORY, container_sas_filename(args))
+
+def get_storage_sas(args):
+    with open(storage_sas_path(args), 'r') as f:
         sas = f.readline()
     return sas
 
-def get_storage_account(args):
-    account_name = args.resource_group
-    sas = get_storage_sas(args)
-    return(CloudStorageAccount(account_name = account_name, sas_token = sas))
+def local_storage_root(args):
+    if(args.local_root != None):
+        return args.local_root
+    return os.path.join(DEFAULT_LOCAL_STORAGE_DIRECTORY, args.resource_group)
+
+# Each kind of storage service is created once per process and shared by every
+# operation and worker thread. All of them send their requests through a
+# single keep-alive HTTP session whose connection pool is sized for
+# '--parallel' workers, so connections (and their TLS handshakes) are reused
+# instead of being set up again for each call.
+storage_services = {}
+storage_services_lock = threading.Lock()
+
+def create_storage_session(args):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(args.parallel, 1) + 1)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_storage_service(args, service_class):
+    # Services are keyed on the account and credentials as well as the
+    # class, as az-daemon.py runs commands for any number of pools in the
+    # same process. The SAS file is only read when it is new or has been
+    # modified since. The metrics proxy only applies to the current command.
+    if(args.backend == 'local'):
+        key = (service_class, args.backend, os.path.abspath(local_storage_root(args)))
+    else:
+        sas_path = os.path.abspath(storage_sas_path(args))
+        key = (service_class, args.backend, args.resource_group, sas_path, os.stat(sas_path).st_mtime)
+    with storage_services_lock:
+        if(key not in storage_services):
+            if(args.backend == 'local'):
+                service = LocalBlobService(os.path.abspath(local_storage_root(args)))
+            else:
+                session_key = ('session', args.parallel)
+                if(session_key not in storage_services):
+                    storage_services[session_key] = create_storage_session(args)
+                service = service_class(account_name = args.resource_group, sas_token = get_storage_sas(args),
+                                        request_session = storage_services[session_key])
+                count_sdk_retries(service)
+            storage_services[key] = service
+        return with_metrics(storage_services[key], args)
 
 def get_blob_service(args):
-    account = get_storage_account(args)
-    return account.create_block_blob_service()
+    return get_storage_service(args, BlockBlobService)
+
+def get_append_blob_service(args):
+    return get_storage_service(args, AppendBlobService)
+
+def download_blob(blob_service, container_name, blob_name, output_path):
+    # Downloads a blob with a single GET, handling a missing blob from that
+    # request rather than checking for it first. The blob is written to a
+    # temporary file and renamed into place, so output_path is never left
+    # holding a partial or empty download. Returns False if the blob does not
+    # exist.
+    tmp_path = "{:s}.{:d}.tmp".format(output_path, os.getpid())
+    try:
+        blob_service.get_blob_to_path(container_name, blob_name, tmp_path)
+        os.rename(tmp_path, output_path)
+    except AzureMissingResourceHttpError:
+        return False
+    finally:
+        if(os.path.exists(tmp_path)):
+            os.remove(tmp_path)
+    return True
+
+def upload_file(blob_service, container_name, blob_name, input_path, args):
+    # Returns the hash of the content the blob refers to ('--content-addressed'
+    # only, otherwise None) and whether the content had to be uploaded
+    if(args.content_addressed):
+        content_hash = file_sha256(input_path)
+        uploaded = put_content_object(blob_service, container_name, input_path, content_hash, args)
+        # Write the reference after the content, so a reference never points
+        # at content that has not been stored yet
+        put_content_reference(blob_service, container_name, blob_name, content_hash)
+        return (content_hash, uploaded)
+    blob_service.create_blob_from_path(container_name, blob_name, input_path)
+    return (None, True)
+
+def fetch_to_file(blob_service, container_name, blob_name, output_path, args):
+    # Returns None if the blob does not exist, otherwise whether it was
+    # copied from the local cache rather than downloaded
+    source_blob_name = blob_name
+    if(args.content_addressed):
+        source_blob_name = resolve_content_reference(blob_service, container_name, blob_name)
+        if(source_blob_name is None):
+            return None
+    if(args.cache_dir != None):
+        # Content objects never change, so caching them also deduplicates the
+        # cache across every name the content is stored under
+        return fetch_blob_cached(blob_service, container_name, source_blob_name, output_path, args)
+    ensure_exists(os.path.dirname(output_path))
+    if(download_blob(blob_service, container_name, source_blob_name, output_path)):
+        return False
+    return None
+
+def remove_blob(blob_service, container_name, blob_name):
+    # Returns False if the blob does not exist
+    try:
+        blob_service.delete_blob(container_name, blob_name)
+        return True
+    except AzureMissingResourceHttpError:
+        return False
+
+def list_blob_pages(blob_service, container_name, prefix=None, delimiter=None, max_results=None, marker=None, include=None):
+    # Generator yielding one page of blobs at a time by following
+    # continuation markers, so callers can process a listing of any size in
+    # bounded memory. Each item is a (blobs, next_marker) tuple, where
+    # next_marker is None once the listing is complete.
+    remaining = max_results
+    while(True):
+        page_size = MAX_LIST_PAGE_SIZE
+        if(remaining is not None):
+            page_size = min(page_size, remaining)
+        page = blob_service.list_blobs(container_name, prefix=prefix, delimiter=delimiter,
+            num_results=page_size, marker=marker, include=include)
+        blobs = list(page)
+        marker = page.next_marker
+        if(remaining is not None):
+            remaining = remaining - len(blobs)
+        yield (blobs, marker)
+        if(not(marker) or remaining == 0):
+            return
+
+def iter_blobs(blob_service, container_name, prefix=None, delimiter=None, max_results=None, marker=None, include=None):
+    for (blobs, next_marker) in list_blob_pages(blob_service, container_name, prefix, delimiter, max_results, marker, include):
+        for blob in blobs:
+            yield blob
+
+def blob_record(blob):
+    # Virtual directory entries returned when listing with a delimiter have
+    # a name but no properties
+    properties = getattr(blob, 'properties', None)
+    if(properties is None):
+        return {"name": blob.name, "size": None, "etag": None, "last_modified": None}
+    last_modified = properties.last_modified
+    return {
+        "name": blob.name,
+        "size": properties.content_length,
+        "etag": properties.etag,
+        "last_modified": last_modified.isoformat() if last_modified else None
+    }
+
+def glob_prefix(pattern):
+    # Literal part of a wildcard pattern before the first special character,
+    # which can be used as a listing prefix
+    for i, c in enumerate(pattern):
+        if(c in GLOB_SPECIAL_CHARACTERS):
+            return pattern[:i]
+    return pattern
+
+def iter_matching_blobs(blob_service, container_name, prefix=None, pattern=None):
+    if(prefix == None and pattern != None):
+        prefix = glob_prefix(pattern)
+    for blob in iter_blobs(blob_service, container_name, prefix=prefix):
+        if(pattern == None or fnmatch.fnmatchcase(blob.name, pattern)):
+            yield blob
+
+def archive_tar_mode(path):
+    # Returns the streaming tarfile mode for the archive path, or None if the
+    # path is not an archive
+    for (extension, mode) in ARCHIVE_TAR_MODES:
+        if(path.endswith(extension)):
+            return mode
+    return None
+
+def ordered_parallel_map(pool, function, items, window):
+    # Like pool.imap, but never has more than 'window' results in flight, so
+    # memory use stays bounded however far the consumer falls behind
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if(len(pending) >= window):
+            yield pending.popleft().get()
+    while(pending):
+        yield pending.popleft().get()
+
+def with_retries(operation, retries, description):
+    # Calls operation(), retrying with exponential backoff if it raises. Not
+    # found and failed precondition errors will not go away on retry, so they
+    # are raised immediately. The attempt number is published in retry_state
+    # so that metrics can count retries.
+    attempt = 0
+    try:
+        while(True):
+            try:
+                retry_state.attempt = attempt
+                return operation()
+            except AzureHttpError as e:
+                if(e.status_code in (HTTP_NOT_MODIFIED, HTTP_NOT_FOUND, HTTP_PRECONDITION_FAILED) or attempt >= retries):
+                    raise
+                error = e
+            except (IOError, OSError) as e:
+                if(attempt >= retries):
+                    raise
+                error = e
+            delay = min(2 ** attempt, MAX_RETRY_DELAY_SECONDS)
+            attempt = attempt + 1
+            print("Attempt {:d} to {:s} failed ({:s}). Retrying in {:d}s.".format(attempt, description, str(error), delay))
+            time.sleep(delay)
+    finally:
+        retry_state.attempt = 0
+
+def rate_string(count, start_time):
+    elapsed = time.time() - start_time
+    rate = count / elapsed if elapsed > 0 else 0.0
+    return "{:.1f}/s".format(rate)
 
 def ensure_exists(directory):
     if(directory and not os.path.exists(directory)):
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Another process may have created the directory in the meantime
+            if(e.errno != errno.EEXIST):
+                raise
+
+## -------
+## METRICS
+## -------
+# When '--metrics' is given, blob services are wrapped in a proxy that times
+# every call and counts the bytes it transfers. Each call is written as a JSON
+# record as it completes, and a summary per operation type is produced when
+# the command exits. Calls made by with_retries() after a failed attempt are
+# recorded with their attempt number, and the requests the storage SDK
+# retries itself are counted against the call that made them, which together
+# give the retry counts. The SDK sends the chunks of large transfers from its
+# own threads, so their retries are counted separately.
+retry_state = threading.local()
+metrics_state = {"recorder": None}
+
+def count_sdk_retries(service):
+    # Wraps the SDK's retry policy, which decides after each failed request
+    # whether to send it again
+    policy = getattr(service, 'retry', None)
+    if(policy is None):
+        return
+    def retry(context):
+        interval = policy(context)
+        if(interval is not None):
+            if(getattr(retry_state, 'in_operation', False)):
+                retry_state.sdk_retries = retry_state.sdk_retries + 1
+            elif(metrics_state["recorder"] is not None):
+                metrics_state["recorder"].record_chunk_retry()
+        return interval
+    service.retry = retry
+
+def operation_bytes(operation, call_args, call_kwargs, result):
+    # Bytes transferred by a blob service call, from its arguments or result
+    def argument(index, name):
+        if(name in call_kwargs):
+            return call_kwargs[name]
+        if(len(call_args) > index):
+            return call_args[index]
+        return None
+    if(operation == 'create_blob_from_path'):
+        return os.path.getsize(argument(2, 'file_path'))
+    if(operation in ('create_blob_from_bytes', 'append_blob_from_bytes')):
+        return len(argument(2, 'blob'))
+    if(operation == 'append_block'):
+        return len(argument(2, 'block'))
+    if(operation == 'get_blob_to_path' and result is not None):
+        return os.path.getsize(argument(2, 'file_path'))
+    if(operation == 'get_blob_to_bytes' and result is not None):
+        return len(result.content)
+    if(operation == 'get_blob_to_stream' and result is not None):
+        return result.properties.content_length
+    return 0
+
+def percentile(sorted_values, percent):
+    # Nearest-rank percentile
+    if(not(sorted_values)):
+        return None
+    rank = int(-(-percent * len(sorted_values) // 100))
+    return sorted_values[max(rank, 1) - 1]
+
+def latency_histogram(latencies_ms):
+    counts = [0] * (len(METRICS_HISTOGRAM_BUCKETS_MS) + 1)
+    for latency in latencies_ms:
+        bucket = 0
+        while(bucket < len(METRICS_HISTOGRAM_BUCKETS_MS) and latency > METRICS_HISTOGRAM_BUCKETS_MS[bucket]):
+            bucket = bucket + 1
+        counts[bucket] = counts[bucket] + 1
+    labels = ["<={:d}ms".format(bound) for bound in METRICS_HISTOGRAM_BUCKETS_MS] + [">{:d}ms".format(METRICS_HISTOGRAM_BUCKETS_MS[-1])]
+    return dict((label, count) for (label, count) in zip(labels, counts) if count > 0)
+
+class MetricsRecorder(object):
+    def __init__(self, path):
+        ensure_exists(os.path.dirname(path))
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.operations = {}
+        self.chunk_retries = 0
+        self.closed = False
+        metrics_state["recorder"] = self
+
+    def record_chunk_retry(self):
+        with self.lock:
+            self.chunk_retries = self.chunk_retries + 1
+
+    def record(self, operation, call_args, call_kwargs, result, start, seconds, status, sdk_retries):
+        transferred = 0
+        if(status == "ok"):
+            try:
+                transferred = operation_bytes(operation, call_args, call_kwargs, result)
+            except (OSError, TypeError):
+                transferred = 0
+        record = {
+            "type": "operation",
+            "operation": operation,
+            "container": call_args[0] if call_args else call_kwargs.get('container_name'),
+            "blob": call_args[1] if len(call_args) > 1 else call_kwargs.get('blob_name'),
+            "start": start,
+            "seconds": seconds,
+            "bytes": transferred,
+            "status": status,
+            "attempt": getattr(retry_state, 'attempt', 0),
+            "sdk_retries": sdk_retries
+        }
+        with self.lock:
+            self.file.write(json.dumps(record, sort_keys=True) + "\n")
+            stats = self.operations.setdefault(operation, {"latencies": [], "bytes": 0, "errors": 0, "retries": 0})
+            stats["latencies"].append(seconds)
+            stats["bytes"] = stats["bytes"] + transferred
+            if(status not in ("ok", HTTP_NOT_MODIFIED)):
+                stats["errors"] = stats["errors"] + 1
+            if(record["attempt"] > 0):
+                stats["retries"] = stats["retries"] + 1
+            stats["retries"] = stats["retries"] + sdk_retries
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        summaries = []
+        for operation in sorted(self.operations):
+            stats = self.operations[operation]
+            latencies_ms = sorted(1000.0 * latency for latency in stats["latencies"])
+            summary = {
+                "type": "summary",
+                "operation": operation,
+                "count": len(latencies_ms),
+                "errors": stats["errors"],
+                "retries": stats["retries"],
+                "bytes": stats["bytes"],
+                "bytes_per_second": stats["bytes"] / elapsed if elapsed > 0 else 0.0,
+                "histogram_ms": latency_histogram(latencies_ms),
+                "elapsed_seconds": elapsed
+            }
+            for percent in METRICS_PERCENTILES:
+                summary["p{:d}_ms".format(percent)] = percentile(latencies_ms, percent)
+            summaries.append(summary)
+        return summaries
+
+    def close(self):
+        with self.lock:
+            if(self.closed):
+                return
+            self.closed = True
+        if(metrics_state["recorder"] is self):
+            metrics_state["recorder"] = None
+        summaries = self.summary()
+        for summary in summaries:
+            self.file.write(json.dumps(summary, sort_keys=True) + "\n")
+        if(self.chunk_retries > 0):
+            self.file.write(json.dumps({"type": "chunk_retries", "retries": self.chunk_retries}, sort_keys=True) + "\n")
+        self.file.close()
+        sys.stderr.write("Storage operation metrics ({:.1f}s):\n".format(summaries[0]["elapsed_seconds"] if summaries else time.time() - self.start_time))
+        for summary in summaries:
+            sys.stderr.write("  {:s}: {:d} calls, {:d} errors, {:d} retries, p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, {:d} bytes ({:.1f} bytes/s)\n".format(
+                summary["operation"], summary["count"], summary["errors"], summary["retries"],
+                summary["p50_ms"], summary["p95_ms"], summary["p99_ms"], summary["bytes"], summary["bytes_per_second"]))
+        if(self.chunk_retries > 0):
+            sys.stderr.write("  {:d} retries of chunks of large transfers\n".format(self.chunk_retries))
+
+class MetricsBlobService(object):
+    # Proxy that records every public method call made on a blob service
+    def __init__(self, service, recorder):
+        self._service = service
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._service, name)
+        if(name.startswith('_') or not(callable(attribute))):
+            return attribute
+        recorder = self._recorder
+        def timed(*call_args, **call_kwargs):
+            start = time.time()
+            status = "ok"
+            result = None
+            retry_state.in_operation = True
+            retry_state.sdk_retries = 0
+            try:
+                result = attribute(*call_args, **call_kwargs)
+                return result
+            except AzureHttpError as e:
+                status = e.status_code
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                retry_state.in_operation = False
+                recorder.record(name, call_args, call_kwargs, result, start, time.time() - start, status, retry_state.sdk_retries)
+        return timed
+
+def with_metrics(service, args):
+    if(args.metrics_recorder is None):
+        return service
+    return MetricsBlobService(service, args.metrics_recorder)
+
+## ----------------
+## LOCAL BLOB CACHE
+## ----------------
+# Cache entries are keyed on container and blob name. Each entry has a data
+# file holding the blob contents, a metadata file recording the ETag the data
+# was downloaded at, and a lock file. Processes hold an exclusive lock on the
+# entry lock file while revalidating, downloading or copying out an entry, so
+# any number of tasks on the same VM can share the cache safely. The data file
+# modification time is bumped on every hit and used as the LRU clock.
+def cache_entry_key(container_name, blob_name):
+    blob_path = "{:s}/{:s}".format(container_name, blob_name)
+    return hashlib.sha1(blob_path.encode('utf-8')).hexdigest()
+
+def cache_entry_path(cache_dir, key, suffix):
+    return os.path.join(cache_dir, "{:s}{:s}".format(key, suffix))
+
+def lock_file(path, shared=False, blocking=True):
+    # Returns an open file holding the requested lock, or None if the lock is
+    # not available and blocking is False. Closing the file releases the lock.
+    f = open(path, 'a')
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if(not(blocking)):
+        mode = mode | fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), mode)
+    except IOError as e:
+        f.close()
+        if(e.errno in (errno.EAGAIN, errno.EACCES)):
+            return None
+        raise
+    return f
+
+def read_local_copy_meta(data_path, meta_path):
+    if(not(os.path.exists(meta_path) and os.path.exists(data_path))):
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # Treat a corrupt metadata file as a missing copy
+        return None
+
+def write_json_atomic(path, obj):
+    tmp_path = "{:s}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
+
+def remove_local_copy(data_path, meta_path):
+    for path in [data_path, meta_path]:
+        if(os.path.exists(path)):
+            os.remove(path)
+
+def refresh_local_copy(blob_service, container_name, blob_name, data_path, meta_path):
+    # Revalidate a local copy of a blob with a conditional GET on the ETag it
+    # was downloaded at, which is recorded in a metadata file alongside it. An
+    # unchanged blob costs a single request with no body; a changed or
+    # missing copy is downloaded by that same request. Callers must hold a
+    # lock covering the copy. Returns True if the local copy was up to date,
+    # False if it was (re)downloaded and None if the blob does not exist.
+    meta = read_local_copy_meta(data_path, meta_path)
+    etag = meta["etag"] if meta else None
+    tmp_path = "{:s}.{:d}.tmp".format(data_path, os.getpid())
+    try:
+        blob = blob_service.get_blob_to_path(container_name, blob_name, tmp_path, if_none_match=etag)
+        os.rename(tmp_path, data_path)
+    except AzureMissingResourceHttpError:
+        remove_local_copy(data_path, meta_path)
+        return None
+    except AzureHttpError as e:
+        if(e.status_code == HTTP_NOT_MODIFIED):
+            return True
+        raise
+    finally:
+        # Discard any partial download left by a failed or not-modified GET
+        if(os.path.exists(tmp_path)):
+            os.remove(tmp_path)
+    write_json_atomic(meta_path, {
+        "container": container_name,
+        "blob": blob_name,
+        "etag": blob.properties.etag,
+        "size": os.path.getsize(data_path)
+    })
+    return False
+
+def remove_cache_entry(cache_dir, key):
+    remove_local_copy(cache_entry_path(cache_dir, key, CACHE_DATA_SUFFIX), cache_entry_path(cache_dir, key, CACHE_META_SUFFIX))
+
+def refresh_cache_entry(blob_service, container_name, blob_name, cache_dir, key):
+    # Must be called with the entry lock held. Returns True if the entry is a
+    # cache hit, False if it was (re)downloaded and None if the blob does not
+    # exist.
+    data_path = cache_entry_path(cache_dir, key, CACHE_DATA_SUFFIX)
+    meta_path = cache_entry_path(cache_dir, key, CACHE_META_SUFFIX)
+    return refresh_local_copy(blob_service, container_name, blob_name, data_path, meta_path)
+
+def evict_cache(cache_dir, max_size_bytes):
+    # Only one process needs to evict at a time. If another process is
+    # already evicting, leave it to them.
+    evict_lock = lock_file(os.path.join(cache_dir, CACHE_EVICT_LOCK), blocking=False)
+    if(evict_lock is None):
+        return
+    try:
+        entries = []
+        for file_name in os.listdir(cache_dir):
+            if(not(file_name.endswith(CACHE_DATA_SUFFIX))):
+                continue
+            key = file_name[:-len(CACHE_DATA_SUFFIX)]
+            try:
+                stat = os.stat(os.path.join(cache_dir, file_name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, key))
+        total_size = sum(size for (mtime, size, key) in entries)
+        # Evict least recently used entries first, skipping any entry that is
+        # currently locked by another process
+        for (mtime, size, key) in sorted(entries):
+            if(total_size <= max_size_bytes):
+                break
+            entry_lock = lock_file(cache_entry_path(cache_dir, key, CACHE_LOCK_SUFFIX), blocking=False)
+            if(entry_lock is None):
+                continue
+            try:
+                remove_cache_entry(cache_dir, key)
+                total_size = total_size - size
+            finally:
+                entry_lock.close()
+    finally:
+        evict_lock.close()
+
+def fetch_blob_cached(blob_service, container_name, blob_name, output_path, args):
+    # Returns True on a cache hit, False on a cache miss and None if the blob
+    # does not exist
+    cache_dir = args.cache_dir
+    ensure_exists(cache_dir)
+    key = cache_entry_key(container_name, blob_name)
+    entry_lock = lock_file(cache_entry_path(cache_dir, key, CACHE_LOCK_SUFFIX))
+    try:
+        hit = refresh_cache_entry(blob_service, container_name, blob_name, cache_dir, key)
+        if(hit is None):
+            return None
+        data_path = cache_entry_path(cache_dir, key, CACHE_DATA_SUFFIX)
+        # Bump modification time to mark entry as most recently used
+        os.utime(data_path, None)
+        output_dir = os.path.dirname(output_path)
+        ensure_exists(output_dir)
+        shutil.copyfile(data_path, output_path)
+    finally:
+        entry_lock.close()
+    evict_cache(cache_dir, args.cache_size * 1024 * 1024)
+    return hit
+
+## ---------------
+## OUTBOX UPLOADER
+## ---------------
+def outbox_files(outbox_dir):
+    # Returns (path, relative blob name) for every finished file in the
+    # outbox, oldest first
+    files = []
+    for (dir_path, dir_names, file_names) in os.walk(outbox_dir):
+        # Skip hidden directories
+        dir_names[:] = [d for d in dir_names if not(d.startswith('.'))]
+        for file_name in file_names:
+            if(file_name.startswith('.') or file_name.endswith(OUTBOX_IGNORED_SUFFIXES)):
+                continue
+            path = os.path.join(dir_path, file_name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            relative_name = os.path.relpath(path, outbox_dir).replace(os.sep, '/')
+            files.append((mtime, path, relative_name))
+    return [(path, relative_name) for (mtime, path, relative_name) in sorted(files)]
+
+def upload_outbox_file(blob_service, container_name, path, blob_name, args):
+    # Uploads a single outbox file and removes it once the upload has been
+    # committed. Returns True on success. Failed files are left in place to
+    # be retried on the next scan.
+    description = "upload '{:s}'".format(path)
+    try:
+        with_retries(lambda: blob_service.create_blob_from_path(container_name, blob_name, path), args.retries, description)
+    except Exception as e:
+        print("Failed to upload file '{:s}' to container '{:s}' as '{:s}': {:s}".format(path, container_name, blob_name, str(e)))
+        return False
+    os.remove(path)
+    print("File '{:s}' uploaded to container '{:s}' as '{:s}'.".format(path, container_name, blob_name))
+    return True
+
+## ------------------------
+## CONTENT-ADDRESSED STORAGE
+## ------------------------
+# Content is stored once per distinct SHA-256 hash as an immutable object
+# blob, and each name it is put under is an empty reference blob holding the
+# hash in its metadata. Hashes known to be stored are cached in a local file,
+# so a put of already stored content costs no request for the content at all.
+def content_object_name(content_hash):
+    return "{:s}{:s}".format(CONTENT_OBJECT_PREFIX, content_hash)
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+def hash_cache_path(args):
+    if(args.hash_cache != None):
+        return args.hash_cache
+    return "{:s}_{:s}_{:s}_{:s}.txt".format(args.pool_file_prefix, args.resource_group, DEFAULT_HASH_CACHE_PREFIX, args.container)
+
+# The cache file is read once per process. Later calls only read the lines
+# appended since (by this or any other process), so a loop of puts does not
+# read the whole file again for every file.
+hash_caches = {}
+hash_caches_lock = threading.Lock()
+
+def read_hash_cache(path):
+    path = os.path.abspath(path)
+    with hash_caches_lock:
+        (hashes, offset) = hash_caches.get(path, (set(), 0))
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if(size < offset):
+            # The file has been deleted or truncated, so start again
+            (hashes, offset) = (set(), 0)
+        if(size > offset):
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+            # Leave any partly written last line for the next call
+            end = data.rfind(b"\n") + 1
+            hashes.update(line.strip() for line in data[:end].decode('utf-8').splitlines() if line.strip())
+            offset = offset + end
+        hash_caches[path] = (hashes, offset)
+        return hashes
+
+def add_to_hash_cache(path, content_hash):
+    # Single short appends are atomic, so concurrent processes can share the
+    # cache file without locking
+    ensure_exists(os.path.dirname(path))
+    with open(path, 'a') as f:
+        f.write(content_hash + "\n")
+
+def put_content_object(blob_service, container_name, input_path, content_hash, args):
+    # Ensures the content object exists. Returns True if it was uploaded and
+    # False if it was already stored.
+    cache_path = hash_cache_path(args)
+    if(content_hash in read_hash_cache(cache_path)):
+        return False
+    object_name = content_object_name(content_hash)
+    uploaded = False
+    if(not(blob_service.exists(container_name, object_name))):
+        try:
+            blob_service.create_blob_from_path(container_name, object_name, input_path, if_none_match='*')
+            uploaded = True
+        except AzureHttpError as e:
+            # Someone else stored the same content in the meantime
+            if(e.status_code not in (HTTP_CONFLICT, HTTP_PRECONDITION_FAILED)):
+                raise
+    add_to_hash_cache(cache_path, content_hash)
+    return uploaded
+
+def put_content_reference(blob_service, container_name, blob_name, content_hash):
+    metadata = {CONTENT_HASH_METADATA_KEY: content_hash}
+    blob_service.create_blob_from_bytes(container_name, blob_name, b"", metadata=metadata)
+
+def resolve_content_reference(blob_service, container_name, blob_name):
+    # Returns the name of the content object a reference blob points at, or
+    # None if the reference does not exist
+    try:
+        reference = blob_service.get_blob_properties(container_name, blob_name)
+    except AzureMissingResourceHttpError:
+        return None
+    content_hash = (reference.metadata or {}).get(CONTENT_HASH_METADATA_KEY)
+    if(content_hash is None):
+        # Not a reference, so fetch the blob itself
+        return blob_name
+    return content_object_name(content_hash)
+
+## ---------------
+## DATASET STAGING
+## ---------------
+# Numeric CSV files are converted once into a binary columnar layout that
+# tasks can memory-map instead of parsing. A dataset is a data file holding
+# each column as a raw little-endian array, starting at an aligned offset, and
+# a small JSON header describing the row count and each column's name, type
+# and offset. The header also records the ETag of the data blob it was staged
+# with, so workers can tell a consistent pair of files from a restage in
+# progress.
+def parse_int(value):
+    # Integers that do not fit in an int64 column are stored as float64
+    try:
+        return DATASET_INT64_MIN <= int(value) <= DATASET_INT64_MAX
+    except ValueError:
+        return False
+
+def read_csv_rows(input_path, has_header):
+    # Generator yielding (row number, row) for every non-blank data row
+    with open(input_path, 'r') as f:
+        reader = csv.reader(f)
+        header_skipped = not(has_header)
+        for row in reader:
+            if(not(row)):
+                continue
+            if(not(header_skipped)):
+                header_skipped = True
+                continue
+            yield (reader.line_num, [value.strip() for value in row])
+
+def infer_csv_columns(input_path, has_header):
+    # Returns (names, types, row count), with each column typed as int64 if
+    # every value is an integer and float64 otherwise
+    names = None
+    if(has_header):
+        with open(input_path, 'r') as f:
+            for row in csv.reader(f):
+                if(row):
+                    names = [name.strip() for name in row]
+                    break
+    types = None
+    rows = 0
+    for (line_num, row) in read_csv_rows(input_path, has_header):
+        if(types is None):
+            types = ["int64"] * len(row)
+        if(len(row) != len(types)):
+            raise ValueError("Line {:d} of '{:s}' has {:d} columns, expected {:d}.".format(line_num, input_path, len(row), len(types)))
+        for (i, value) in enumerate(row):
+            if(types[i] == "int64" and parse_int(value)):
+                continue
+            try:
+                float(value)
+            except ValueError:
+                raise ValueError("Line {:d} of '{:s}' has non-numeric value '{:s}' in column {:d}.".format(line_num, input_path, value, i + 1))
+            types[i] = "float64"
+        rows = rows + 1
+    if(types is None):
+        raise ValueError("'{:s}' contains no data rows.".format(input_path))
+    if(names is None):
+        names = ["column{:d}".format(i + 1) for i in range(len(types))]
+    return (names, types, rows)
+
+def write_dataset(input_path, has_header, data_path):
+    # Converts the CSV file to a dataset data file and returns its header.
+    # Each column is streamed to its own temporary file and the columns are
+    # then concatenated, so memory use does not grow with the dataset.
+    names, types, rows = infer_csv_columns(input_path, has_header)
+    column_files = [tempfile.TemporaryFile() for _ in types]
+    try:
+        buffers = [[] for _ in types]
+        def flush_buffers():
+            for (i, values) in enumerate(buffers):
+                fmt = "<{:d}{:s}".format(len(values), DATASET_COLUMN_TYPES[types[i]][1])
+                column_files[i].write(struct.pack(fmt, *values))
+                del values[:]
+        for (line_num, row) in read_csv_rows(input_path, has_header):
+            for (i, value) in enumerate(row):
+                buffers[i].append(int(value) if types[i] == "int64" else float(value))
+            if(len(buffers[0]) >= DATASET_WRITE_ROWS):
+                flush_buffers()
+        flush_buffers()
+        columns = []
+        with open(data_path, 'wb') as f:
+            for (i, column_file) in enumerate(column_files):
+                padding = -f.tell() % DATASET_COLUMN_ALIGNMENT
+                f.write(b"\0" * padding)
+                columns.append({
+                    "name": names[i],
+                    "type": types[i],
+                    "dtype": DATASET_COLUMN_TYPES[types[i]][0],
+                    "offset": f.tell()
+                })
+                column_file.seek(0)
+                shutil.copyfileobj(column_file, f)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+    return {
+        "format": DATASET_FORMAT,
+        "version": DATASET_FORMAT_VERSION,
+        "source": os.path.basename(input_path),
+        "rows": rows,
+        "columns": columns
+    }
+
+## ----------------
+## LOCAL BLOB INDEX
+## ----------------
+# The index holds one row per blob with its size, ETag, last modified time and
+# metadata, tagged with the generation of the refresh that last saw it. A
+# refresh lists the container (or a prefix of it) a page at a time, writes
+# the new and changed blobs in each page and records the continuation marker,
+# so an interrupted refresh resumes where it left off. Rows whose ETag is
+# unchanged only have their generation updated. Once the listing completes,
+# rows from earlier generations under the refreshed prefix belong to deleted
+# blobs and are removed. Blob listings cannot be filtered by last modified
+# time, so every refresh still lists the whole prefix.
+def index_filename(args):
+    return "{:s}_{:s}_{:s}_{:s}.sqlite".format(args.pool_file_prefix, args.resource_group, DEFAULT_INDEX_PREFIX, args.container)
+
+def index_path(args):
+    if(args.index_path != None):
+        return args.index_path
+    return index_filename(args)
+
+def open_index(path):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS blobs (container TEXT NOT NULL, name TEXT NOT NULL, size INTEGER, etag TEXT, last_modified TEXT, metadata TEXT, generation INTEGER NOT NULL, PRIMARY KEY (container, name))")
+    db.execute("CREATE TABLE IF NOT EXISTS refreshes (container TEXT NOT NULL, prefix TEXT NOT NULL, generation INTEGER NOT NULL, marker TEXT, completed INTEGER NOT NULL, PRIMARY KEY (container, prefix))")
+    db.commit()
+    return db
+
+def prefix_clause(prefix):
+    # SQL condition and parameters restricting blob names to a prefix. Uses a
+    # name range rather than LIKE so that the primary key index is used and
+    # no characters in the prefix need escaping.
+    if(not(prefix)):
+        return ("1", [])
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return ("name >= ? AND name < ?", [prefix, upper])
+
+def start_index_refresh(db, container_name, prefix):
+    # Returns the generation and continuation marker to refresh from, resuming
+    # any earlier refresh of the same prefix that did not complete
+    row = db.execute("SELECT generation, marker, completed FROM refreshes WHERE container = ? AND prefix = ?", (container_name, prefix)).fetchone()
+    if(row is not None and not(row[2])):
+        return (row[0], row[1])
+    generation = db.execute("SELECT COALESCE(MAX(generation), 0) + 1 FROM refreshes").fetchone()[0]
+    db.execute("INSERT OR REPLACE INTO refreshes (container, prefix, generation, marker, completed) VALUES (?, ?, ?, NULL, 0)", (container_name, prefix, generation))
+    db.commit()
+    return (generation, None)
+
+def index_blob_page(db, container_name, blobs, generation):
+    # Returns the number of (added, changed) blobs in the page
+    if(not(blobs)):
+        return (0, 0)
+    # Listings are in name order, so one range query fetches the existing
+    # rows for the whole page
+    existing = dict(db.execute("SELECT name, etag FROM blobs WHERE container = ? AND name >= ? AND name <= ?",
+        (container_name, blobs[0].name, blobs[-1].name)).fetchall())
+    added = 0
+    changed = 0
+    rows = []
+    unchanged = []
+    for blob in blobs:
+        record = blob_record(blob)
+        if(record["name"] not in existing):
+            added = added + 1
+        elif(existing[record["name"]] != record["etag"]):
+            changed = changed + 1
+        else:
+            unchanged.append((generation, container_name, record["name"]))
+            continue
+        metadata = getattr(blob, 'metadata', None)
+        rows.append((container_name, record["name"], record["size"], record["etag"], record["last_modified"],
+            json.dumps(metadata, sort_keys=True) if metadata else None, generation))
+    db.executemany("INSERT OR REPLACE INTO blobs (container, name, size, etag, last_modified, metadata, generation) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    db.executemany("UPDATE blobs SET generation = ? WHERE container = ? AND name = ?", unchanged)
+    return (added, changed)
+
+def finish_index_refresh(db, container_name, prefix, generation):
+    # Returns the number of removed blobs
+    clause, params = prefix_clause(prefix)
+    cursor = db.execute("DELETE FROM blobs WHERE container = ? AND generation < ? AND " + clause, [container_name, generation] + params)
+    db.execute("UPDATE refreshes SET marker = NULL, completed = 1 WHERE container = ? AND prefix = ?", (container_name, prefix))
+    db.commit()
+    return cursor.rowcount
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            name = line.strip()
+            if(name):
+                yield name
+
+## ---------------------
+## LOCAL STORAGE BACKEND
+## ---------------------
+# A stand-in for the Azure BlockBlobService that keeps each container as a
+# directory on the local filesystem, with blob names mapped to relative paths.
+# It implements the subset of the BlockBlobService interface used by this
+# script, including conditional requests and byte ranges, and raises the same
+# exceptions, so every command can be run, tested and benchmarked on a single
+# machine. ETags are derived from file modification time, inode and size. Writes go
+# to a temporary file that is renamed into place, so readers never see a
+# partially written blob.
+class LocalBlobProperties(object):
+    def __init__(self, etag=None, content_length=None, last_modified=None):
+        self.etag = etag
+        self.content_length = content_length
+        self.last_modified = last_modified
+
+class LocalBlob(object):
+    def __init__(self, name, properties=None, metadata=None, content=None):
+        self.name = name
+        self.properties = properties
+        self.metadata = metadata
+        self.content = content
+
+class LocalBlobPrefix(object):
+    def __init__(self, name):
+        self.name = name
+
+class LocalBlobPage(list):
+    def __init__(self, items, next_marker):
+        list.__init__(self, items)
+        self.next_marker = next_marker
+
+class LocalBlobService(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _container_path(self, container_name):
+        return os.path.join(self.root, container_name)
+
+    def _blob_path(self, container_name, blob_name):
+        return os.path.join(self._container_path(container_name), *blob_name.split('/'))
+
+    def _metadata_path(self, container_name, blob_name):
+        return os.path.join(self.root, LOCAL_METADATA_DIRECTORY, container_name, *blob_name.split('/')) + ".json"
+
+    def _not_found(self, container_name, blob_name):
+        return AzureMissingResourceHttpError("Blob '{:s}' does not exist in container '{:s}'.".format(blob_name, container_name), HTTP_NOT_FOUND)
+
+    def _properties(self, stat):
+        # Writes replace the file, so the inode changes along with the
+        # modification time whenever the blob is overwritten. The time is
+        # taken in nanoseconds where available (Python 3), so that rewrites
+        # of the same size in quick succession still change the ETag.
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if(mtime_ns is None):
+            mtime_ns = int(stat.st_mtime * 1e9)
+        # Fixed-width fields, so different values never run together into
+        # the same ETag
+        etag = '"0x{:016X}{:016X}{:016X}"'.format(mtime_ns, stat.st_ino, stat.st_size)
+        last_modified = datetime.datetime.utcfromtimestamp(stat.st_mtime)
+        return LocalBlobProperties(etag, stat.st_size, last_modified)
+
+    def _metadata(self, container_name, blob_name):
+        metadata_path = self._metadata_path(container_name, blob_name)
+        if(not(os.path.exists(metadata_path))):
+            return {}
+        with open(metadata_path, 'r') as f:
+            return json.load(f)
+
+    def _check_conditions(self, properties, if_match=None, if_none_match=None):
+        # Mirrors the service: a failed If-None-Match on a read is reported as
+        # 'not modified', any other failed condition as 'precondition failed'
+        etag = properties.etag if properties else None
+        if(if_match is not None and (etag is None or (if_match != '*' and if_match != etag))):
+            raise AzureHttpError("The condition specified using HTTP conditional header(s) is not met.", HTTP_PRECONDITION_FAILED)
+        if(if_none_match is not None and etag is not None and (if_none_match == '*' or if_none_match == etag)):
+            return False
+        return True
+
+    def _get_properties(self, container_name, blob_name):
+        path = self._blob_path(container_name, blob_name)
+        if(not(os.path.isfile(path))):
+            return None
+        return self._properties(os.stat(path))
+
+    def _read_blob(self, container_name, blob_name, stream, start_range=None, end_range=None, if_match=None, if_none_match=None):
+        path = self._blob_path(container_name, blob_name)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if(e.errno == errno.ENOENT):
+                raise self._not_found(container_name, blob_name)
+            raise
+        with f:
+            properties = self._properties(os.fstat(f.fileno()))
+            if(not(self._check_conditions(properties, if_match, if_none_match))):
+                raise AzureHttpError("The condition specified using HTTP conditional header(s) is not met.", HTTP_NOT_MODIFIED)
+            start = start_range or 0
+            end = properties.content_length - 1 if end_range is None else end_range
+            f.seek(start)
+            remaining = end - start + 1
+            while(remaining > 0):
+                data = f.read(min(remaining, LOCAL_COPY_CHUNK_SIZE))
+                if(not(data)):
+                    break
+                stream.write(data)
+                remaining = remaining - len(data)
+        return LocalBlob(blob_name, properties, self._metadata(container_name, blob_name))
+
+    def _write_blob(self, container_name, blob_name, stream, metadata=None, if_match=None, if_none_match=None):
+        container_path = self._container_path(container_name)
+        if(not(os.path.isdir(container_path))):
+            raise AzureMissingResourceHttpError("Container '{:s}' does not exist.".format(container_name), HTTP_NOT_FOUND)
+        if(not(self._check_conditions(self._get_properties(container_name, blob_name), if_match, if_none_match))):
+            raise AzureHttpError("The condition specified using HTTP conditional header(s) is not met.", HTTP_PRECONDITION_FAILED)
+        path = self._blob_path(container_name, blob_name)
+        ensure_exists(os.path.dirname(path))
+        tmp_path = "{:s}.{:d}.{:d}.tmp".format(path, os.getpid(), id(stream))
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, LOCAL_COPY_CHUNK_SIZE)
+        os.rename(tmp_path, path)
+        properties = self._properties(os.stat(path))
+        metadata_path = self._metadata_path(container_name, blob_name)
+        if(metadata):
+            ensure_exists(os.path.dirname(metadata_path))
+            with open(metadata_path, 'w') as f:
+                json.dump(metadata, f)
+        elif(os.path.exists(metadata_path)):
+            os.remove(metadata_path)
+        return properties
+
+    def _blob_names(self, container_name, prefix):
+        container_path = self._container_path(container_name)
+        # Only walk the part of the tree that can contain the prefix
+        prefix_dir = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        walk_root = os.path.join(container_path, *prefix_dir.split('/')) if prefix_dir else container_path
+        names = []
+        for (dir_path, dir_names, file_names) in os.walk(walk_root):
+            relative_dir = os.path.relpath(dir_path, container_path).replace(os.sep, '/')
+            for file_name in file_names:
+                if(file_name.endswith(".tmp")):
+                    continue
+                name = file_name if relative_dir == '.' else "{:s}/{:s}".format(relative_dir, file_name)
+                if(name.startswith(prefix)):
+                    names.append(name)
+        return sorted(names)
+
+    def create_container(self, container_name, fail_on_exist=False):
+        container_path = self._container_path(container_name)
+        if(os.path.isdir(container_path)):
+            return False
+        ensure_exists(container_path)
+        return True
+
+    def exists(self, container_name, blob_name=None):
+        if(blob_name is None):
+            return os.path.isdir(self._container_path(container_name))
+        return os.path.isfile(self._blob_path(container_name, blob_name))
+
+    def list_blobs(self, container_name, prefix=None, num_results=None, include=None, delimiter=None, marker=None, timeout=None):
+        # Markers are the name of the next entry to return, as with the
+        # service, so blobs can be deleted while a listing is in progress
+        if(not(os.path.isdir(self._container_path(container_name)))):
+            raise AzureMissingResourceHttpError("Container '{:s}' does not exist.".format(container_name), HTTP_NOT_FOUND)
+        prefix = prefix or ""
+        items = []
+        seen_prefixes = set()
+        for name in self._blob_names(container_name, prefix):
+            if(marker is not None and name < marker):
+                continue
+            if(delimiter):
+                index = name.find(delimiter, len(prefix))
+                if(index >= 0):
+                    virtual_dir = name[:index + len(delimiter)]
+                    if(virtual_dir not in seen_prefixes):
+                        seen_prefixes.add(virtual_dir)
+                        items.append((name, LocalBlobPrefix(virtual_dir)))
+                    continue
+            items.append((name, None))
+            if(num_results is not None and len(items) > num_results):
+                break
+        next_marker = None
+        if(num_results is not None and len(items) > num_results):
+            next_marker = items[num_results][0]
+            items = items[:num_results]
+        blobs = []
+        for (name, item) in items:
+            if(item is None):
+                try:
+                    properties = self._properties(os.stat(self._blob_path(container_name, name)))
+                except OSError:
+                    # Deleted since the directory walk
+                    continue
+                item = LocalBlob(name, properties, self._metadata(container_name, name))
+            blobs.append(item)
+        return LocalBlobPage(blobs, next_marker)
+
+    def get_blob_properties(self, container_name, blob_name, if_match=None, if_none_match=None, timeout=None):
+        properties = self._get_properties(container_name, blob_name)
+        if(properties is None):
+            raise self._not_found(container_name, blob_name)
+        if(not(self._check_conditions(properties, if_match, if_none_match))):
+            raise AzureHttpError("The condition specified using HTTP conditional header(s) is not met.", HTTP_NOT_MODIFIED)
+        return LocalBlob(blob_name, properties, self._metadata(container_name, blob_name))
+
+    def get_blob_to_stream(self, container_name, blob_name, stream, start_range=None, end_range=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        return self._read_blob(container_name, blob_name, stream, start_range, end_range, if_match, if_none_match)
+
+    def get_blob_to_path(self, container_name, blob_name, file_path, open_mode='wb', start_range=None, end_range=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        with open(file_path, open_mode) as f:
+            return self._read_blob(container_name, blob_name, f, start_range, end_range, if_match, if_none_match)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        stream = io.BytesIO()
+        blob = self._read_blob(container_name, blob_name, stream, start_range, end_range, if_match, if_none_match)
+        blob.content = stream.getvalue()
+        return blob
+
+    def create_blob_from_stream(self, container_name, blob_name, stream, count=None, content_settings=None, metadata=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        return self._write_blob(container_name, blob_name, stream, metadata, if_match, if_none_match)
+
+    def create_blob_from_path(self, container_name, blob_name, file_path, content_settings=None, metadata=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        with open(file_path, 'rb') as f:
+            return self._write_blob(container_name, blob_name, f, metadata, if_match, if_none_match)
+
+    def create_blob_from_bytes(self, container_name, blob_name, blob, content_settings=None, metadata=None, if_match=None, if_none_match=None, max_connections=None, timeout=None):
+        return self._write_blob(container_name, blob_name, io.BytesIO(blob), metadata, if_match, if_none_match)
+
+    def delete_blob(self, container_name, blob_name, if_match=None, timeout=None):
+        path = self._blob_path(container_name, blob_name)
+        self._check_conditions(self._get_properties(container_name, blob_name), if_match)
+        try:
+            os.remove(path)
+        except OSError as e:
+            if(e.errno == errno.ENOENT):
+                raise self._not_found(container_name, blob_name)
+            raise
+        metadata_path = self._metadata_path(container_name, blob_name)
+        if(os.path.exists(metadata_path)):
+            os.remove(metadata_path)
+
+    # Append blob operations. Appends write to the blob file in place, so
+    # readers of a growing log see each block as soon as it is appended.
+    def create_blob(self, container_name, blob_name, content_settings=None, metadata=None, if_match=None, if_none_match=None, timeout=None):
+        return self._write_blob(container_name, blob_name, io.BytesIO(), metadata, if_match, if_none_match)
+
+    def append_block(self, container_name, blob_name, block, timeout=None):
+        path = self._blob_path(container_name, blob_name)
+        if(not(os.path.isfile(path))):
+            raise self._not_found(container_name, blob_name)
+        with open(path, 'ab') as f:
+            f.write(block)
+        return self._properties(os.stat(path))
+
+    def append_blob_from_bytes(self, container_name, blob_name, blob, timeout=None):
+        return self.append_block(container_name, blob_name, blob)
+
+## ----------------
+## LOG STREAMING
+## ----------------
+# 'tee' copies its standard input to standard output and ships it to an append
+# blob in batches, once either enough output has been buffered or the oldest
+# buffered output is old enough, so shipping a log costs a handful of requests
+# however chatty the process is. 'tail' follows any number of such blobs with
+# one listing request per poll, using the ETags in the listing to find the
+# blobs that have grown and fetching only the new bytes of each.
+def append_log_chunk(append_service, container_name, blob_name, chunks):
+    # Returns True if the chunks were appended. Failures are reported but
+    # never interrupt the process whose output is being shipped; the caller
+    # keeps the chunks, up to LOG_MAX_BACKLOG_BYTES, and tries again at the
+    # next flush.
+    try:
+        append_service.append_blob_from_bytes(container_name, blob_name, b"".join(chunks))
+        return True
+    except Exception as e:
+        sys.stderr.write("Failed to append output to blob '{:s}' in container '{:s}': {:s}\n".format(blob_name, container_name, str(e)))
+        return False
+
+def print_log_lines(blob_name, data, partial_lines):
+    # Prints complete lines prefixed with the blob name, holding back any
+    # trailing partial line until the rest of it arrives
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    data = partial_lines.get(blob_name, b"") + data
+    lines = data.split(b"\n")
+    partial_lines[blob_name] = lines.pop()
+    label = "[{:s}] ".format(blob_name).encode('utf-8')
+    for line in lines:
+        out.write(label + line + b"\n")
+    out.flush()
 
 ## ------------------
 ## TOP-LEVEL COMMANDS
@@ -86,9 +1472,24 @@ def ensure_exists(directory):
 def list_blobs(args):
     blob_service = get_blob_service(args)
     container_name = args.container
-    blobs = list(blob_service.list_blobs(container_name))
-    for blob in blobs:
-        print(blob.name)
+    pages = list_blob_pages(blob_service, container_name, prefix=args.prefix, delimiter=args.delimiter,
+        max_results=args.max_results, marker=args.marker)
+    if(args.format == 'csv'):
+        writer = csv.DictWriter(sys.stdout, fieldnames=LIST_FIELDS)
+        writer.writeheader()
+    next_marker = None
+    for (blobs, next_marker) in pages:
+        for blob in blobs:
+            if(args.format == 'jsonl'):
+                sys.stdout.write(json.dumps(blob_record(blob), sort_keys=True) + "\n")
+            elif(args.format == 'csv'):
+                writer.writerow(blob_record(blob))
+            else:
+                sys.stdout.write(blob.name + "\n")
+        # Flush each page so downstream consumers can start work immediately
+        sys.stdout.flush()
+    if(next_marker):
+        sys.stderr.write("Listing stopped after {:d} entries. Resume with '--marker={:s}'.\n".format(args.max_results, next_marker))
 
 def put_blob(args):
     blob_service = get_blob_service(args)
@@ -98,8 +1499,13 @@ def put_blob(args):
         blob_name = os.path.basename(input_path)
     else:
         blob_name = args.blob
-    success = blob_service.create_blob_from_path(container_name, blob_name, input_path)
-    print("File '{:s}' uploaded to container '{:s}' as '{:s}'.".format(input_path, container_name, blob_name))
+    (content_hash, uploaded) = upload_file(blob_service, container_name, blob_name, input_path, args)
+    if(content_hash is None):
+        print("File '{:s}' uploaded to container '{:s}' as '{:s}'.".format(input_path, container_name, blob_name))
+    elif(uploaded):
+        print("File '{:s}' uploaded to container '{:s}' as '{:s}' (content '{:s}').".format(input_path, container_name, blob_name, content_hash))
+    else:
+        print("File '{:s}' added to container '{:s}' as '{:s}' (content '{:s}' already stored, skipping upload).".format(input_path, container_name, blob_name, content_hash))
 
 def fetch_blob(args):
     blob_service = get_blob_service(args)
@@ -109,23 +1515,374 @@ def fetch_blob(args):
         output_path = blob_name
     else:
         output_path = args.output_path
-    if(not(blob_service.exists(container_name, blob_name))):
+    hit = fetch_to_file(blob_service, container_name, blob_name, output_path, args)
+    if(hit is None):
         print("Blob '{:s}' does not exist in container '{:s}'. Skipping fetch.".format(blob_name, container_name))
     else:
-        output_dir = os.path.dirname(output_path)
-        ensure_exists(output_dir)
-        blob_service.get_blob_to_path(container_name, blob_name, output_path)
-        print("Blob '{:s}' fetched from container '{:s}' to file '{:s}'.".format(blob_name, container_name, output_path))
+        source = "local cache" if hit else "container '{:s}'".format(container_name)
+        print("Blob '{:s}' fetched from {:s} to file '{:s}'.".format(blob_name, source, output_path))
 
 def delete_blob(args):
     blob_service = get_blob_service(args)
     container_name = args.container
     blob_name = args.blob
-    if(not(blob_service.exists(container_name, blob_name))):
+    if(remove_blob(blob_service, container_name, blob_name)):
+        print("Blob '{:s}' deleted from container '{:s}'.".format(blob_name, container_name))
+    else:
         print("Blob '{:s}' does not exist in container '{:s}'. Skipping delete.".format(blob_name, container_name))
+
+
+def index_blobs(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    prefix = args.prefix or ""
+    path = index_path(args)
+    db = open_index(path)
+    generation, marker = start_index_refresh(db, container_name, prefix)
+    if(marker):
+        print("Resuming interrupted refresh of index '{:s}' for container '{:s}'.".format(path, container_name))
     else:
-        blob_service.delete_blob(container_name, blob_name)
-        print("Blob '{:s}' deleted from container '{:s}'.".format(blob_name, container_name))
+        print("Refreshing index '{:s}' for container '{:s}'.".format(path, container_name))
+    listed = 0
+    added = 0
+    changed = 0
+    include = Include(metadata=True)
+    for (blobs, marker) in list_blob_pages(blob_service, container_name, prefix=prefix, marker=marker, include=include):
+        page_added, page_changed = index_blob_page(db, container_name, blobs, generation)
+        listed = listed + len(blobs)
+        added = added + page_added
+        changed = changed + page_changed
+        db.execute("UPDATE refreshes SET marker = ? WHERE container = ? AND prefix = ?", (marker, container_name, prefix))
+        db.commit()
+    removed = finish_index_refresh(db, container_name, prefix, generation)
+    db.close()
+    print("Indexed {:d} blobs in container '{:s}': {:d} added, {:d} changed, {:d} removed.".format(listed, container_name, added, changed, removed))
+
+def query_index(args):
+    container_name = args.container
+    path = index_path(args)
+    if(not(os.path.exists(path))):
+        print("Index '{:s}' does not exist. Run the 'index' command to build it.".format(path))
+        return
+    db = open_index(path)
+    clause, params = prefix_clause(args.prefix)
+    if(args.query == 'count'):
+        count, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs WHERE container = ? AND " + clause, [container_name] + params).fetchone()
+        print("{:d} blobs ({:d} bytes) indexed in container '{:s}'.".format(count, size, container_name))
+    elif(args.query == 'list'):
+        rows = db.execute("SELECT name, size, etag, last_modified FROM blobs WHERE container = ? AND " + clause + " ORDER BY name", [container_name] + params)
+        if(args.format == 'csv'):
+            writer = csv.DictWriter(sys.stdout, fieldnames=LIST_FIELDS)
+            writer.writeheader()
+        for row in rows:
+            record = dict(zip(LIST_FIELDS, row))
+            if(args.format == 'jsonl'):
+                sys.stdout.write(json.dumps(record, sort_keys=True) + "\n")
+            elif(args.format == 'csv'):
+                writer.writerow(record)
+            else:
+                sys.stdout.write(record["name"] + "\n")
+    elif(args.query == 'missing'):
+        prefix = args.prefix or ""
+        for name in read_manifest(args.manifest):
+            if(not(name.startswith(prefix))):
+                continue
+            row = db.execute("SELECT 1 FROM blobs WHERE container = ? AND name = ?", (container_name, name)).fetchone()
+            if(row is None):
+                sys.stdout.write(name + "\n")
+    db.close()
+
+def delete_blobs(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    pattern = args.glob
+    prefix = args.prefix
+    if(prefix == None and pattern != None):
+        prefix = glob_prefix(pattern)
+
+    def delete_one(blob_name):
+        try:
+            blob_service.delete_blob(container_name, blob_name)
+            return True
+        except AzureMissingResourceHttpError:
+            # Already deleted by someone else
+            return False
+
+    start_time = time.time()
+    matched = 0
+    matched_bytes = 0
+    deleted = 0
+    pool = ThreadPool(args.parallel)
+    try:
+        # Delete a page at a time so that only one page of the listing is held
+        # in memory, however many blobs match
+        for (blobs, marker) in list_blob_pages(blob_service, container_name, prefix=prefix):
+            matching = [blob for blob in blobs if pattern == None or fnmatch.fnmatchcase(blob.name, pattern)]
+            names = [blob.name for blob in matching]
+            matched = matched + len(names)
+            matched_bytes = matched_bytes + sum(blob.properties.content_length for blob in matching)
+            if(args.dry_run or not(names)):
+                continue
+            deleted = deleted + sum(pool.map(delete_one, names))
+            print("Deleted {:d} blobs from container '{:s}' ({:s}).".format(deleted, container_name, rate_string(deleted, start_time)))
+    finally:
+        pool.close()
+        pool.join()
+    if(args.dry_run):
+        print("Dry run: {:d} blobs ({:d} bytes) in container '{:s}' would be deleted.".format(matched, matched_bytes, container_name))
+    else:
+        print("Deleted {:d} of {:d} matching blobs from container '{:s}' in {:.1f}s ({:s}).".format(deleted, matched, container_name, time.time() - start_time, rate_string(deleted, start_time)))
+
+def collect_blobs(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    output_path = args.output_path
+    tar_mode = archive_tar_mode(output_path)
+
+    def download(blob):
+        return blob_service.get_blob_to_bytes(container_name, blob.name)
+
+    start_time = time.time()
+    collected = 0
+    collected_bytes = 0
+    ensure_exists(os.path.dirname(output_path))
+    tmp_path = "{:s}.{:d}.tmp".format(output_path, os.getpid())
+    pool = ThreadPool(args.parallel)
+    try:
+        with open(tmp_path, 'wb') as f:
+            if(output_path.endswith('.zst')):
+                output = zstandard.ZstdCompressor().stream_writer(f)
+            else:
+                output = f
+            tar = tarfile.open(fileobj=output, mode=tar_mode) if tar_mode else None
+            blobs = iter_matching_blobs(blob_service, container_name, args.prefix, args.glob)
+            for blob in ordered_parallel_map(pool, download, blobs, 2 * args.parallel):
+                content = blob.content
+                if(tar is not None):
+                    info = tarfile.TarInfo(blob.name)
+                    info.size = len(content)
+                    info.mtime = calendar.timegm(blob.properties.last_modified.utctimetuple())
+                    tar.addfile(info, io.BytesIO(content))
+                else:
+                    if(args.skip_header and collected > 0):
+                        content = content.split(b"\n", 1)[1] if b"\n" in content else b""
+                    if(content and not(content.endswith(b"\n"))):
+                        content = content + b"\n"
+                    output.write(content)
+                collected = collected + 1
+                collected_bytes = collected_bytes + len(blob.content)
+            if(tar is not None):
+                tar.close()
+            if(output is not f):
+                output.flush(zstandard.FLUSH_FRAME)
+        os.rename(tmp_path, output_path)
+    finally:
+        pool.close()
+        pool.join()
+        if(os.path.exists(tmp_path)):
+            os.remove(tmp_path)
+    print("Collected {:d} blobs ({:d} bytes) from container '{:s}' into '{:s}' in {:.1f}s ({:s}).".format(collected, collected_bytes, container_name, output_path, time.time() - start_time, rate_string(collected, start_time)))
+
+def run_uploader(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    outbox_dir = args.outbox_dir
+    prefix = args.prefix or ""
+    ensure_exists(outbox_dir)
+    # Finish the batch in progress and exit cleanly when asked to stop
+    stop = []
+    def request_stop(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def upload(item):
+        path, relative_name = item
+        return upload_outbox_file(blob_service, container_name, path, prefix + relative_name, args)
+
+    if(args.drain):
+        print("Uploading all files in outbox '{:s}' to container '{:s}'.".format(outbox_dir, container_name))
+    else:
+        print("Watching outbox '{:s}' for files to upload to container '{:s}'.".format(outbox_dir, container_name))
+    sys.stdout.flush()
+    uploaded = 0
+    pool = ThreadPool(args.parallel)
+    try:
+        while(not(stop)):
+            files = outbox_files(outbox_dir)
+            if(args.drain and not(files)):
+                break
+            results = pool.map(upload, files) if files else []
+            uploaded = uploaded + sum(results)
+            sys.stdout.flush()
+            if(args.drain and not(all(results))):
+                print("{:d} files could not be uploaded and remain in outbox '{:s}'.".format(len(results) - sum(results), outbox_dir))
+                break
+            if(not(args.drain)):
+                time.sleep(args.poll_interval)
+    finally:
+        pool.close()
+        pool.join()
+    print("Uploader stopped after uploading {:d} files from outbox '{:s}'.".format(uploaded, outbox_dir))
+
+def tee_log(args):
+    append_service = get_append_blob_service(args)
+    container_name = args.container
+    blob_name = args.blob
+    if(args.append):
+        # Create the log blob only if it does not exist yet
+        try:
+            append_service.create_blob(container_name, blob_name, if_none_match='*')
+        except AzureHttpError as e:
+            if(e.status_code not in (HTTP_CONFLICT, HTTP_PRECONDITION_FAILED)):
+                raise
+    else:
+        append_service.create_blob(container_name, blob_name)
+    stdin_fd = sys.stdin.fileno()
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    chunks = collections.deque()
+    buffered = 0
+    shipped = 0
+    dropped = 0
+    last_flush = time.time()
+    end_of_input = False
+    while(not(end_of_input)):
+        timeout = max(0, last_flush + args.flush_interval - time.time())
+        ready, _, _ = select.select([stdin_fd], [], [], timeout)
+        if(ready):
+            data = os.read(stdin_fd, LOG_READ_SIZE)
+            if(data):
+                out.write(data)
+                out.flush()
+                chunks.append(data)
+                buffered = buffered + len(data)
+            else:
+                end_of_input = True
+        interval_elapsed = (time.time() - last_flush >= args.flush_interval)
+        if(buffered > 0 and (buffered >= args.flush_bytes or interval_elapsed or end_of_input)):
+            if(append_log_chunk(append_service, container_name, blob_name, chunks)):
+                shipped = shipped + buffered
+                chunks = collections.deque()
+                buffered = 0
+            elif(buffered > LOG_MAX_BACKLOG_BYTES):
+                dropping = 0
+                while(buffered - dropping > LOG_MAX_BACKLOG_BYTES):
+                    dropping = dropping + len(chunks.popleft())
+                buffered = buffered - dropping
+                dropped = dropped + dropping
+                sys.stderr.write("Dropped the oldest {:d} bytes of output not yet appended to blob '{:s}', keeping the latest {:d} bytes to retry.\n".format(dropping, blob_name, buffered))
+        if(interval_elapsed or not(buffered)):
+            last_flush = time.time()
+    if(buffered > 0):
+        sys.stderr.write("{:d} bytes of output could not be appended to blob '{:s}' in container '{:s}'.\n".format(buffered, blob_name, container_name))
+    if(dropped > 0):
+        sys.stderr.write("{:d} bytes of output were dropped while appending to blob '{:s}' in container '{:s}' was failing.\n".format(dropped, blob_name, container_name))
+    sys.stderr.write("Appended {:d} bytes of output to blob '{:s}' in container '{:s}'.\n".format(shipped, blob_name, container_name))
+
+def tail_logs(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    prefix = args.prefix
+    pattern = args.glob
+    if(args.blob != None):
+        prefix = args.blob
+        pattern = None
+    etags = {}
+    offsets = {}
+    partial_lines = {}
+    first_poll = True
+    try:
+        while(True):
+            for blob in iter_matching_blobs(blob_service, container_name, prefix, pattern):
+                name = blob.name
+                if(args.blob != None and name != args.blob):
+                    continue
+                etag = blob.properties.etag
+                size = blob.properties.content_length
+                if(etags.get(name) == etag):
+                    continue
+                etags[name] = etag
+                if(first_poll and not(args.from_start)):
+                    # Only follow output appended from now on
+                    offsets[name] = size
+                    continue
+                offset = offsets.get(name, 0)
+                if(size < offset):
+                    # Blob was replaced by a new log, so start again
+                    offset = 0
+                    partial_lines[name] = b""
+                if(size > offset):
+                    try:
+                        data = blob_service.get_blob_to_bytes(container_name, name, start_range=offset, end_range=size - 1).content
+                    except AzureMissingResourceHttpError:
+                        continue
+                    print_log_lines(name, data, partial_lines)
+                    offset = offset + len(data)
+                offsets[name] = offset
+            first_poll = False
+            time.sleep(args.flush_interval)
+    except KeyboardInterrupt:
+        pass
+
+def stage_dataset(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    input_path = args.input_path
+    header_blob_name = args.blob + DATASET_HEADER_SUFFIX
+    data_blob_name = args.blob + DATASET_DATA_SUFFIX
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(work_dir, "dataset" + DATASET_DATA_SUFFIX)
+        header_path = os.path.join(work_dir, "dataset" + DATASET_HEADER_SUFFIX)
+        print("Converting '{:s}' to binary dataset.".format(input_path))
+        try:
+            header = write_dataset(input_path, args.csv_header, data_path)
+        except ValueError as e:
+            print("Cannot stage dataset: {:s}".format(str(e)))
+            return
+        # Upload the data before the header, so the header only ever refers
+        # to data that has been uploaded
+        blob_service.create_blob_from_path(container_name, data_blob_name, data_path)
+        # Not all SDK versions return the properties of the uploaded blob
+        header["data_etag"] = blob_service.get_blob_properties(container_name, data_blob_name).properties.etag
+        with open(header_path, 'w') as f:
+            json.dump(header, f, indent=2, sort_keys=True)
+        blob_service.create_blob_from_path(container_name, header_blob_name, header_path)
+    finally:
+        shutil.rmtree(work_dir)
+    print("Dataset '{:s}' ({:d} rows, {:d} columns) staged to container '{:s}' as '{:s}' and '{:s}'.".format(input_path, header["rows"], len(header["columns"]), container_name, header_blob_name, data_blob_name))
+
+def fetch_dataset(args):
+    blob_service = get_blob_service(args)
+    container_name = args.container
+    dataset_name = args.blob
+    if(args.output_path == None):
+        output_path = os.path.basename(dataset_name)
+    else:
+        output_path = args.output_path
+    header_path = output_path + DATASET_HEADER_SUFFIX
+    data_path = output_path + DATASET_DATA_SUFFIX
+    ensure_exists(os.path.dirname(output_path))
+    # Tasks starting together on the same VM wait for the first to fetch the
+    # dataset and then find it up to date
+    dataset_lock = lock_file(output_path + DATASET_LOCK_SUFFIX)
+    try:
+        header_state = refresh_local_copy(blob_service, container_name, dataset_name + DATASET_HEADER_SUFFIX, header_path, header_path + DATASET_META_SUFFIX)
+        if(header_state is None):
+            print("Dataset '{:s}' does not exist in container '{:s}'. Skipping fetch.".format(dataset_name, container_name))
+            return
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        data_state = refresh_local_copy(blob_service, container_name, dataset_name + DATASET_DATA_SUFFIX, data_path, data_path + DATASET_META_SUFFIX)
+        data_meta = read_local_copy_meta(data_path, data_path + DATASET_META_SUFFIX)
+        if(data_state is None or data_meta["etag"] != header["data_etag"]):
+            sys.exit("Dataset '{:s}' in container '{:s}' changed while it was being fetched. Please fetch it again.".format(dataset_name, container_name))
+    finally:
+        dataset_lock.close()
+    if(header_state and data_state):
+        print("Dataset '{:s}' at '{:s}' is up to date.".format(dataset_name, output_path))
+    else:
+        print("Dataset '{:s}' ({:d} rows) fetched from container '{:s}' to '{:s}' and '{:s}'.".format(dataset_name, header["rows"], container_name, header_path, data_path))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+
+# Python API for the operations of az-vm-pool.py, az-queue.py and
+# az-storage.py, for driver scripts that would otherwise run one of those
+# scripts for every operation. Each object keeps its Azure login, clients and
+# connections open for as long as it is used. For example:
+#
+#   import azpool
+#   tasks = azpool.TaskQueue("testpool93647", "tasks")
+#   tasks.put_all(["julia run.jl {:d}".format(i) for i in range(100)])
+#   store = azpool.BlobStore("testpool93647")
+#   store.fetch("results/0.csv", "results/0.csv")
+#
+# The scripts are loaded from the directory this file is in, so keep it
+# alongside them. Options take the same values as the command line options of
+# the same name and are checked in the same way.
+#
+# Each object keeps its own options, and each operation its own Azure
+# lookups. The only state shared between objects is what belongs to the whole
+# process: the Azure CLI, which runs one call at a time, its login and
+# subscription list, and clients and connections keyed on the account and
+# credentials they were created with.
+
+import os
+
+try:
+    import importlib.util as importlib_util
+except ImportError:
+    # Python 2
+    importlib_util = None
+    import imp
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+## ----------------
+## HELPER FUNCTIONS
+## ----------------
+loaded_scripts = {}
+
+def load_script(script_name):
+    # The scripts have hyphenated names, so cannot be loaded with 'import'
+    if(script_name not in loaded_scripts):
+        path = os.path.join(SCRIPT_DIRECTORY, script_name)
+        module_name = os.path.splitext(script_name)[0].replace('-', '_')
+        if(importlib_util is not None):
+            spec = importlib_util.spec_from_file_location(module_name, path)
+            module = importlib_util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            module = imp.load_source(module_name, path)
+        loaded_scripts[script_name] = module
+    return loaded_scripts[script_name]
+
+def script_args(script, positional_args, options):
+    # Builds the arguments for a command with the script's own parser, so
+    # defaults and checks are the same as on the command line. Options set to
+    # None or False are left at their defaults.
+    argv = list(positional_args)
+    for (name, value) in options:
+        option = "--" + name.replace('_', '-')
+        if(value is True):
+            argv.append(option)
+        elif(value is not None and value is not False):
+            argv.extend([option, str(value)])
+    try:
+        return script.parse_args(argv)
+    except SystemExit:
+        # The parser has already printed why
+        raise ValueError("Invalid options for {:s}. See the error printed above.".format(os.path.basename(script.__file__)))
+
+## ----
+## POOL
+## ----
+class Pool(object):
+    # The VM pool in a resource group. Checks the Azure CLI login, as
+    # az-vm-pool.py does, when created. Operations log their progress in the
+    # same way as the matching az-vm-pool.py commands.
+    def __init__(self, resource_group, pool_directory=None, backend=None, parallel=None, ssh_persist=None, upload_via=None):
+        self._script = load_script("az-vm-pool.py")
+        self.resource_group = resource_group
+        self._options = [("pool_directory", pool_directory), ("backend", backend), ("parallel", parallel),
+                         ("ssh_persist", ssh_persist)]
+        # Only accepted by the commands that upload directories to the VMs
+        self._upload_options = [("upload_via", upload_via)]
+        self._subscription = None
+        args = self._command_args('show-pool')
+        self._script.initialise_azure(args)
+        self._subscription = args.subscription
+
+    def _command_args(self, command, options=[]):
+        # Each operation gets new arguments, and with them its own lookups,
+        # as the pool may have changed since the last one
+        args = script_args(self._script, [self.resource_group, command], self._options + options)
+        args.subscription = self._subscription
+        return args
+
+    def vms(self):
+        return self._script.get_vms(self._command_args('show-pool'))
+
+    def resources(self):
+        # The VMs, public IPs, NICs and OS disks in the pool, by VM name
+        return self._script.get_pool_inventory(self._command_args('show-pool'))
+
+    # The operations below on many VMs return a result per VM, with the
+    # success, timing and error of each step
+    def create(self, num_vms, vm_size, vm_image=None):
+        options = [("num_vms", num_vms), ("vm_size", vm_size), ("vm_image", vm_image)]
+        return self._script.create_pool(self._command_args('create-pool', options))
+
+    def provision(self, num_vms, vm_size, vm_image=None):
+        options = [("num_vms", num_vms), ("vm_size", vm_size), ("vm_image", vm_image)]
+        return self._script.provision_pool(self._command_args('provision', options + self._upload_options))
+
+    def setup(self):
+        return self._script.setup_pool(self._command_args('setup-pool', self._upload_options))
+
+    def deploy_task(self, redeploy=False):
+        # Only deploys to VMs without the current version of the task, unless
+        # 'redeploy' is set
+        options = [("redeploy", redeploy)]
+        return self._script.deploy_task(self._command_args('deploy-task', options + self._upload_options))
+
+    def start_task(self):
+        return self._script.start_task(self._command_args('start-task'))
+
+    def kill_task(self):
+        return self._script.kill_task(self._command_args('kill-task'))
+
+    def start(self):
+        self._script.start_all(self._command_args('start-all'))
+
+    def stop(self):
+        self._script.shutdown_all(self._command_args('stop-all'))
+
+    def refresh_sas(self):
+        self._script.refresh_sas(self._command_args('refresh-sas'))
+
+## ----------
+## TASK QUEUE
+## ----------
+class TaskQueue(object):
+    # A service bus queue of tasks, as used by az-queue.py
+    def __init__(self, resource_group, queue_name, sas_path=None):
+        self._script = load_script("az-queue.py")
+        self.name = queue_name
+        self._args = script_args(self._script, [resource_group, queue_name, 'status'], [("sas_path", sas_path)])
+
+    def exists(self):
+        return bool(self._script.queue_exists(self.name, self._args))
+
+    def create(self):
+        return self._script.create_queue(self.name, self._args)
+
+    def delete(self):
+        return self._script.delete_queue(self.name, self._args)
+
+    def put(self, task):
+        return self._script.queue_task(task, self.name, self._args)
+
+    def put_all(self, tasks):
+        # Returns False if the queue does not exist
+        return self._script.queue_tasks(tasks, self.name, self._args)
+
+    def fetch(self):
+        # Removes the next task from the queue and returns it, or returns
+        # None if the queue is empty or does not exist
+        task = self._script.fetch_task(self.name, self._args)
+        if(task is False):
+            return None
+        return task
+
+    def __len__(self):
+        return self._script.queue_length(self.name, self._args)
+
+## ----------
+## BLOB STORE
+## ----------
+class BlobStore(object):
+    # A container in the pool storage account (or the 'local' backend), as
+    # used by az-storage.py
+    def __init__(self, resource_group, container=None, sas_path=None, backend=None, local_root=None,
+                 parallel=None, content_addressed=False, cache_dir=None, cache_size=None):
+        self._script = load_script("az-storage.py")
+        options = [("container", container), ("sas_path", sas_path), ("backend", backend), ("local_root", local_root),
+                   ("parallel", parallel), ("content_addressed", content_addressed), ("cache_dir", cache_dir),
+                   ("cache_size", cache_size)]
+        self._args = script_args(self._script, [resource_group, 'list'], options)
+        self.container = self._args.container
+
+    def _service(self):
+        return self._script.get_blob_service(self._args)
+
+    def list(self, prefix=None):
+        # Yields the name, size, ETag and last modified time of each blob
+        for blob in self._script.iter_blobs(self._service(), self.container, prefix=prefix):
+            yield self._script.blob_record(blob)
+
+    def put(self, input_path, blob=None):
+        # Returns the name of the blob, which defaults to the file name
+        if(blob is None):
+            blob = os.path.basename(input_path)
+        self._script.upload_file(self._service(), self.container, blob, input_path, self._args)
+        return blob
+
+    def fetch(self, blob, output_path=None):
+        # Returns False if the blob does not exist
+        if(output_path is None):
+            output_path = blob
+        return self._script.fetch_to_file(self._service(), self.container, blob, output_path, self._args) is not None
+
+    def delete(self, blob):
+        # Returns False if the blob does not exist
+        return self._script.remove_blob(self._service(), self.container, blob)
@@ -8,7 +8,7 @@
 # MAXNEVENTS
 # MAXT
 
-using PDMP, JLD
+using PDMP, JLD, JSON
 
 params = Dict(
     "CHILDNAME"  => CHILDNAME,
@@ -24,8 +24,29 @@ params = Dict(
 start = time()
 scriptdir = dirname(@__FILE__)
 println(scriptdir)
-a = readdlm(scriptdir * "/data/ratings.csv", ',', Int)
-R = a[:,1:3]
+# The ratings are staged as a binary dataset by deploy/run.sh and fetched to
+# the VM by task/run.sh, so each column can be memory-mapped without parsing
+datasetpath = scriptdir * "/data/ratings"
+header = JSON.parsefile(datasetpath * ".json")
+# Columns are named column1, column2, ... as the CSV file has no header row.
+# stage-dataset stores a column as float64 if any value in it is not an
+# int64, so map each column with the type given in the header.
+function mapcolumn(io, name)
+    columns = filter(c -> c["name"] == name, header["columns"])
+    isempty(columns) && error("Dataset '$datasetpath' has no column '$name'")
+    c = columns[1]
+    T = c["type"] == "int64" ? Int64 : c["type"] == "float64" ? Float64 :
+        error("Column '$name' of dataset '$datasetpath' has unsupported type '$(c["type"])'")
+    Mmap.mmap(io, Vector{T}, header["rows"], c["offset"])
+end
+# Keep the columns as separate memory-mapped vectors, combining them into a
+# matrix would copy the whole dataset into memory
+users, movies, ratings = open(datasetpath * ".bin") do io
+    [mapcolumn(io, name) for name in ["column1", "column2", "column3"]]
+end
+# Users and movies index the factors, so must be integers
+eltype(users) == Int64 || error("User ids in dataset '$datasetpath' are not all integers")
+eltype(movies) == Int64 || error("Movie ids in dataset '$datasetpath' are not all integers")
 
 println("($(time()-start)s) -- read the data")
 
@@ -37,8 +58,8 @@ sigmaR  = SIGMA_R
 
 ### there may be discrepancy with lines missing etc.
 # -> use unique
-nU = maximum(R[:,1])
-nV = maximum(R[:,2])
+nU = maximum(users)
+nV = maximum(movies)
 
 # factors: create N factors for the users,
 mvgU             = MvDiagonalGaussian(zeros(latentD), sigmaU)
@@ -77,8 +98,8 @@ structure = [[k] for k in 1:(nU+nV)]
 #  fRij      Ui,Vj = [i, nU+j]
 # -----------------------------
 
-for k in 1:size(R,1)
-    i,j, rij = R[k,:]
+for k in 1:length(ratings)
+    i, j, rij = users[k], movies[k], ratings[k]
     # the likelihood
     gij = PMFGaussian(rij, sigmaR, latentD)
     # the factor
@@ -117,11 +138,10 @@ save(filepath,
 
 println("($(time()-start)s) -- saved the results")
 
-resourcegroup = "mortest42"
-saspath  = scriptdir * "/secrets/azure_vm_pool_mortest42_sas_storage_container_data.txt"
-storagescript = scriptdir * "/az-storage.py"
-pushcommand = `python $storagescript $resourcegroup put -i $filepath --sas-path $saspath`
-
-run(pushcommand)
+# Hand the results over to the background uploader started by run.sh. Moving
+# the finished file into the outbox ensures a partial file is never uploaded.
+outboxdir = scriptdir * "/outbox"
+mkpath(outboxdir)
+mv(filepath, outboxdir * "/" * basename(filepath), remove_destination=true)
 
 println("($(time()-start)s) -- pushed the results to Azure")
\ No newline at end of file
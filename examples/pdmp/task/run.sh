@@ -3,6 +3,16 @@ DIR=`dirname "$BASH_SOURCE"`
 resourcegroup="mortest42"
 queuename="tasks"
 taskfile="task.txt"
+outboxdir="$DIR/outbox"
+storagesaspath="$DIR/secrets/azure_vm_pool_mortest42_sas_storage_container_data.txt"
+# Keep Azure connections warm between the az-queue.py and az-storage.py calls below
+python $DIR/az-daemon.py start &
+daemonpid=$!
+# Fetch the staged ratings dataset once for all tasks run on this VM
+python $DIR/az-storage.py $resourcegroup fetch-dataset -b datasets/ratings -o $DIR/data/ratings --sas-path $storagesaspath
+# Upload task outputs in the background so the next task can start straight away
+python $DIR/az-storage.py $resourcegroup uploader --outbox-dir $outboxdir --sas-path $storagesaspath &
+uploaderpid=$!
 while [ 1 ]
 do
 	eval "python $DIR/az-queue.py $resourcegroup $queuename fetch -o $DIR/$taskfile --sas-path $DIR/secrets/azure_vm_pool_mortest42_sas_servicebus_management.txt"
@@ -10,9 +20,16 @@ do
 	then
 	    task=$(cd "$DIR" && cat "$taskfile")
 	    echo "Running task"
-		eval "$task"
+		# Ship task output to a log blob per VM that can be followed with 'az-storage.py tail'
+		eval "$task" 2>&1 | python $DIR/az-storage.py $resourcegroup tee -b logs/$(hostname).log --append --sas-path $storagesaspath
 	else
-		echo "No tasks to process. Exiting."
+		echo "No tasks to process. Waiting for uploads to finish."
+		kill $uploaderpid
+		wait $uploaderpid
+		python $DIR/az-storage.py $resourcegroup uploader --outbox-dir $outboxdir --sas-path $storagesaspath --drain
+		python $DIR/az-daemon.py stop
+		wait $daemonpid
+		echo "Exiting."
 		exit
 	fi
 	sleep 5
@@ -3,6 +3,17 @@
 import argparse
 import os
 
+## -----------------
+## DAEMON FORWARDING
+## -----------------
+# Commands are sent to az-daemon.py when it is running, see azdaemonclient.py
+# No commands need to run outside the daemon
+DAEMON_LOCAL_COMMANDS = []
+
+if(__name__ == "__main__"):
+    import azdaemonclient
+    azdaemonclient.forward_to_daemon()
+
 from azure.servicebus import ServiceBusService, Message, Queue
 
 DEFAULT_SAS_DIRECTORY = 'secrets'
@@ -11,7 +22,10 @@ DEFAULT_SERVICEBUS_SAS_KEY_NAME = "RootManageSharedAccessKey"
 DEFAULT_SERVICEBUS_SAS_PREFIX = "sas_servicebus"
 
 def main():
-    # Parse command line arguments
+    run(parse_args())
+
+def parse_args(argv=None):
+    # Also used by azpool.py to build the arguments for its TaskQueue objects
     parser = argparse.ArgumentParser(description=__name__)
     parser.add_argument('resource_group',
         help='Name of VM pool resource group.')
@@ -25,7 +39,7 @@ def main():
     parser.add_argument('--sas-path', '-t',
         help='Path to Shared Access Signature (SAS) token with full access to the queue')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # Add some default arguments that we won't clutter up the command line with
     args.pool_file_prefix = DEFAULT_POOL_FILE_PREFIX
     args.servicebus_sas_prefix = DEFAULT_SERVICEBUS_SAS_PREFIX
@@ -36,7 +50,9 @@ def main():
         parser.error("Input path required for command '{:s}'. Please provide using '-i' or '--input-path'".format(args.command))
     if(args.command in ['fetch'] and args.output_path == None):
         parser.error("Output path required for command '{:s}'. Please provide using '-o' or '--output-path'".format(args.command))
+    return args
 
+def run(args):
     if(args.command == 'create'):
         create(args)
     elif(args.command == 'status'):
@@ -73,16 +89,22 @@ def get_servicebus_management_sas(args):
         sas = f.readline()
     return sas
 
+# Service bus clients are kept for the life of the process, which is many
+# commands when run by az-daemon.py
+servicebus_services = {}
+
 def get_servicebus(args):
     namespace = servicebus_namespace(args)
     key_name = args.servicebus_sas_key_name
     key_value = get_servicebus_management_sas(args)
-    bus = ServiceBusService(
-        service_namespace = namespace,
-        shared_access_key_name = key_name,
-        shared_access_key_value = key_value
-    )
-    return(bus)
+    key = (namespace, key_name, key_value)
+    if(key not in servicebus_services):
+        servicebus_services[key] = ServiceBusService(
+            service_namespace = namespace,
+            shared_access_key_name = key_name,
+            shared_access_key_value = key_value
+        )
+    return(servicebus_services[key])
 
 def queue_exists(queue_name, args):
     bus = get_servicebus(args)
@@ -113,6 +135,14 @@ def queue_task(task, queue_name, args):
         success = bus. send_queue_message(queue_name, Message(task))
         return success
 
+def queue_tasks(tasks, queue_name, args):
+    # Checks the queue exists once for the whole batch rather than per task
+    bus = get_servicebus(args)
+    if(not(queue_exists(queue_name, args))):
+        return False
+    else:
+        return [bus.send_queue_message(queue_name, Message(task)) for task in tasks]
+
 def create_queue(queue_name, args):
     bus = get_servicebus(args)
     if(queue_exists(queue_name, args)):
@@ -130,13 +160,9 @@ def delete_queue(queue_name, args):
         return(success)
 
 def fill_queue(queue_name, task_file_path, args):
-    bus = get_servicebus(args)
-    if(not(queue_exists(queue_name, args))):
-        return(False)
-    else:
-        with open(task_file_path, 'r') as f:
-            tasks = f.readlines()
-        [queue_task(task, queue_name, args) for task in tasks]
+    with open(task_file_path, 'r') as f:
+        tasks = f.readlines()
+    return queue_tasks(tasks, queue_name, args)
 
 def empty_queue(queue_name, args):
     bus = get_servicebus(args)
@@ -1,25 +1,59 @@
 #! /usr/bin/env python
 
+import time
+# Taken before the other imports so that '--timing' can include them
+SCRIPT_START_TIME = time.time()
 import os
 import sys
 import string
+import collections
+import threading
 import random
 import uuid
 import argparse
+import logging
 import json
+import hashlib
+import io
+import stat
+import tarfile
+import tempfile
 from datetime import datetime
 from datetime import timedelta
-from tabulate import tabulate
 import subprocess
 import os.path
 import shutil
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    # Python 2
+    from pipes import quote as shell_quote
+
+## -----------------
+## DAEMON FORWARDING
+## -----------------
+# Commands are sent to az-daemon.py when it is running, see azdaemonclient.py
+# Commands that ask for confirmation on stdin, or run subprocesses such as
+# 'ssh-keygen' that prompt on or write to the terminal
+DAEMON_LOCAL_COMMANDS = ['create-pool', 'provision', 'delete-pool', 'get-ssh', 'init-directory']
+
+if(__name__ == "__main__"):
+    import azdaemonclient
+    azdaemonclient.forward_to_daemon(start_time=SCRIPT_START_TIME)
+
+from tabulate import tabulate
+from azsdk import sdk_to_dict
 
-from azure.cli.core.application import APPLICATION, Configuration
-from azure.cli.core._session import ACCOUNT, CONFIG, SESSION
-import azure.cli.core.azlogging as azlogging
-from azure.cli.core._environment import get_config_dir
+# Importing and initialising the Azure CLI takes seconds, so it is only done
+# by initialise_azure() for commands that need Azure. The management SDK
+# clients used by the 'sdk' backend are imported by import_azure_sdk().
+APPLICATION = None
 
-logger = azlogging.get_az_logger(__name__)
+# The same logger azlogging.get_az_logger(__name__) returns, so that it is
+# configured along with the Azure CLI loggers once the CLI is initialised.
+# Until then, main() has it print to stderr through the root logger.
+logger = logging.getLogger("az").getChild(__name__)
 
 # Azure account name constants
 AZURE_ACCOUNT_NAME_MIN_LENGTH = 3
@@ -39,6 +73,7 @@ DEFAULT_OS_CONTAINER_NAME = "vhds"
 DEFAULT_DATA_CONTAINER_NAME = "data"
 DEFAULT_SSH_KEY_CONTAINER_NAME = "sshkeys"
 DEFAULT_VM_SECRETS_CONTAINER_NAME = "vmsecrets"
+DEFAULT_DEPLOY_CONTAINER_NAME = "deploy"
 DEFAULT_CONTAINER_SAS_PREFIX = "sas_storage_container"
 DEFAULT_SAS_EXPIRY_DAYS = 14
 DEFAULT_POOL_FILE_PREFIX = "azure_vm_pool"
@@ -51,6 +86,31 @@ SETUP_SCRIPT = "run.sh"
 DEPLOY_SCRIPT = "run.sh"
 TASK_SCRIPT = "run.sh"
 DEFAULT_VM_USER = "vm-admin"
+DEFAULT_PARALLEL_VMS = 1
+DEFAULT_BACKEND = "cli"
+AZURE_STORAGE_ENDPOINT_SUFFIX = "core.windows.net"
+DEFAULT_VNET_ADDRESS_PREFIX = "10.0.0.0/16"
+DEFAULT_SUBNET_ADDRESS_PREFIX = "10.0.0.0/24"
+HTTP_NOT_FOUND = 404
+# Commands that only work with local files and never need to talk to Azure
+LOCAL_COMMANDS = ['init-directory']
+VM_READY_POLL_SECONDS = 10
+VM_READY_TIMEOUT_SECONDS = 1200
+SSH_READY_POLL_SECONDS = 10
+SSH_READY_TIMEOUT_SECONDS = 300
+DEFAULT_SSH_PERSIST_SECONDS = 600
+# Master SSH connection sockets, named by OpenSSH from a hash of the user,
+# host and port to keep the path within the Unix socket path length limit
+SSH_CONTROL_DIRECTORY = os.path.join(os.path.expanduser("~"), ".ssh", "az-vm-pool-control")
+# Written into each directory uploaded to a VM, recording what was uploaded
+DEPLOY_MANIFEST_FILENAME = ".az-vm-pool-manifest.json"
+DEPLOY_DELETED_FILENAME = ".az-vm-pool-deleted"
+VERSION_QUERY_THREADS = 32
+HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_UPLOAD_VIA = "ssh"
+# Read-only SAS for VMs to fetch an uploaded directory from pool storage
+BUNDLE_SAS_EXPIRY_HOURS = 24
+BUNDLE_FETCH_RETRIES = 5
 
 # Set up some exit statuses
 CLEAN_EXIT = 0
@@ -64,12 +124,31 @@ else:
     get_input = input
 
 def main():
-
-    # Parse command line arguments
+    # az-daemon.py calls main() once per command in the same process
+    startup_timings.clear()
+    phase_start = record_timing("Module imports", SCRIPT_START_TIME)
+    args = parse_args()
+    phase_start = record_timing("Argument parsing", phase_start)
+    # Commands that do not initialise the Azure CLI, which replaces this
+    # handler with its own, still need their progress messages printed
+    logging.basicConfig(format="%(message)s")
+
+    if(args.command not in LOCAL_COMMANDS):
+        initialise_azure(args)
+    phase_start = time.time()
+
+    run(args)
+    record_timing("Command '{:s}'".format(args.command), phase_start)
+    if(args.timing):
+        print_timings()
+        print("Reused cached results for {:d} Azure lookups ({:d} lookups made).".format(args.lookups["hits"], args.lookups["misses"]))
+
+def parse_args(argv=None):
+    # Also used by azpool.py to build the arguments for its Pool objects
     parser = argparse.ArgumentParser(description=__name__)
     parser.add_argument('resource_group',
         help='Name of VM pool resource group.')
-    parser.add_argument('command', choices=['list-sizes', 'create-pool', 'delete-pool', 'show-pool', 'setup-pool', 'start-all', 'stop-all', 'deploy-task', 'start-task', 'kill-task', 'refresh-sas', 'get-ssh', 'get-secrets', 'init-directory'])
+    parser.add_argument('command', choices=['list-sizes', 'create-pool', 'provision', 'delete-pool', 'show-pool', 'setup-pool', 'start-all', 'stop-all', 'deploy-task', 'start-task', 'kill-task', 'refresh-sas', 'get-ssh', 'get-secrets', 'init-directory'])
     parser.add_argument('--num-vms', '-n', type=int,
         help='Number of VMs to create in pool.')
     parser.add_argument('--vm-size', '-s',
@@ -99,21 +178,47 @@ def main():
         help="Force creation of resource group is it does not exist. Also requires location option to be set to required Azure region.")
     parser.add_argument("--location", "-l",
         help="Used alongside --force option to create resource group if it does not already exist. Set to required Azure region (e.g. westeurope)")
-
-    args = parser.parse_args()
+    parser.add_argument("--backend", choices=['cli', 'sdk'],
+        default=DEFAULT_BACKEND,
+        help="How to make Azure management calls: through the Azure CLI command parser ('cli'), or directly with the Azure management SDK clients using the Azure CLI login ('sdk'), which avoids the overhead of parsing and loading a CLI command for every call.")
+    parser.add_argument("--timing", action='store_true',
+        help="Print how long each stage of startup (imports, Azure CLI initialisation, login check) and the command itself took, and how many Azure lookups were reused.")
+    parser.add_argument("--parallel", "-p", type=int,
+        default=DEFAULT_PARALLEL_VMS,
+        help="Number of VMs to operate on concurrently. A failure on one VM does not stop the others. With the 'cli' backend, Azure calls are still made one at a time, but 'create-pool' and 'provision' start each VM's creation without waiting for it, so the creations still overlap.")
+    parser.add_argument("--ssh-persist", type=int,
+        default=DEFAULT_SSH_PERSIST_SECONDS,
+        help="Number of seconds to keep the SSH connection to each VM open after it was last used. SSH calls to a VM, from this or later commands, share the open connection rather than each connecting again. Set to 0 to connect again for every call.")
+    parser.add_argument("--redeploy", action='store_true',
+        help="Deploy the task to every VM, killing any running task, even if the VM already has the current version of the task directory. Every file is sent again, replacing any changed on the VM.")
+    parser.add_argument("--upload-via", choices=['ssh', 'storage'],
+        default=DEFAULT_UPLOAD_VIA,
+        help="How the setup and task directories reach the VMs: sent from this machine to each VM over SSH ('ssh'), or uploaded once to the pool storage account and fetched from there by each VM ('storage'), so the upload from this machine does not grow with the size of the pool.")
+
+    args = parser.parse_args(argv)
     # Enforce conditional required arguments
-    if(args.command in ['create-pool'] and args.num_vms == None):
+    if(args.command in ['create-pool', 'provision'] and args.num_vms == None):
         parser.error("Number of VMs required for command '{:s}'. Please provide using '-n' or '--num-vms'".format(args.command))
-    if(args.command in ['create-pool'] and args.vm_size == None):
+    if(args.command in ['create-pool', 'provision'] and args.vm_size == None):
         parser.error("Size of VMs required for command '{:s}'. Please provide using '-s' or '--vm-size'. Available VM sizes in pool region can be listed using the 'list-sizes' command.".format(args.command))
     if(args.command in ['setup-pool'] and args.pool_directory == None):
         parser.error("Pool directory required for command '{:s}'. Please provide the path to a pool folder containing a 'setup' subfolder using '-d' or '--pool-directory'".format(args.command))
-    if(args.command in ['start-task'] and args.pool_directory == None):
+    if(args.command in ['provision'] and args.pool_directory == None):
+        parser.error("Pool directory required for command '{:s}'. Please provide the path to a pool folder containing 'setup' and 'task' subfolders using '-d' or '--pool-directory'".format(args.command))
+    if(args.command in ['start-task', 'deploy-task'] and args.pool_directory == None):
         parser.error("Pool directory required for command '{:s}'. Please provide the path to a pool folder containing a 'task' subfolder using '-d' or '--pool-directory'".format(args.command))
     if(args.command in ['init-directory'] and args.pool_directory == None):
         parser.error("Pool directory required for command '{:s}'. Please provide the path to a pool folder using '-d' or '--pool-directory'".format(args.command))
     if(args.command not in ['create-pool', 'setup-pool', 'start-all', 'stop-all'] and args.no_wait):
         parser.error("'--no-wait' not supported for command '{:s}'".format(args.command))
+    if(args.parallel < 1):
+        parser.error("'--parallel' must be at least 1")
+    if(args.ssh_persist < 0):
+        parser.error("'--ssh-persist' must not be negative")
+    if(args.command not in ['deploy-task'] and args.redeploy):
+        parser.error("'--redeploy' not supported for command '{:s}'".format(args.command))
+    if(args.command not in ['provision', 'setup-pool', 'deploy-task'] and args.upload_via != DEFAULT_UPLOAD_VIA):
+        parser.error("'--upload-via' not supported for command '{:s}'".format(args.command))
 
 
 
@@ -124,6 +229,7 @@ def main():
     args.data_container_name = DEFAULT_DATA_CONTAINER_NAME
     args.ssh_key_container_name = DEFAULT_SSH_KEY_CONTAINER_NAME
     args.vm_secrets_container_name = DEFAULT_VM_SECRETS_CONTAINER_NAME
+    args.deploy_container_name = DEFAULT_DEPLOY_CONTAINER_NAME
     args.container_sas_prefix = DEFAULT_CONTAINER_SAS_PREFIX
     args.pool_file_prefix = DEFAULT_POOL_FILE_PREFIX
     args.setup_directory = SETUP_DIRECTORY
@@ -135,45 +241,22 @@ def main():
     args.vm_user = DEFAULT_VM_USER
     args.storage_redundancy = DEFAULT_STORAGE_REDUNDANCY
     args.storage_account_type = DEFAULT_STORAGE_ACCOUNT_TYPE
-
-    azlogging.configure_logging("")
-
-    # We use the Azure CLI 2.0 APPLICATION object to let us call functionality
-    # in exactly the same manner as calling the 'az' app from the terminal. We
-    # just pass an array of arguments to APPLICATION.execute(), get the output
-    # from the 'result' field and assign it to a variable for further processing
-    # e.g. apps = APPLICATION.execute(['ad', app', 'list']).result
-
-    # Set up various configuration variables.
-    # NOTE: Even though credential caching is not explicitly set up here, and
-    # cached credentials are stored in 'accessTokens.json' rather than
-    # 'azureProfile.json', ACCOUNT.load(os.path.join(azure_folder,
-    # 'azureProfile.json')) is required for credential caching to work.
-    azure_dir = get_config_dir()
-    ensure_exists(azure_dir)
-    ACCOUNT.load(os.path.join(azure_dir, 'azureProfile.json'))
-
-    # Configure APPLICATION
-    APPLICATION.initialize(Configuration())
-
-    # Check if user has already authenticated. If not, get user to interactively authenticate
-    if not(is_authenticated()):
-        login()
-
-    # We will use the default subscription for everything. To change the
-    # default subscription, use set_default_subscription(name_or_id). This
-    # changes the default subscription for this session only.
-    # TODO: Take subscription as a commandline argument
-    subscription = get_default_subscription()
-    logger.warning("Using default subscription ({0} / {1})".format(subscription["name"], subscription["id"]))
-    args.subscription = subscription
-
+    args.inventory = None
+    args.local_manifests = {}
+    args.uploaded_bundles = {}
+    # Lookups only hold for a single command
+    args.lookups = new_lookup_cache()
+    return args
+
+def run(args):
     if(args.command == 'show-pool'):
         show_pool(args)
     elif(args.command == 'list-sizes'):
         list_sizes(args)
     elif(args.command == 'create-pool'):
         create_pool(args)
+    elif(args.command == 'provision'):
+        provision_pool(args)
     elif(args.command == 'setup-pool'):
         setup_pool(args)
     elif(args.command == 'start-all'):
@@ -202,22 +285,345 @@ def main():
 ## --------------------------------
 ## AUTHENTICATION / LOGIN / ACCOUNT
 ## --------------------------------
-def is_authenticated():
+def initialise_azure(args):
+    global APPLICATION
+    if(args.backend == 'sdk' and not(import_azure_sdk())):
+        sys.exit("The 'sdk' backend requires the Azure management SDK packages (azure-mgmt-compute, azure-mgmt-network, azure-mgmt-resource, azure-mgmt-storage).")
+    phase_start = time.time()
+    # Skipped if already done by an earlier command run by az-daemon.py
+    if(APPLICATION is None):
+        from azure.cli.core.application import APPLICATION, Configuration
+        from azure.cli.core._session import ACCOUNT
+        import azure.cli.core.azlogging as azlogging
+        from azure.cli.core._environment import get_config_dir
+        phase_start = record_timing("Azure CLI import", phase_start)
+
+        azlogging.configure_logging("")
+
+        # We use the Azure CLI 2.0 APPLICATION object to let us call functionality
+        # in exactly the same manner as calling the 'az' app from the terminal. We
+        # just pass an array of arguments to APPLICATION.execute(), get the output
+        # from the 'result' field and assign it to a variable for further processing
+        # e.g. apps = APPLICATION.execute(['ad', app', 'list']).result
+
+        # Set up various configuration variables.
+        # NOTE: Even though credential caching is not explicitly set up here, and
+        # cached credentials are stored in 'accessTokens.json' rather than
+        # 'azureProfile.json', ACCOUNT.load(os.path.join(azure_folder,
+        # 'azureProfile.json')) is required for credential caching to work.
+        azure_dir = get_config_dir()
+        ensure_exists(azure_dir)
+        ACCOUNT.load(os.path.join(azure_dir, 'azureProfile.json'))
+
+        # Configure APPLICATION
+        APPLICATION.initialize(Configuration())
+        phase_start = record_timing("Azure CLI initialisation", phase_start)
+
+    # Check if user has already authenticated. If not, get user to interactively authenticate
+    if not(is_authenticated()):
+        login()
+
+    # We will use the default subscription for everything. To change the
+    # default subscription, use set_default_subscription(name_or_id). This
+    # changes the default subscription for this session only.
+    # TODO: Take subscription as a commandline argument
+    subscription = get_default_subscription()
+    logger.warning("Using default subscription ({0} / {1})".format(subscription["name"], subscription["id"]))
+    args.subscription = subscription
+    record_timing("Login check and subscription lookup", phase_start)
+
+def import_azure_sdk():
+    # Returns False if the management SDK packages are not installed
+    global Profile, ComputeManagementClient, NetworkManagementClient, ResourceManagementClient, StorageManagementClient
+    global BlockBlobService, BlobPermissions, ContainerPermissions, CloudError
+    phase_start = time.time()
+    try:
+        from azure.cli.core._profile import Profile
+        from azure.mgmt.compute import ComputeManagementClient
+        from azure.mgmt.network import NetworkManagementClient
+        from azure.mgmt.resource import ResourceManagementClient
+        from azure.mgmt.storage import StorageManagementClient
+        from azure.storage.blob import BlockBlobService, BlobPermissions, ContainerPermissions
+        from msrestazure.azure_exceptions import CloudError
+    except ImportError:
+        return False
+    record_timing("Azure SDK import", phase_start)
+    return True
+
+# The Azure CLI APPLICATION rebuilds its parser and session on every call, so
+# calls from the VM worker threads are made one at a time. Only the SSH work
+# and '--backend sdk' calls run concurrently.
+cli_lock = threading.Lock()
+
+def cli_execute(command_list):
+    with cli_lock:
+        return APPLICATION.execute(command_list).result
+
+def get_subscriptions():
     # Get subscriptions. This returns an empty list if user is not authenticated.
-    subscriptions = APPLICATION.execute(['account','list']).result
+    return cached_lookup("subscriptions", lambda: cli_execute(['account', 'list']), subscription_lookups)
+
+def is_authenticated():
+    subscriptions = get_subscriptions()
     if not(subscriptions):
         return False
     else:
         return True
 
 def login():
-    APPLICATION.execute(['login'])
+    cli_execute(['login'])
+    invalidate_lookup("subscriptions", subscription_lookups)
 
 def get_default_subscription():
-    subscriptions = APPLICATION.execute(['account', 'list']).result
+    subscriptions = get_subscriptions()
     default_subscription = [s for s in subscriptions if s['isDefault']][0]
     return default_subscription
 
+## ------
+## TIMING
+## ------
+startup_timings = collections.OrderedDict()
+
+def record_timing(phase, phase_start):
+    # Records the time since phase_start against phase and returns the time
+    # now, to use as the start of the next phase
+    now = time.time()
+    startup_timings[phase] = startup_timings.get(phase, 0.0) + now - phase_start
+    return now
+
+def print_timings():
+    rows = [[phase, "{:.3f}".format(seconds)] for (phase, seconds) in startup_timings.items()]
+    rows.append(["Total", "{:.3f}".format(time.time() - SCRIPT_START_TIME)])
+    print(tabulate(rows, headers=["Stage", "Seconds"], tablefmt="fancy_grid"))
+
+## --------------
+## CACHED LOOKUPS
+## --------------
+# Some lookups are repeated many times within a single command, e.g. the
+# resource group location for every resource created or the storage account
+# connection string for every blob operation. Their results only change when
+# this script changes the underlying resources, so each lookup is made once
+# per command and reused. Functions that change those resources must call
+# invalidate_lookup() for the lookups they affect.
+#
+# Each command's lookups are kept in its 'args.lookups', so commands run by
+# az-daemon.py or azpool.py objects for different pools never see each
+# other's results. Only the subscription list, which comes from the Azure CLI
+# login shared by the whole process, is kept between commands.
+def new_lookup_cache():
+    return {"values": {}, "locks": {}, "lock": threading.Lock(), "hits": 0, "misses": 0}
+
+subscription_lookups = new_lookup_cache()
+
+def cached_lookup(key, lookup, cache):
+    # Concurrent callers of the same lookup wait for a single call to finish
+    # rather than each making it
+    with cache["lock"]:
+        key_lock = cache["locks"].setdefault(key, threading.Lock())
+    with key_lock:
+        with cache["lock"]:
+            if(key in cache["values"]):
+                cache["hits"] = cache["hits"] + 1
+                return cache["values"][key]
+        value = lookup()
+        with cache["lock"]:
+            cache["misses"] = cache["misses"] + 1
+            cache["values"][key] = value
+        return value
+
+def invalidate_lookup(key, cache):
+    with cache["lock"]:
+        cache["values"].pop(key, None)
+
+## -----------
+## SDK BACKEND
+## -----------
+# With '--backend=sdk', the helper functions below call the Azure management
+# SDK clients directly instead of going through APPLICATION.execute(), which
+# parses a command line, loads the command module and serialises the result
+# to JSON for every call. Results are converted to the same dictionaries the
+# CLI returns, so callers do not need to know which backend is in use.
+sdk_clients = {}
+sdk_clients_lock = threading.Lock()
+
+def sdk_client(client_class, args):
+    # Each client is created once per subscription, on first use, and shared
+    # by all threads. All clients use the credentials of the Azure CLI login,
+    # and each keeps a pool of keep-alive HTTP connections.
+    key = (client_class, args.subscription["id"])
+    with sdk_clients_lock:
+        if(key not in sdk_clients):
+            credentials, subscription_id, tenant_id = Profile().get_login_credentials(subscription_id=args.subscription["id"])
+            sdk_clients[key] = client_class(credentials, subscription_id)
+        return sdk_clients[key]
+
+def sdk_blob_service(args):
+    connection_string = pool_storage_account_connection_string(args)
+    # Keyed on the connection string as az-daemon.py can run commands for
+    # more than one pool
+    key = (BlockBlobService, connection_string)
+    with sdk_clients_lock:
+        if(key not in sdk_clients):
+            sdk_clients[key] = BlockBlobService(connection_string=connection_string)
+        return sdk_clients[key]
+
+def sdk_not_found(error):
+    return isinstance(error, CloudError) and error.status_code == HTTP_NOT_FOUND
+
+def sdk_get_resource_group(args):
+    resource_client = sdk_client(ResourceManagementClient, args)
+    try:
+        return sdk_to_dict(resource_client.resource_groups.get(args.resource_group))
+    except CloudError as e:
+        if(sdk_not_found(e)):
+            return None
+        raise
+
+def sdk_create_resource_group(args):
+    resource_client = sdk_client(ResourceManagementClient, args)
+    return sdk_to_dict(resource_client.resource_groups.create_or_update(args.resource_group, {"location": args.location}))
+
+def sdk_vm_dict(vm):
+    # Adds the power state that 'vm list --show-details' reports
+    vm_dict = sdk_to_dict(vm)
+    statuses = vm.instance_view.statuses if vm.instance_view else []
+    power_states = [status.display_status for status in statuses if status.code.startswith("PowerState/")]
+    vm_dict["powerState"] = power_states[0] if power_states else None
+    return vm_dict
+
+def sdk_get_vm(vm_name, args):
+    compute_client = sdk_client(ComputeManagementClient, args)
+    try:
+        return sdk_vm_dict(compute_client.virtual_machines.get(args.resource_group, vm_name, expand="instanceView"))
+    except CloudError as e:
+        if(sdk_not_found(e)):
+            return None
+        raise
+
+def sdk_list_vms(args):
+    # One call for the VMs in the resource group, along with their power
+    # states, rather than a call for each VM
+    compute_client = sdk_client(ComputeManagementClient, args)
+    try:
+        vms = list(compute_client.virtual_machines.list(args.resource_group, expand="instanceView"))
+    except TypeError:
+        # Older SDK versions cannot expand the instance view of listed VMs
+        vms = list(compute_client.virtual_machines.list(args.resource_group))
+    for vm in vms:
+        if(getattr(vm, "instance_view", None) is None):
+            # Only asked for the VMs whose instance view was left out
+            vm.instance_view = compute_client.virtual_machines.instance_view(args.resource_group, vm.name)
+    return [sdk_vm_dict(vm) for vm in vms]
+
+def sdk_list_vm_sizes(location, args):
+    compute_client = sdk_client(ComputeManagementClient, args)
+    return [sdk_to_dict(size) for size in compute_client.virtual_machine_sizes.list(location)]
+
+def sdk_create_virtual_network(vnet_name, subnet_name, args):
+    network_client = sdk_client(NetworkManagementClient, args)
+    parameters = {
+        "location": get_resource_group_location(args),
+        "address_space": {"address_prefixes": [DEFAULT_VNET_ADDRESS_PREFIX]},
+        "subnets": [{"name": subnet_name, "address_prefix": DEFAULT_SUBNET_ADDRESS_PREFIX}]
+    }
+    return sdk_to_dict(network_client.virtual_networks.create_or_update(args.resource_group, vnet_name, parameters).result())
+
+def sdk_create_storage_account(storage_account_name, args):
+    storage_client = sdk_client(StorageManagementClient, args)
+    parameters = {
+        "location": get_resource_group_location(args),
+        "sku": {"name": args.storage_redundancy},
+        "kind": args.storage_account_type
+    }
+    return sdk_to_dict(storage_client.storage_accounts.create(args.resource_group, storage_account_name, parameters).result())
+
+def sdk_storage_account_connection_string(storage_account_name, args):
+    storage_client = sdk_client(StorageManagementClient, args)
+    keys = storage_client.storage_accounts.list_keys(args.resource_group, storage_account_name).keys
+    connection_string = "DefaultEndpointsProtocol=https;EndpointSuffix={:s};AccountName={:s};AccountKey={:s}".format(AZURE_STORAGE_ENDPOINT_SUFFIX, storage_account_name, keys[0].value)
+    return {"connectionString": connection_string}
+
+def sdk_create_public_ip(ip_name, args):
+    network_client = sdk_client(NetworkManagementClient, args)
+    parameters = {
+        "location": get_resource_group_location(args),
+        "public_ip_allocation_method": "Dynamic",
+        "dns_settings": {"domain_name_label": ip_name}
+    }
+    return sdk_to_dict(network_client.public_ip_addresses.create_or_update(args.resource_group, ip_name, parameters).result())
+
+def sdk_create_nic(nic_name, vnet_name, subnet_name, public_ip_name, args):
+    network_client = sdk_client(NetworkManagementClient, args)
+    subnet = network_client.subnets.get(args.resource_group, vnet_name, subnet_name)
+    public_ip = network_client.public_ip_addresses.get(args.resource_group, public_ip_name)
+    parameters = {
+        "location": get_resource_group_location(args),
+        "ip_configurations": [{
+            "name": "ipconfig1",
+            "subnet": {"id": subnet.id},
+            "public_ip_address": {"id": public_ip.id}
+        }]
+    }
+    return sdk_to_dict(network_client.network_interfaces.create_or_update(args.resource_group, nic_name, parameters).result())
+
+def sdk_list_network_resources(resource_type, args):
+    network_client = sdk_client(NetworkManagementClient, args)
+    if(resource_type == "public-ip"):
+        resources = network_client.public_ip_addresses.list(args.resource_group)
+    else:
+        resources = network_client.network_interfaces.list(args.resource_group)
+    return [sdk_to_dict(resource) for resource in resources]
+
+def sdk_delete_network_resource(resource_type, name, args):
+    network_client = sdk_client(NetworkManagementClient, args)
+    if(resource_type == "public-ip"):
+        network_client.public_ip_addresses.delete(args.resource_group, name).result()
+    else:
+        network_client.network_interfaces.delete(args.resource_group, name).result()
+
+def sdk_create_vm(vm_name, nic_name, os_disk_name, args):
+    compute_client = sdk_client(ComputeManagementClient, args)
+    network_client = sdk_client(NetworkManagementClient, args)
+    publisher, offer, sku, version = args.vm_image.split(":")
+    nic = network_client.network_interfaces.get(args.resource_group, nic_name)
+    os_disk_uri = "https://{:s}.blob.{:s}/{:s}/{:s}".format(args.resource_group, AZURE_STORAGE_ENDPOINT_SUFFIX, pool_os_container_name(args), vm_os_disk_blob_name(vm_name, args))
+    parameters = {
+        "location": get_resource_group_location(args),
+        "hardware_profile": {"vm_size": args.vm_size},
+        "storage_profile": {
+            "image_reference": {"publisher": publisher, "offer": offer, "sku": sku, "version": version},
+            "os_disk": {"name": os_disk_name, "caching": "ReadWrite", "create_option": "FromImage", "vhd": {"uri": os_disk_uri}}
+        },
+        "os_profile": {
+            "computer_name": vm_name,
+            "admin_username": args.vm_user,
+            "linux_configuration": {
+                "disable_password_authentication": True,
+                "ssh": {"public_keys": [{"path": "/home/{:s}/.ssh/authorized_keys".format(args.vm_user), "key_data": get_ssh_public_key(args)}]}
+            }
+        },
+        "network_profile": {"network_interfaces": [{"id": nic.id}]}
+    }
+    poller = compute_client.virtual_machines.create_or_update(args.resource_group, vm_name, parameters)
+    if(args.no_wait):
+        return None
+    return sdk_to_dict(poller.result())
+
+def sdk_vm_operation(operation, vm_name, args):
+    # Runs a long-running VM operation ('start', 'deallocate' or 'delete'),
+    # waiting for it to finish unless '--no-wait' is set
+    compute_client = sdk_client(ComputeManagementClient, args)
+    poller = getattr(compute_client.virtual_machines, operation)(args.resource_group, vm_name)
+    if(not(args.no_wait)):
+        poller.result()
+
+def sdk_container_sas(container_name, expiry_datetime, args):
+    permissions = ContainerPermissions(read=True, write=True, delete=True, list=True)
+    return sdk_blob_service(args).generate_container_shared_access_signature(container_name, permission=permissions, expiry=expiry_datetime, protocol="https")
+
+def sdk_blob_read_sas(container_name, blob_name, expiry_datetime, args):
+    return sdk_blob_service(args).generate_blob_shared_access_signature(container_name, blob_name, permission=BlobPermissions.READ, expiry=expiry_datetime, protocol="https")
+
 ## ----------------
 ## HELPER FUNCTIONS
 ## ----------------
@@ -229,7 +635,10 @@ def resource_group_exists(args):
     commands = ["group", "show"]
     options = [name_opt]
     command_list = commands + options
-    result = APPLICATION.execute(command_list).result
+    if(args.backend == 'sdk'):
+        result = cached_lookup("resource-group", lambda: sdk_get_resource_group(args), args.lookups)
+    else:
+        result = cached_lookup("resource-group", lambda: cli_execute(command_list), args.lookups)
     return(result is not None)
 
 def create_resource_group(args):
@@ -238,7 +647,11 @@ def create_resource_group(args):
     commands = ["group", "create"]
     options = [name_opt, location_opt]
     command_list = commands + options
-    result = APPLICATION.execute(command_list).result
+    if(args.backend == 'sdk'):
+        result = sdk_create_resource_group(args)
+    else:
+        result = cli_execute(command_list)
+    invalidate_lookup("resource-group", args.lookups)
     return(result)
 
 def print_vm_list(vm_list_json, args):
@@ -292,7 +705,10 @@ def vm_image_string(image_json):
 
 def get_vms(args):
     power_state_opt = "--show-details"
-    vms = vm_pool_command(["vm", "list"], [power_state_opt], args)
+    if(args.backend == 'sdk'):
+        vms = cached_lookup("vms", lambda: sdk_list_vms(args), args.lookups)
+    else:
+        vms = cached_lookup("vms", lambda: vm_pool_command(["vm", "list"], [power_state_opt], args), args.lookups)
     #vms = APPLICATION.execute(["vm", "list", power_state_opt]).result
     return(vms)
 
@@ -303,7 +719,7 @@ def vm_pool_command(command_list, option_list, args):
     resource_group_opt = "--resource-group={0}".format(args.resource_group)
     option_list.append(resource_group_opt)
     command_list = command_list + option_list
-    return APPLICATION.execute(command_list).result
+    return cli_execute(command_list)
 
 def timedelta_string(time_delta):
     total_seconds = (time_delta.days * 24 * 3600) + time_delta.seconds
@@ -311,6 +727,57 @@ def timedelta_string(time_delta):
     minutes, seconds = divmod(remainder, 60)
     return "{:02d}h{:02d}m{:02d}s".format(hours, minutes, seconds)
 
+def run_vm_operation(operation, item, vm_name, description, args):
+    # Runs operation(item, args) for a single VM, recording its timing and
+    # catching any failure so that it only affects this VM. SystemExit is
+    # caught too, as the Azure CLI exits on some errors. Operations return an
+    # ordered mapping of the steps they ran to whether each step succeeded.
+    start_time = datetime.now()
+    error = None
+    steps = collections.OrderedDict()
+    try:
+        steps = operation(item, args)
+    except (Exception, SystemExit) as e:
+        error = str(e) or e.__class__.__name__
+        logger.warning("{:%Hh%Mm%Ss}: {:s} failed for VM '{:s}': {:s}".format(datetime.now(), description, vm_name, error))
+    success = error is None and all(steps.values())
+    return {"name": vm_name, "start": start_time, "end": datetime.now(), "steps": steps, "success": success, "error": error}
+
+def run_vm_operations(operation, items, vm_names, description, args):
+    # Runs operation(item, args) for each VM on up to '--parallel' worker
+    # threads. Returns one result per VM, in the order given.
+    num_workers = max(1, min(args.parallel, len(items)))
+    pool = ThreadPool(num_workers)
+    try:
+        return pool.map(lambda job: run_vm_operation(operation, job[0], job[1], description, args), list(zip(items, vm_names)))
+    finally:
+        pool.close()
+        pool.join()
+
+def print_vm_results_table(results, args):
+    # One row per VM, with a success/failure column for each step that was
+    # run on any VM. Steps a VM did not reach are shown as '-'.
+    step_names = []
+    for result in results:
+        step_names = step_names + [step for step in result["steps"] if step not in step_names]
+    headers = ["Name", "Result"] + step_names + ["Started", "Finished", "Duration", "Error"]
+    rows = [[
+        result["name"],
+        "OK" if result["success"] else "FAILED"
+        ] + [
+        "-" if step not in result["steps"] else ("ok" if result["steps"][step] else "FAILED")
+            for step in step_names
+        ] + [
+        "{:%Hh%Mm%Ss}".format(result["start"]),
+        "{:%Hh%Mm%Ss}".format(result["end"]),
+        timedelta_string(result["end"] - result["start"]),
+        result["error"] or ""
+        ] for result in results]
+    print(tabulate(rows, headers=headers, tablefmt="fancy_grid"))
+
+def num_failed(results):
+    return len([result for result in results if not(result["success"])])
+
 def number_from_name(vm_name):
     stem, number = vm_name.split("-")
     return int(number)
@@ -361,7 +828,10 @@ def gen_ssh_keys(args):
 
 def get_resource_group_location(args):
     resource_group_opt = "--name={0}".format(args.resource_group)
-    resource_group = APPLICATION.execute(["group", "show", resource_group_opt]).result
+    if(args.backend == 'sdk'):
+        resource_group = cached_lookup("resource-group", lambda: sdk_get_resource_group(args), args.lookups)
+    else:
+        resource_group = cached_lookup("resource-group", lambda: cli_execute(["group", "show", resource_group_opt]), args.lookups)
     return(resource_group["location"])
 
 def create_virtual_network(args):
@@ -372,6 +842,8 @@ def create_virtual_network(args):
     subnet_opt = "--subnet-name={0}".format(subnet_name)
     commands = ["network", "vnet", "create"]
     options = [name_opt, location_opt, subnet_opt]
+    if(args.backend == 'sdk'):
+        return sdk_create_virtual_network(vnet_name, subnet_name, args)
     result = vm_pool_command(commands, options, args)
     return(result)
 
@@ -383,18 +855,12 @@ def create_storage_account(args):
     account_type_opt = "--kind={0}".format(args.storage_account_type)
     commands = ["storage", "account", "create"]
     options = [name_opt, location_opt, account_type_opt, redundancy_opt]
-    result = vm_pool_command(commands, options, args)
-    return(result)
-
-def public_ip_exists(ip_name, args):
-    name_opt = "--name={0}".format(ip_name)
-    commands = ["network", "public-ip", "show"]
-    options = [name_opt]
-    result = vm_pool_command(commands, options, args)
-    if(result == None):
-        return False
+    if(args.backend == 'sdk'):
+        result = sdk_create_storage_account(storage_account_name, args)
     else:
-        return True
+        result = vm_pool_command(commands, options, args)
+    invalidate_lookup("storage-connection-string", args.lookups)
+    return(result)
 
 def create_public_ip(ip_name, args):
     name_opt = "--name={0}".format(ip_name)
@@ -402,6 +868,8 @@ def create_public_ip(ip_name, args):
     dns_name_opt = "--dns-name={0}".format(ip_name)
     commands = ["network", "public-ip", "create"]
     options = [name_opt, location_opt, dns_name_opt]
+    if(args.backend == 'sdk'):
+        return sdk_create_public_ip(ip_name, args)
     result = vm_pool_command(commands, options, args)
     return(result)
 
@@ -409,19 +877,11 @@ def delete_public_ip(ip_name, args):
     name_opt = "--name={0}".format(ip_name)
     commands = ["network", "public-ip", "delete"]
     options = [name_opt]
+    if(args.backend == 'sdk'):
+        return sdk_delete_network_resource("public-ip", ip_name, args)
     result = vm_pool_command(commands, options, args)
     return(result)
 
-def nic_exists(nic_name, args):
-    name_opt = "--name={0}".format(nic_name)
-    commands = ["network", "nic", "show"]
-    options = [name_opt]
-    result = vm_pool_command(commands, options, args)
-    if(result == None):
-        return False
-    else:
-        return True
-
 def create_nic(nic_name, args):
     vnet_name = args.resource_group
     subnet_name = vnet_name
@@ -433,6 +893,8 @@ def create_nic(nic_name, args):
     public_ip_opt = "--public-ip-address={0}".format(public_ip_name)
     commands = ["network", "nic", "create"]
     options = [name_opt, location_opt, vnet_name_opt, subnet_opt, public_ip_opt]
+    if(args.backend == 'sdk'):
+        return sdk_create_nic(nic_name, vnet_name, subnet_name, public_ip_name, args)
     result = vm_pool_command(commands, options, args)
     return(result)
 
@@ -440,34 +902,78 @@ def delete_nic(nic_name, args):
     name_opt = "--name={0}".format(nic_name)
     commands = ["network", "nic", "delete"]
     options = [name_opt]
+    if(args.backend == 'sdk'):
+        return sdk_delete_network_resource("nic", nic_name, args)
     result = vm_pool_command(commands, options, args)
     return(result)
 
-def vm_os_disk_blob_exists(vm_name, args):
-    blob_name = vm_os_disk_name(vm_name, args)
-    container_name = pool_os_container_name(args)
-    connection_string = pool_storage_account_connection_string(args)
-    name_opt = "--name={0}".format(blob_name)
-    container_name_opt = "--container-name={0}".format(container_name)
-    connection_string_opt = "--connection-string={0}".format(connection_string)
-    commands = ["storage", "blob", "exists"]
-    options = [name_opt, container_name_opt, connection_string_opt]
-    return APPLICATION.execute(commands + options).result["exists"]
-
 def delete_vm_os_disk_blob(vm_name, args):
-    blob_name = vm_os_disk_name(vm_name, args)
+    blob_name = vm_os_disk_blob_name(vm_name, args)
     container_name = pool_os_container_name(args)
     connection_string = pool_storage_account_connection_string(args)
-    name_opt = "--name={0}.vhd".format(blob_name)
+    name_opt = "--name={0}".format(blob_name)
     container_name_opt = "--container-name={0}".format(container_name)
     connection_string_opt = "--connection-string={0}".format(connection_string)
     commands = ["storage", "blob", "delete"]
     options = [name_opt, container_name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        sdk_blob_service(args).delete_blob(container_name, blob_name)
+        return
+    result = cli_execute(commands + options)
 
 def vm_os_disk_name(vm_name, args):
     return "{0}_os_disk".format(vm_name)
 
+def vm_os_disk_blob_name(vm_name, args):
+    # Unmanaged OS disks are stored as '<os-disk-name>.vhd'
+    return "{0}.vhd".format(vm_os_disk_name(vm_name, args))
+
+def list_network_resources(resource_type, args):
+    # resource_type is 'public-ip' or 'nic'
+    if(args.backend == 'sdk'):
+        return sdk_list_network_resources(resource_type, args)
+    return vm_pool_command(["network", resource_type, "list"], [], args)
+
+def index_by_name(resources):
+    return dict((resource["name"], resource) for resource in (resources or []))
+
+def list_pool_os_disk_blobs(args):
+    container_name = pool_os_container_name(args)
+    if(not(pool_container_exists(container_name, args))):
+        return []
+    return list_blobs(container_name, args)
+
+def get_pool_inventory(args):
+    # Lists each kind of per-VM pool resource once and indexes it by name, so
+    # that deciding what to create or delete for each VM is a dictionary
+    # lookup rather than a round trip per resource. The inventory is a
+    # snapshot: each VM only creates or deletes its own resources, so it stays
+    # valid for the per-VM decisions made during a command.
+    logger.warning("{:%Hh%Mm%Ss}: Taking inventory of pool resources.".format(datetime.now()))
+    return {
+        "vms": index_by_name(get_vms(args)),
+        "public_ips": index_by_name(list_network_resources("public-ip", args)),
+        "nics": index_by_name(list_network_resources("nic", args)),
+        "os_disk_blobs": index_by_name(list_pool_os_disk_blobs(args))
+    }
+
+def print_pool_resources_table(inventory, args):
+    # One row for each VM name that has any pool resource, which also shows
+    # up public IPs, NICs and OS disks left behind by deleted VMs
+    disk_suffix = vm_os_disk_blob_name("", args)
+    names = set(inventory["vms"]) | set(inventory["public_ips"]) | set(inventory["nics"])
+    names = names | set(name[:-len(disk_suffix)] for name in inventory["os_disk_blobs"] if name.endswith(disk_suffix))
+    print("Pool resources in Resource Group '{0}':".format(args.resource_group))
+    headers = ["Name", "VM", "Public IP", "NIC", "OS disk"]
+    rows = [[
+        name,
+        inventory["vms"][name]["powerState"] if name in inventory["vms"] else "-",
+        (inventory["public_ips"][name].get("ipAddress") or "unassigned") if name in inventory["public_ips"] else "-",
+        "yes" if name in inventory["nics"] else "-",
+        "yes" if vm_os_disk_blob_name(name, args) in inventory["os_disk_blobs"] else "-"
+        ] for name in sorted(names)]
+    print(tabulate(rows, headers=headers, tablefmt="fancy_grid"))
+
 def pool_os_container_name(args, with_extension = False):
     return "{:s}".format(args.os_container_name)
 
@@ -480,6 +986,9 @@ def pool_ssh_key_container_name(args):
 def pool_vm_secrets_container_name(args):
     return "{:s}".format(args.vm_secrets_container_name)
 
+def pool_deploy_container_name(args):
+    return "{:s}".format(args.deploy_container_name)
+
 def create_pool_data_container(args):
     container_name = pool_data_container_name(args)
     create_pool_container(container_name, args)
@@ -499,7 +1008,9 @@ def create_pool_container(container_name, args):
     connection_string_opt = "--connection-string={0}".format(connection_string)
     commands = ["storage", "container", "create"]
     options = [container_name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        return {"created": sdk_blob_service(args).create_container(container_name)}
+    result = cli_execute(commands + options)
     return(result)
 
 def pool_container_exists(container_name, args):
@@ -509,7 +1020,9 @@ def pool_container_exists(container_name, args):
     connection_string_opt = "--connection-string={0}".format(connection_string)
     commands = ["storage", "container", "exists"]
     options = [container_name_opt, connection_string_opt]
-    exists = APPLICATION.execute(commands + options).result["exists"]
+    if(args.backend == 'sdk'):
+        return sdk_blob_service(args).exists(container_name)
+    exists = cli_execute(commands + options)["exists"]
     return(exists)
 
 def delete_pool_os_container(args):
@@ -521,7 +1034,10 @@ def delete_pool_os_container(args):
     connection_string_opt = "--connection-string={0}".format(connection_string)
     commands = ["storage", "container", "delete"]
     options = [container_name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        sdk_blob_service(args).delete_container(storage_container_name)
+        return
+    result = cli_execute(commands + options)
 
 def container_sas_filename(container_name, args):
     return "{:s}_{:s}_{:s}_{:s}.txt".format(args.pool_file_prefix, args.resource_group, args.container_sas_prefix, container_name)
@@ -531,7 +1047,9 @@ def pool_storage_account_connection_string(args):
     account_name_opt = "--name={0}".format(storage_account_name)
     commands = ["storage", "account", "show-connection-string"]
     options = [account_name_opt]
-    return vm_pool_command(commands, options, args)["connectionString"]
+    if(args.backend == 'sdk'):
+        return cached_lookup("storage-connection-string", lambda: sdk_storage_account_connection_string(storage_account_name, args), args.lookups)["connectionString"]
+    return cached_lookup("storage-connection-string", lambda: vm_pool_command(commands, options, args), args.lookups)["connectionString"]
 
 def pool_data_container_sas(args):
     container_name = pool_data_container_name(args)
@@ -544,7 +1062,10 @@ def pool_data_container_sas(args):
     expiry_opt = "--expiry={:%Y-%m-%dT%H:%MZ}".format(expiry_datetime)
     commands = ["storage", "container", "generate-sas"]
     options = [name_opt, connection_string_opt, permissions_opt, https_opt, expiry_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        result = sdk_container_sas(container_name, expiry_datetime, args)
+    else:
+        result = cli_execute(commands + options)
     ensure_exists(args.vm_secrets_directory)
     file_name = container_sas_filename(container_name, args)
     file_path = os.path.join(args.vm_secrets_directory, file_name)
@@ -554,6 +1075,25 @@ def pool_data_container_sas(args):
     upload_secret(file_path, file_name, args)
     return result
 
+def blob_read_url(container_name, blob_name, args):
+    # URL with a short-lived read-only SAS, for fetching the blob without
+    # any other credentials
+    connection_string = pool_storage_account_connection_string(args)
+    container_name_opt = "--container-name={0}".format(container_name)
+    name_opt = "--name={0}".format(blob_name)
+    connection_string_opt = "--connection-string={0}".format(connection_string)
+    permissions_opt = "--permissions=r"
+    https_opt = "--https-only"
+    expiry_datetime = datetime.utcnow() + timedelta(hours = BUNDLE_SAS_EXPIRY_HOURS)
+    expiry_opt = "--expiry={:%Y-%m-%dT%H:%MZ}".format(expiry_datetime)
+    commands = ["storage", "blob", "generate-sas"]
+    options = [container_name_opt, name_opt, connection_string_opt, permissions_opt, https_opt, expiry_opt]
+    if(args.backend == 'sdk'):
+        sas_token = sdk_blob_read_sas(container_name, blob_name, expiry_datetime, args)
+    else:
+        sas_token = cli_execute(commands + options)
+    return "https://{:s}.blob.{:s}/{:s}/{:s}?{:s}".format(args.resource_group, AZURE_STORAGE_ENDPOINT_SUFFIX, container_name, blob_name, sas_token)
+
 def upload_secret(file_path, blob_name, args):
     container_name = pool_vm_secrets_container_name(args)
     upload_blob(container_name, file_path, blob_name, args)
@@ -562,16 +1102,46 @@ def upload_secret(file_path, blob_name, args):
 def vm_url(vm, args):
     return("{:s}.{:s}.cloudapp.azure.com".format(vm["name"], vm["location"]))
 
+def vm_host(vm, args):
+    return("{:s}@{:s}".format(args.vm_user, vm_url(vm, args)))
+
+def ensure_ssh_control_directory():
+    try:
+        os.makedirs(SSH_CONTROL_DIRECTORY, 0o700)
+    except OSError:
+        # Another thread may have created it in the meantime
+        if(not(os.path.isdir(SSH_CONTROL_DIRECTORY))):
+            raise
+
+def ssh_options(args):
+    # Options for every ssh and scp call to a VM. Unless '--ssh-persist' is
+    # 0, the first call to a VM leaves a master connection running in the
+    # background. Later calls open a channel on it rather than making a new
+    # connection with its own key exchange. The master exits once it has been
+    # idle for '--ssh-persist' seconds.
+    options = ["-i", ssh_private_key_path(args), "-o", "StrictHostKeyChecking=no"]
+    if(args.ssh_persist > 0):
+        ensure_ssh_control_directory()
+        options.extend(["-o", "ControlMaster=auto",
+                        "-o", "ControlPath={:s}".format(os.path.join(SSH_CONTROL_DIRECTORY, "%C")),
+                        "-o", "ControlPersist={:d}".format(args.ssh_persist)])
+    return options
+
+def close_ssh_master(vm, args):
+    # Stops any master connection to the VM, so that calls made after the VM
+    # is deallocated, deleted or recreated do not try to reuse it
+    if(args.ssh_persist > 0):
+        command = ["ssh"] + ssh_options(args) + ["-O", "exit", vm_host(vm, args)]
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+
 def vm_run_script(vm, script, args, detach=False):
-    ssh_key_opt = "{:s}".format(ssh_private_key_path(args))
-    strict_host_check_opt = "StrictHostKeyChecking=no"
-    host_opt = "{:s}@{:s}".format(args.vm_user, vm_url(vm, args))
     if(detach):
         script_opt = "screen -d -m {:s}".format(script)
     else:
         script_opt = script
-    command = ["ssh", host_opt, "-i", ssh_key_opt, "-o", strict_host_check_opt, script_opt]
-    result = subprocess.call(command, stderr=subprocess.STDOUT)
+    command = ["ssh"] + ssh_options(args) + [vm_host(vm, args), script_opt]
+    result = vm_subprocess_call(vm, command)
     return(result == 0)
 
 def local_run_script(script, args):
@@ -588,17 +1158,17 @@ def vm_make_exec(vm, script, args):
     exec_script = "chmod +x {:s}".format(script)
     return(vm_run_script(vm, exec_script, args))
 
-def vm_upload_dir(vm, source_dir, dest_dir, args):
-    ssh_key_opt = "{:s}".format(ssh_private_key_path(args))
-    strict_host_check_opt = "StrictHostKeyChecking=no"
-    source_opt = source_dir
-    dest_opt = "{:s}:{:s}".format(vm_url(vm, args) ,dest_dir)
-    command = ["scp", "-i", ssh_key_opt, "-o", strict_host_check_opt, "-r", source_opt, dest_opt]
-    # First remove directory if it exists already
-    remove_dir_script = "rm -r {:s}".format(dest_dir)
-    vm_run_script(vm, remove_dir_script, args)
-    result = subprocess.call(command, stderr=subprocess.STDOUT)
-    return(result == 0)
+# Several VMs can be worked on at once, so each line of output from a command
+# run against a VM is printed whole and prefixed with the VM name.
+output_lock = threading.Lock()
+
+def vm_subprocess_call(vm, command, stdin=None):
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b''):
+        with output_lock:
+            sys.stdout.write("[{:s}] {:s}\n".format(vm["name"], line.decode('utf-8', 'replace').rstrip('\r\n')))
+            sys.stdout.flush()
+    return process.wait()
 
 def ensure_exists(directory):
     if(directory and not os.path.exists(directory)):
@@ -614,7 +1184,10 @@ def upload_blob(container_name, file_path, blob_name, args):
     connection_string_opt = "--connection-string={:s}".format(pool_storage_account_connection_string(args))
     commands = ["storage", "blob", "upload"]
     options = [container_opt, file_opt, name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        sdk_blob_service(args).create_blob_from_path(container_name, blob_name, file_path)
+        return
+    result = cli_execute(commands + options)
 
 def download_blob(container_name, file_path, blob_name, args):
     directory = os.path.dirname(file_path)
@@ -625,7 +1198,21 @@ def download_blob(container_name, file_path, blob_name, args):
     connection_string_opt = "--connection-string={:s}".format(pool_storage_account_connection_string(args))
     commands = ["storage", "blob", "download"]
     options = [container_opt, file_opt, name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        sdk_blob_service(args).get_blob_to_path(container_name, blob_name, file_path)
+        return
+    result = cli_execute(commands + options)
+
+def delete_blob(container_name, blob_name, args):
+    container_opt = "--container-name={:s}".format(container_name)
+    name_opt = "--name={:s}".format(blob_name)
+    connection_string_opt = "--connection-string={:s}".format(pool_storage_account_connection_string(args))
+    commands = ["storage", "blob", "delete"]
+    options = [container_opt, name_opt, connection_string_opt]
+    if(args.backend == 'sdk'):
+        sdk_blob_service(args).delete_blob(container_name, blob_name)
+        return
+    result = cli_execute(commands + options)
 
 def blob_exists(container_name, blob_name, args):
     container_opt = "--container-name={:s}".format(container_name)
@@ -633,14 +1220,16 @@ def blob_exists(container_name, blob_name, args):
     connection_string_opt = "--connection-string={:s}".format(pool_storage_account_connection_string(args))
     commands = ["storage", "blob", "exists"]
     options = [container_opt, name_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    result = cli_execute(commands + options)
 
 def list_blobs(container_name, args):
     container_opt = "--container-name={:s}".format(container_name)
     connection_string_opt = "--connection-string={:s}".format(pool_storage_account_connection_string(args))
     commands = ["storage", "blob", "list"]
     options = [container_opt, connection_string_opt]
-    result = APPLICATION.execute(commands + options).result
+    if(args.backend == 'sdk'):
+        return [{"name": blob.name} for blob in sdk_blob_service(args).list_blobs(container_name)]
+    result = cli_execute(commands + options)
     return(result)
 
 def upload_ssh_keys(args):
@@ -681,21 +1270,62 @@ def download_secrets(args):
     ensure_exists(args.vm_secrets_directory)
     [download_blob(container_name, os.path.join(args.vm_secrets_directory, blob["name"]), blob["name"], args) for blob in blobs]
 
+# 'ssh-keygen -R' rewrites the known hosts file, so only one VM at a time
+known_hosts_lock = threading.Lock()
+
 def remove_ssh_host(vm, args):
+    # The VM may have been recreated with a new host key since any master
+    # connection to it was opened
+    close_ssh_master(vm, args)
     hostname = vm_url(vm, args)
     command = ['ssh-keygen', '-R', hostname]
-    result = subprocess.call(command, stderr=subprocess.STDOUT)
+    with known_hosts_lock:
+        result = subprocess.call(command, stderr=subprocess.STDOUT)
 
 def vm_test_ssh(vm, args):
     script = "exit"
     return vm_run_script(vm, script, args, detach=False)
 
+def get_vm(vm_name, args):
+    name_opt = "--name={0}".format(vm_name)
+    details_opt = "--show-details"
+    if(args.backend == 'sdk'):
+        return sdk_get_vm(vm_name, args)
+    return vm_pool_command(["vm", "show"], [name_opt, details_opt], args)
+
+def wait_for_vm_ready(vm_name, args):
+    # Returns the VM once it has been provisioned and is running, or None if
+    # it fails to provision or is not running within the time limit
+    deadline = time.time() + VM_READY_TIMEOUT_SECONDS
+    while(True):
+        vm = get_vm(vm_name, args)
+        if(vm is not None and vm["provisioningState"] == "Succeeded" and vm["powerState"] == "VM running"):
+            return vm
+        if(vm is not None and vm["provisioningState"] == "Failed"):
+            return None
+        if(time.time() > deadline):
+            return None
+        time.sleep(VM_READY_POLL_SECONDS)
+
+def wait_for_vm_ssh(vm, args):
+    # A newly running VM can take a little while before it accepts SSH
+    # connections
+    deadline = time.time() + SSH_READY_TIMEOUT_SECONDS
+    while(not(vm_test_ssh(vm, args))):
+        if(time.time() > deadline):
+            return False
+        time.sleep(SSH_READY_POLL_SECONDS)
+    return True
+
 def initialise_pool_subdirectory(directory_name, args):
     dir_path = os.path.join(args.pool_directory, directory_name)
     ensure_exists(dir_path)
     # Copy utility scripts
     shutil.copy2("az-queue.py", os.path.join(dir_path, "az-queue.py"))
     shutil.copy2("az-storage.py", os.path.join(dir_path, "az-storage.py"))
+    shutil.copy2("az-daemon.py", os.path.join(dir_path, "az-daemon.py"))
+    shutil.copy2("azpool.py", os.path.join(dir_path, "azpool.py"))
+    shutil.copy2("azdaemonclient.py", os.path.join(dir_path, "azdaemonclient.py"))
     # Copy secrets
     dest_secrets_path = os.path.join(dir_path, args.vm_secrets_directory)
     # Cannot use copytree if destination folder exists. We probably want to remove the secrets irectory anyway to ensure we don't keep any secrets in the pool directories that don't exist in the master source we are initialising from.
@@ -703,6 +1333,202 @@ def initialise_pool_subdirectory(directory_name, args):
         shutil.rmtree(dest_secrets_path)
     shutil.copytree(args.vm_secrets_directory, dest_secrets_path)
 
+## ----------------------
+## DIRECTORY UPLOAD TO VM
+## ----------------------
+# Directories are uploaded as a delta against what was uploaded last time.
+# Each uploaded directory holds a manifest of the SHA-256 hash and
+# permissions of everything in it. Only entries that differ from the VM's
+# manifest are sent, as a single compressed tar stream over one SSH channel.
+# The VM builds the new version alongside the current one, starting from
+# hard links to the current files, and then swaps it in by atomically
+# replacing a symlink. Files created on the VM inside the directory (e.g.
+# task outputs) are kept, while files removed locally are removed on the VM.
+# With '--upload-via storage', each distinct delta is instead uploaded once to
+# the pool storage account and each VM fetches it from there.
+local_manifests_lock = threading.Lock()
+uploaded_bundles_lock = threading.Lock()
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def local_dir_manifest(source_dir):
+    # Maps the path of each file, directory and symlink below source_dir to
+    # its content (hash, link target or 'dir') and permissions
+    manifest = {}
+    for (dir_path, dir_names, file_names) in os.walk(source_dir):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            relative_path = os.path.relpath(path, source_dir).replace(os.sep, '/')
+            mode = stat.S_IMODE(os.lstat(path).st_mode)
+            if(os.path.islink(path)):
+                manifest[relative_path] = ["link:" + os.readlink(path), mode]
+            elif(os.path.isdir(path)):
+                manifest[relative_path] = ["dir", mode]
+            else:
+                manifest[relative_path] = [file_sha256(path), mode]
+    return manifest
+
+def get_local_manifest(source_dir, args):
+    # Hashed once per command, however many VMs the directory is uploaded to
+    with local_manifests_lock:
+        if(source_dir not in args.local_manifests):
+            args.local_manifests[source_dir] = local_dir_manifest(source_dir)
+        return args.local_manifests[source_dir]
+
+def manifest_json(manifest):
+    return json.dumps(manifest, sort_keys=True)
+
+def bundle_version(manifest):
+    # The version of an uploaded directory is the SHA-256 hash of its
+    # manifest file, so VMs record it without any extra file
+    return hashlib.sha256(manifest_json(manifest).encode('utf-8')).hexdigest()
+
+def vm_script_output(vm, script, args):
+    # Returns None if the script fails or the VM cannot be reached
+    command = ["ssh"] + ssh_options(args) + [vm_host(vm, args), script]
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull)
+        output = process.communicate()[0]
+    if(process.returncode != 0):
+        return None
+    return output.decode('utf-8')
+
+def get_vm_manifest(vm, dest_dir, args):
+    # Returns an empty manifest if the directory was never uploaded with one
+    manifest_path = "{:s}/{:s}".format(dest_dir, DEPLOY_MANIFEST_FILENAME)
+    manifest = vm_script_output(vm, "cat {:s}".format(shell_quote(manifest_path)), args)
+    try:
+        return json.loads(manifest or "{}")
+    except ValueError:
+        return {}
+
+def vm_bundle_version(vm, dest_dir, args):
+    # Returns None if the directory was never uploaded with a manifest
+    manifest_path = "{:s}/{:s}".format(dest_dir, DEPLOY_MANIFEST_FILENAME)
+    output = vm_script_output(vm, "sha256sum {:s}".format(shell_quote(manifest_path)), args)
+    if(not(output)):
+        return None
+    return output.split()[0]
+
+def get_vm_bundle_versions(vms, dest_dir, args):
+    # Asks all VMs at once, however many are then uploaded to at a time
+    pool = ThreadPool(max(1, min(VERSION_QUERY_THREADS, len(vms))))
+    try:
+        versions = pool.map(lambda vm: vm_bundle_version(vm, dest_dir, args), vms)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip([vm["name"] for vm in vms], versions))
+
+def add_bytes_to_tar(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+def delta_archive(source_dir, changed_paths, deleted_paths, manifest):
+    # Returns a temporary file holding the changed entries, the new manifest
+    # and the list of entries to delete, as a gzipped tar
+    archive = tempfile.NamedTemporaryFile(suffix=".tar.gz")
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for relative_path in sorted(changed_paths):
+            tar.add(os.path.join(source_dir, relative_path), arcname=relative_path, recursive=False)
+        if(deleted_paths):
+            add_bytes_to_tar(tar, DEPLOY_DELETED_FILENAME, "".join(path + "\n" for path in sorted(deleted_paths)).encode('utf-8'))
+        add_bytes_to_tar(tar, DEPLOY_MANIFEST_FILENAME, manifest_json(manifest).encode('utf-8'))
+    archive.seek(0)
+    return archive
+
+def apply_delta_script(dest_dir, bundle_url=None):
+    # Shell script run on the VM with the delta archive on stdin, or fetching
+    # it from 'bundle_url'. 'dest_dir' ends up as a symlink to the new
+    # version. GNU tar removes an existing file before writing it and keeps
+    # existing directories, so the hard-linked current version is not changed.
+    name = shell_quote(dest_dir)
+    new = shell_quote("{:s}.{:s}".format(dest_dir, uuid.uuid4().hex[:8]))
+    manifest = shell_quote(DEPLOY_MANIFEST_FILENAME)
+    deleted = shell_quote(DEPLOY_DELETED_FILENAME)
+    lines = [
+        "set -e",
+        "mkdir -p {0}".format(new),
+        # Remove the new version if anything fails before it is swapped in
+        "trap {0} EXIT".format(shell_quote("rm -rf " + new)),
+        "if [ -f {0}/{1} ]; then cp -al {0}/. {2}/; fi".format(name, manifest, new),
+        "tar -xzf - -C {0}".format(new) if bundle_url is None else
+        "curl -fsS --retry {0:d} {1} | tar -xzf - -C {2}".format(BUNDLE_FETCH_RETRIES, shell_quote(bundle_url), new),
+        "if [ -f {0}/{1} ]; then while IFS= read -r f; do rm -rf {0}/\"$f\"; done < {0}/{1}; rm -f {0}/{1}; fi".format(new, deleted),
+        "old=",
+        "if [ -L {0} ]; then old=$(readlink {0}); elif [ -e {0} ]; then old={0}.replaced; mv {0} \"$old\"; fi".format(name),
+        "ln -sfn \"$(basename {0})\" {1}.link".format(new, name),
+        "mv -T {0}.link {0}".format(name),
+        "trap - EXIT",
+        "if [ -n \"$old\" ]; then rm -rf \"$(dirname {0})\"/\"$(basename \"$old\")\"; fi".format(name),
+    ]
+    return "\n".join(lines)
+
+def upload_bundle(source_dir, changed_paths, deleted_paths, manifest, args):
+    # Uploads the delta to pool storage, unless a VM needing the same delta
+    # has already done so in this command, and returns the URL to fetch it
+    key = json.dumps([manifest, sorted(changed_paths), sorted(deleted_paths)], sort_keys=True)
+    with uploaded_bundles_lock:
+        if(key not in args.uploaded_bundles):
+            container_name = pool_deploy_container_name(args)
+            blob_name = "{:s}.tar.gz".format(hashlib.sha256(key.encode('utf-8')).hexdigest())
+            archive = delta_archive(source_dir, changed_paths, deleted_paths, manifest)
+            try:
+                archive_size = os.fstat(archive.fileno()).st_size
+                logger.warning("{:%Hh%Mm%Ss}: Uploading {:d} changed and {:d} deleted entries of '{:s}' to pool storage as '{:s}' ({:.1f} KB).".format(datetime.now(), len(changed_paths), len(deleted_paths), source_dir, blob_name, archive_size / 1024.0))
+                upload_blob(container_name, archive.name, blob_name, args)
+            finally:
+                archive.close()
+            args.uploaded_bundles[key] = (blob_name, blob_read_url(container_name, blob_name, args))
+        return args.uploaded_bundles[key][1]
+
+def delete_uploaded_bundles(args):
+    # Called once all VMs have fetched their bundles
+    container_name = pool_deploy_container_name(args)
+    for (blob_name, _) in args.uploaded_bundles.values():
+        try:
+            delete_blob(container_name, blob_name, args)
+        except Exception as e:
+            logger.warning("{:%Hh%Mm%Ss}: Failed to delete '{:s}' from pool storage container '{:s}': {}".format(datetime.now(), blob_name, container_name, e))
+    args.uploaded_bundles.clear()
+
+def vm_upload_dir(vm, source_dir, dest_dir, args):
+    vm_name = vm["name"]
+    manifest = get_local_manifest(source_dir, args)
+    vm_manifest = get_vm_manifest(vm, dest_dir, args)
+    if(args.redeploy):
+        # Send every file, in case files on the VM were changed since they
+        # were uploaded, as the manifest would not show it
+        changed_paths = list(manifest.keys())
+    else:
+        changed_paths = [path for (path, entry) in manifest.items() if vm_manifest.get(path) != entry]
+    deleted_paths = [path for path in vm_manifest if path not in manifest]
+    if(not(changed_paths) and not(deleted_paths)):
+        logger.warning("{:%Hh%Mm%Ss}: Directory '{:s}' on VM '{:s}' is already up to date with '{:s}'.".format(datetime.now(), dest_dir, vm_name, source_dir))
+        return True
+    if(args.upload_via == 'storage'):
+        bundle_url = upload_bundle(source_dir, changed_paths, deleted_paths, manifest, args)
+        logger.warning("{:%Hh%Mm%Ss}: Fetching {:d} changed and {:d} deleted entries of '{:s}' from pool storage on VM '{:s}'.".format(datetime.now(), len(changed_paths), len(deleted_paths), source_dir, vm_name))
+        command = ["ssh"] + ssh_options(args) + [vm_host(vm, args), apply_delta_script(dest_dir, bundle_url)]
+        return(vm_subprocess_call(vm, command) == 0)
+    archive = delta_archive(source_dir, changed_paths, deleted_paths, manifest)
+    try:
+        archive_size = os.fstat(archive.fileno()).st_size
+        logger.warning("{:%Hh%Mm%Ss}: Sending {:d} changed and {:d} deleted entries of '{:s}' to VM '{:s}' ({:.1f} KB).".format(datetime.now(), len(changed_paths), len(deleted_paths), source_dir, vm_name, archive_size / 1024.0))
+        command = ["ssh"] + ssh_options(args) + [vm_host(vm, args), apply_delta_script(dest_dir)]
+        result = vm_subprocess_call(vm, command, stdin=archive)
+    finally:
+        archive.close()
+    return(result == 0)
+
 ## ------------------
 ## TOP-LEVEL COMMANDS
 ## ------------------
@@ -714,10 +1540,15 @@ def list_sizes(args):
         # Use location from resource group (if group exists)
         location = get_resource_group_location(args)
     location_opt = "--location={0}".format(location)
-    result = APPLICATION.execute(["vm", "list-sizes", location_opt]).result
+    if(args.backend == 'sdk'):
+        result = sdk_list_vm_sizes(location, args)
+    else:
+        result = cli_execute(["vm", "list-sizes", location_opt])
     print_vm_size_table(result, args)
 
-def create_pool(args):
+def prepare_pool(args):
+    # Creates the resources shared by every VM in a new pool. Returns False if
+    # the pool cannot be created.
     # Check if resource group exists before progressing further
     if not resource_group_exists(args):
         if(args.force and args.location is not None):
@@ -732,19 +1563,30 @@ def create_pool(args):
     if(num_existing_vms > 0):
         print_vm_table(vms, args)
         logger.warning("VM pool already exists containing the above VMs. Use 'delete-pool' command to remove this pool before creating a new pool.")
-    else:
-        start_time = datetime.now()
-        logger.warning("{:%Hh%Mm%Ss}: Creating pool of {:d} VMs for Resource Group '{:s}' using image '{:s}'.".format(datetime.now(), args.num_vms, args.resource_group, args.vm_image))
-        logger.warning("{:%Hh%Mm%Ss}: Ensuring storage account exists for Resource Group '{:s}'.".format(datetime.now(), args.resource_group))
-        create_storage_account(args)
-        logger.warning("{:%Hh%Mm%Ss}: Creating SSH keys for VM pool {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), args.num_vms, args.resource_group))
-        gen_ssh_keys(args)
-        upload_ssh_keys(args)
-        logger.warning("{:%Hh%Mm%Ss}: Creating pool data container '{:s}' if it doesn't already exist.".format(datetime.now(), pool_data_container_name(args)))
-        create_pool_data_container(args)
-        logger.warning("{:%Hh%Mm%Ss}: Ensuring virtual network exists for pool '{:s}'.".format(datetime.now(), args.resource_group))
-        create_virtual_network(args)
-        result = [create_vm(i, args) for i in range(0, args.num_vms)]
+        return False
+    logger.warning("{:%Hh%Mm%Ss}: Creating pool of {:d} VMs for Resource Group '{:s}' using image '{:s}'.".format(datetime.now(), args.num_vms, args.resource_group, args.vm_image))
+    logger.warning("{:%Hh%Mm%Ss}: Ensuring storage account exists for Resource Group '{:s}'.".format(datetime.now(), args.resource_group))
+    create_storage_account(args)
+    logger.warning("{:%Hh%Mm%Ss}: Creating SSH keys for VM pool {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), args.num_vms, args.resource_group))
+    gen_ssh_keys(args)
+    upload_ssh_keys(args)
+    logger.warning("{:%Hh%Mm%Ss}: Creating pool data container '{:s}' if it doesn't already exist.".format(datetime.now(), pool_data_container_name(args)))
+    create_pool_data_container(args)
+    logger.warning("{:%Hh%Mm%Ss}: Ensuring virtual network exists for pool '{:s}'.".format(datetime.now(), args.resource_group))
+    create_virtual_network(args)
+    args.inventory = get_pool_inventory(args)
+    return True
+
+def create_pool(args):
+    start_time = datetime.now()
+    if(prepare_pool(args)):
+        vm_numbers = list(range(0, args.num_vms))
+        vm_names = [name_from_number(i, args) for i in vm_numbers]
+        logger.warning("{:%Hh%Mm%Ss}: Creating {:d} VMs, {:d} at a time.".format(datetime.now(), args.num_vms, min(args.parallel, args.num_vms)))
+        results = run_vm_operations(create_pool_vm, vm_numbers, vm_names, "Creating VM", args)
+        print_vm_results_table(results, args)
+        if(num_failed(results) > 0):
+            logger.warning("{:%Hh%Mm%Ss}: Creation failed for {:d} of {:d} VMs. See the table above for the errors.".format(datetime.now(), num_failed(results), args.num_vms))
         # Refresh VMs
         vms = get_vms(args)
         logger.warning("{:%Hh%Mm%Ss}: Removing any existing SSH host entries for each VM.".format(datetime.now()))
@@ -755,8 +1597,72 @@ def create_pool(args):
         # Print pool info
         print_vm_table(vms, args)
         logger.warning("{:%Hh%Mm%Ss}: Pool of {:d} VMs for Resource Group '{:s}' created in {:s}.".format(datetime.now(), args.num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
 
-def create_vm(vm_number, args):
+def create_pool_vm(vm_number, args):
+    # Azure CLI calls are made one at a time, so with the 'cli' backend only
+    # start the creation and then poll until the VM is running, as in
+    # provision_vm(), rather than holding up every other VM's calls until it
+    # finishes
+    if(args.no_wait):
+        return create_vm(vm_number, args)
+    vm_name = name_from_number(vm_number, args)
+    steps = create_vm(vm_number, args, wait=(args.backend == 'sdk'))
+    steps["Ready"] = wait_for_vm_ready(vm_name, args) is not None
+    if(not(steps["Ready"])):
+        logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' is not running.".format(datetime.now(), vm_name))
+    return steps
+
+def provision_pool(args):
+    # Unlike running 'create-pool', 'setup-pool', 'deploy-task' and
+    # 'start-task' in turn, each VM goes through the whole pipeline on its
+    # own, so it starts taking tasks as soon as it is ready rather than
+    # waiting at each step for the slowest VM in the pool
+    start_time = datetime.now()
+    if(prepare_pool(args)):
+        vm_numbers = list(range(0, args.num_vms))
+        vm_names = [name_from_number(i, args) for i in vm_numbers]
+        logger.warning("{:%Hh%Mm%Ss}: Provisioning {:d} VMs, {:d} at a time.".format(datetime.now(), args.num_vms, min(args.parallel, args.num_vms)))
+        results = run_vm_operations(provision_vm, vm_numbers, vm_names, "Provisioning VM", args)
+        delete_uploaded_bundles(args)
+        print_vm_results_table(results, args)
+        print_vm_table(get_vms(args), args)
+        ready_times = [result["end"] for result in results if result["success"]]
+        if(ready_times):
+            logger.warning("{:%Hh%Mm%Ss}: First VM started its task after {:s}.".format(datetime.now(), timedelta_string(min(ready_times) - start_time)))
+        logger.warning("{:%Hh%Mm%Ss}: Provisioned {:d} of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), args.num_vms - num_failed(results), args.num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
+
+def provision_vm(vm_number, args):
+    # Runs create -> wait until running -> SSH check -> setup -> deploy ->
+    # start task for a single VM. Each step only runs if the previous steps
+    # succeeded.
+    vm_name = name_from_number(vm_number, args)
+    # Azure CLI calls are made one at a time, so with the 'cli' backend only
+    # start the creation rather than holding up every other VM's calls until
+    # it finishes. wait_for_vm_ready() then polls between other VMs' calls.
+    steps = create_vm(vm_number, args, wait=(args.backend == 'sdk'))
+    vm = wait_for_vm_ready(vm_name, args)
+    steps["Ready"] = vm is not None
+    if(vm is None):
+        logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' is not running.".format(datetime.now(), vm_name))
+        return steps
+    remove_ssh_host(vm, args)
+    steps["SSH"] = wait_for_vm_ssh(vm, args)
+    if(not(steps["SSH"])):
+        logger.warning("{:%Hh%Mm%Ss}: Unable to connect to VM '{:s}' using SSH.".format(datetime.now(), vm_name))
+        return steps
+    for vm_operation in [setup_vm, deploy_task_vm, start_task_vm]:
+        vm_steps = vm_operation(vm, args)
+        steps.update(vm_steps)
+        if(not(all(vm_steps.values()))):
+            return steps
+    logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' provisioned and running task.".format(datetime.now(), vm_name))
+    return steps
+
+def create_vm(vm_number, args, wait=True):
+    # With 'wait=False', returns once creation has started, as with '--no-wait'
+    no_wait = args.no_wait or not(wait)
     # Set VM name from number and use VM name to name IP and NIC resources
     vm_name = name_from_number(vm_number, args)
     ip_name = vm_name
@@ -767,19 +1673,19 @@ def create_vm(vm_number, args):
     # Start the clock for timing VM creation
     start_time = datetime.now()
     # Create public IP address
-    if(not(public_ip_exists(ip_name, args))):
+    if(ip_name not in args.inventory["public_ips"]):
         logger.warning("{:%Hh%Mm%Ss}: Creating Public IP '{:s}'.".format(datetime.now(), ip_name))
         create_public_ip(ip_name, args)
     else:
         logger.warning("{:%Hh%Mm%Ss}: Public IP '{:s}' already exists. Skipping create.".format(datetime.now(), ip_name))
     # Create Network Interface Card (NIC)
-    if(not(nic_exists(nic_name, args))):
+    if(nic_name not in args.inventory["nics"]):
         logger.warning("{:%Hh%Mm%Ss}: Creating NIC '{:s}'.".format(datetime.now(), nic_name))
         create_nic(nic_name, args)
     else:
         logger.warning("{:%Hh%Mm%Ss}: NIC '{:s}' already exists. Skipping create.".format(datetime.now(), nic_name))
     # Delete any existing OS disk storage blob
-    if(vm_os_disk_blob_exists(vm_name, args)):
+    if(vm_os_disk_blob_name(vm_name, args) in args.inventory["os_disk_blobs"]):
         logger.warning("{:%Hh%Mm%Ss}: Deleting existing OS disk blob '{:s}'".format(datetime.now(), os_disk_name))
         delete_vm_os_disk_blob(vm_name, args)
     # Set up VM creation options
@@ -797,17 +1703,21 @@ def create_vm(vm_number, args):
     # Construct commands and options
     commands = ["vm", "create"]
     options = [name_opt, ssh_opt, image_opt, location_opt, size_opt, nics_opt, unmanaged_opt, storage_account_opt, storage_container_opt, os_disk_name_opt, user_opt]
-    if(args.no_wait):
+    if(no_wait):
         options.append("--no-wait")
     # Create VM
-    if(args.no_wait):
+    if(no_wait):
         logger.warning("{:%Hh%Mm%Ss}: Inititating creation of VM '{:s}'.".format(datetime.now(), vm_name))
     else:
         logger.warning("{:%Hh%Mm%Ss}: Creating VM '{:s}'.".format(datetime.now(), vm_name))
-    result = vm_pool_command(commands, options, args)
-    if(not(args.no_wait)):
+    if(args.backend == 'sdk'):
+        result = sdk_create_vm(vm_name, nic_name, os_disk_name, args)
+    else:
+        result = vm_pool_command(commands, options, args)
+    invalidate_lookup("vms", args.lookups)
+    if(not(no_wait)):
         logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' created in {:s}".format(datetime.now(), vm_name, timedelta_string(datetime.now() - start_time)))
-    return(result)
+    return collections.OrderedDict([("Create", True)])
 
 def setup_pool(args):
     vms = get_vms(args)
@@ -815,43 +1725,52 @@ def setup_pool(args):
     if(num_vms == 0):
         print_vm_table(vms, args)
         logger.warning("No VM pool exists. Use 'create-pool' command to create a new pool.")
+        return []
     else:
         start_time = datetime.now()
         if(args.no_wait):
             logger.warning("{:%Hh%Mm%Ss}: Initiating setup for pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
         else:
             logger.warning("{:%Hh%Mm%Ss}: Setting up pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
-        result = [setup_vm(vm, args) for vm in vms]
+        results = run_vm_operations(setup_vm, vms, [vm["name"] for vm in vms], "Setting up VM", args)
+        delete_uploaded_bundles(args)
+        print_vm_results_table(results, args)
         if(args.no_wait):
-            logger.warning("{:%Hh%Mm%Ss}: Setup initiated for pool of {:d} VMs for Resource Group '{:s}'. To check if setup is still running on a VM, SSH into it and run 'screen -R'.".format(datetime.now(), num_vms, args.resource_group))
+            logger.warning("{:%Hh%Mm%Ss}: Setup initiated for {:d} of {:d} VMs for Resource Group '{:s}' in {:s}. To check if setup is still running on a VM, SSH into it and run 'screen -R'.".format(datetime.now(), num_vms - num_failed(results), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
         else:
-            logger.warning("{:%Hh%Mm%Ss}: Setup completed for pool of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+            logger.warning("{:%Hh%Mm%Ss}: Setup completed for {:d} of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms - num_failed(results), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
 
 def setup_vm(vm, args):
     vm_name = vm["name"]
     source_dir = os.path.join(args.pool_directory, args.setup_directory)
     dest_dir = args.setup_directory
     setup_script = os.path.join(dest_dir, args.setup_script)
+    steps = collections.OrderedDict()
     # Copy setup directory to VM
     logger.warning("Copying setup directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(source_dir, dest_dir, vm_name))
     success = vm_upload_dir(vm, source_dir, dest_dir, args)
+    steps["Copy setup"] = success
     if(success):
         logger.warning("Successfully copied setup directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(source_dir, dest_dir, vm_name))
     else:
         logger.warning("Failed to copy setup directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(source_dir, dest_dir, vm_name))
+        return steps
     # Make setup script executable
-    success = vm_make_exec(vm, setup_script, args)
+    steps["Chmod setup"] = vm_make_exec(vm, setup_script, args)
     # Run setup script
     if(args.no_wait):
         detach = True
     else:
         detach = False
     success = vm_run_script(vm, setup_script, args, detach=detach)
+    steps["Start setup" if args.no_wait else "Run setup"] = success
     if(not(args.no_wait)):
         if(success):
             logger.warning("Successfully ran setup script '{:s}' on VM '{:s}'.".format(setup_script, vm_name))
         else:
             logger.warning("Failed to run setup script '{:s}' on VM '{:s}'.".format(setup_script, vm_name))
+    return steps
 
 def deploy_task(args):
     vms = get_vms(args)
@@ -859,27 +1778,45 @@ def deploy_task(args):
     if(num_vms == 0):
         print_vm_table(vms, args)
         logger.warning("No VM pool exists. Use 'create-pool' command to create a new pool.")
+        return []
     else:
         start_time = datetime.now()
-        # Kill any running task
-        kill_task(args)
-        # Copy task to VMs
-        logger.warning("{:%Hh%Mm%Ss}: Deploying task to pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
-        result = [deploy_task_vm(vm, args) for vm in vms]
-        logger.warning("{:%Hh%Mm%Ss}: Task deployed to pool of {:d} VMs for Resource Group '{:s}' in {:s}. Fill the 'tasks' queue and then run 'start-task' to run the task.".format(datetime.now(), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        if(not(args.redeploy)):
+            # Leave VMs that already have this version of the task directory,
+            # and any task running on them, alone
+            task_source_dir = os.path.join(args.pool_directory, args.task_directory)
+            version = bundle_version(get_local_manifest(task_source_dir, args))
+            vm_versions = get_vm_bundle_versions(vms, args.task_directory, args)
+            vms = [vm for vm in vms if vm_versions[vm["name"]] != version]
+            logger.warning("{:%Hh%Mm%Ss}: {:d} of {:d} VMs already have version {:s} of task directory '{:s}'.".format(datetime.now(), num_vms - len(vms), num_vms, version[:12], task_source_dir))
+            num_vms = len(vms)
+            if(num_vms == 0):
+                logger.warning("{:%Hh%Mm%Ss}: Nothing to deploy. Use '--redeploy' to deploy the task to every VM anyway.".format(datetime.now()))
+                return []
+        # Kill any running task and copy task to VMs
+        logger.warning("{:%Hh%Mm%Ss}: Deploying task to {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
+        results = run_vm_operations(deploy_task_vm, vms, [vm["name"] for vm in vms], "Deploying task to VM", args)
+        delete_uploaded_bundles(args)
+        print_vm_results_table(results, args)
+        logger.warning("{:%Hh%Mm%Ss}: Task deployed to {:d} of {:d} VMs for Resource Group '{:s}' in {:s}. Fill the 'tasks' queue and then run 'start-task' to run the task.".format(datetime.now(), num_vms - num_failed(results), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
 
 def deploy_task_vm(vm, args):
     vm_name = vm["name"]
     task_source_dir = os.path.join(args.pool_directory, args.task_directory)
     task_dest_dir = args.task_directory
     task_script = os.path.join(task_dest_dir, args.task_script)
+    # Kill any running task
+    steps = kill_task_vm(vm, args)
     # Copy task directory to VM
     logger.warning("Copying task directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(task_source_dir, task_dest_dir, vm_name))
     success = vm_upload_dir(vm, task_source_dir, task_dest_dir, args)
+    steps["Copy task"] = success
     if(success):
         logger.warning("Successfully copied setup directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(task_source_dir, task_dest_dir, vm_name))
     else:
         logger.warning("Failed to copy setup directory '{:s}' to directory '{:s}' on VM '{:s}'.".format(task_source_dir, task_dest_dir, vm_name))
+    return steps
 
 def start_task(args):
     vms = get_vms(args)
@@ -887,24 +1824,30 @@ def start_task(args):
     if(num_vms == 0):
         print_vm_table(vms, args)
         logger.warning("No VM pool exists. Use 'create-pool' command to create a new pool.")
+        return []
     else:
         start_time = datetime.now()
         logger.warning("{:%Hh%Mm%Ss}: Starting task on pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
-        result = [start_task_vm(vm, args) for vm in vms]
-        logger.warning("{:%Hh%Mm%Ss}: Task started on pool of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        results = run_vm_operations(start_task_vm, vms, [vm["name"] for vm in vms], "Starting task on VM", args)
+        print_vm_results_table(results, args)
+        logger.warning("{:%Hh%Mm%Ss}: Task started on {:d} of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms - num_failed(results), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
 
 def start_task_vm(vm, args):
     task_dest_dir = args.task_directory
     task_script = os.path.join(task_dest_dir, args.task_script)
     vm_name = vm["name"]
+    steps = collections.OrderedDict()
     # Make task script executable
-    success = vm_make_exec(vm, task_script, args)
+    steps["Chmod task"] = vm_make_exec(vm, task_script, args)
     # Run task script
     success = vm_run_script(vm, task_script, args, detach=True)
+    steps["Start task"] = success
     if(success):
         logger.warning("Successfully started script '{:s}' on VM '{:s}'.".format(task_script, vm_name))
     else:
         logger.warning("Failed to start script '{:s}' on VM '{:s}'.".format(task_script, vm_name))
+    return steps
 
 def kill_task(args):
     vms = get_vms(args)
@@ -912,26 +1855,32 @@ def kill_task(args):
     if(num_vms == 0):
         print_vm_table(vms, args)
         logger.warning("No VM pool exists. Use 'create-pool' command to create a new pool.")
+        return []
     else:
         start_time = datetime.now()
         # Kill task on all poll VMs
         logger.warning("{:%Hh%Mm%Ss}: Killing task on pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
-        result = [kill_task_vm(vm, args) for vm in vms]
-        logger.warning("{:%Hh%Mm%Ss}: Task killed on pool of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        results = run_vm_operations(kill_task_vm, vms, [vm["name"] for vm in vms], "Killing task on VM", args)
+        print_vm_results_table(results, args)
+        logger.warning("{:%Hh%Mm%Ss}: Task killed on {:d} of {:d} VMs for Resource Group '{:s}' in {:s}.".format(datetime.now(), num_vms - num_failed(results), num_vms, args.resource_group, timedelta_string(datetime.now() - start_time)))
+        return results
 
 def kill_task_vm(vm, args):
     vm_name = vm["name"]
-    # Run script to kill anything running in screen
-    kill_script = "killall screen"
+    # Run script to kill anything running in screen. Having nothing to kill
+    # is not a failure, so only a failed SSH connection is reported.
+    kill_script = "killall screen; true"
     success = vm_run_script(vm, kill_script, args)
     if(success):
         logger.warning("Successfully killed task on VM '{:s}'.".format(vm_name))
     else:
         logger.warning("Failed to kill task on VM '{:s}'.".format( vm_name))
+    return collections.OrderedDict([("Kill task", success)])
 
 def show_pool(args):
     vms = get_vms(args)
     print_vm_table(vms, args)
+    print_pool_resources_table(get_pool_inventory(args), args)
 
 def start_all(args):
     vms = get_vms(args)
@@ -960,7 +1909,11 @@ def start_vm(vm, args):
         commands = ["vm", "start"]
         if(args.no_wait):
             options.append("--no-wait")
-        result = vm_pool_command(commands,options, args)
+        if(args.backend == 'sdk'):
+            result = sdk_vm_operation("start", vm_name, args)
+        else:
+            result = vm_pool_command(commands,options, args)
+        invalidate_lookup("vms", args.lookups)
         if(not(args.no_wait)):
             logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' started in {:s}".format(datetime.now(), vm_name, timedelta_string(datetime.now() - start_time)))
         return(result)
@@ -987,12 +1940,17 @@ def shutdown_vm(vm, args):
     else:
         start_time = datetime.now()
         logger.warning("{:%Hh%Mm%Ss}: Deallocating VM '{:s}'.".format(datetime.now(), vm_name))
+        close_ssh_master(vm, args)
         name_opt = "--name={0}".format(vm_name)
         options = [name_opt]
         commands = ["vm", "deallocate"]
         if(args.no_wait):
             options.append("--no-wait")
-        result = vm_pool_command(commands,options, args)
+        if(args.backend == 'sdk'):
+            result = sdk_vm_operation("deallocate", vm_name, args)
+        else:
+            result = vm_pool_command(commands,options, args)
+        invalidate_lookup("vms", args.lookups)
         if(not(args.no_wait)):
             logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' deallocated in {:s}".format(datetime.now(), vm_name, timedelta_string(datetime.now() - start_time)))
         return(result)
@@ -1007,6 +1965,7 @@ def delete_pool(args):
     resp = get_input("Are you sure you want to delete all {0} of the above VMs? (y/n):".format(num_vms))
     if(resp == "y"):
         start_time = datetime.now()
+        args.inventory = get_pool_inventory(args)
         logger.warning("{:%Hh%Mm%Ss}: Deleting pool of {:d} VMs for Resource Group '{:s}'.".format(datetime.now(), num_vms, args.resource_group))
         result = [delete_vm(vm, args, force=True) for vm in vms]
         # Delete storage container for VM OS disk vhds
@@ -1024,20 +1983,29 @@ def delete_vm(vm, args, force):
     vm_name = vm["name"]
     start_time = datetime.now()
     logger.warning("{:%Hh%Mm%Ss}: Deleting VM '{:s}'.".format(datetime.now(), vm_name))
+    close_ssh_master(vm, args)
     name_opt = "--name={0}".format(vm_name)
     options = [name_opt]
     if(force):
         options.append("--yes")
     commands = ["vm", "delete"]
     # Delete VM
-    result = vm_pool_command(commands, options, args)
-    # Delete NIC and Public IP address
-    logger.warning("{:%Hh%Mm%Ss}: Deleting NIC '{:s}'.".format(datetime.now(), vm_name))
-    vm_pool_command(["network", "nic", "delete"], [name_opt], args)
-    logger.warning("{:%Hh%Mm%Ss}: Deleting Public IP '{:s}'.".format(datetime.now(), vm_name))
-    vm_pool_command(["network", "public-ip", "delete"], [name_opt], args)
-    logger.warning("{:%Hh%Mm%Ss}: Deleting OS disk blob '{:s}'.".format(datetime.now(), vm_name))
-    delete_vm_os_disk_blob(vm_name, args)
+    if(args.backend == 'sdk'):
+        result = sdk_vm_operation("delete", vm_name, args)
+    else:
+        result = vm_pool_command(commands, options, args)
+    invalidate_lookup("vms", args.lookups)
+    # Delete NIC, Public IP address and OS disk, skipping any that the pool
+    # inventory shows do not exist
+    if(vm_name in args.inventory["nics"]):
+        logger.warning("{:%Hh%Mm%Ss}: Deleting NIC '{:s}'.".format(datetime.now(), vm_name))
+        delete_nic(vm_name, args)
+    if(vm_name in args.inventory["public_ips"]):
+        logger.warning("{:%Hh%Mm%Ss}: Deleting Public IP '{:s}'.".format(datetime.now(), vm_name))
+        delete_public_ip(vm_name, args)
+    if(vm_os_disk_blob_name(vm_name, args) in args.inventory["os_disk_blobs"]):
+        logger.warning("{:%Hh%Mm%Ss}: Deleting OS disk blob '{:s}'.".format(datetime.now(), vm_os_disk_blob_name(vm_name, args)))
+        delete_vm_os_disk_blob(vm_name, args)
     logger.warning("{:%Hh%Mm%Ss}: VM '{:s}' deleted in {:s}".format(datetime.now(), vm_name, timedelta_string(datetime.now() - start_time)))
     return(result)
 
@@ -0,0 +1,18 @@
+#! /usr/bin/env python
+
+# Helpers shared by the scripts that call the Azure management SDK directly
+# (az-vm-pool.py with '--backend=sdk' and configure_batch_account.py). Keep
+# this file alongside them.
+
+def sdk_to_dict(model):
+    # Converts an SDK model to the camelCase dictionary the CLI would output
+    def camel_case(key):
+        words = key.split('_')
+        return words[0] + ''.join(word.title() for word in words[1:])
+    def convert(value):
+        if(isinstance(value, dict)):
+            return dict((camel_case(key), convert(item)) for (key, item) in value.items())
+        if(isinstance(value, list)):
+            return [convert(item) for item in value]
+        return value
+    return convert(model.as_dict())
@@ -7,12 +7,23 @@ import uuid
 import argparse
 import time
 import subprocess
+from azsdk import sdk_to_dict
 
 from azure.cli.core.application import APPLICATION, Configuration
 from azure.cli.core._session import ACCOUNT, CONFIG, SESSION
 import azure.cli.core.azlogging as azlogging
 from azure.cli.core._environment import get_config_dir
 
+# The management SDK clients are only needed by the 'sdk' backend. They are
+# installed alongside the Azure CLI.
+try:
+    from azure.cli.core._profile import Profile
+    from azure.mgmt.batch import BatchManagementClient
+    from azure.mgmt.resource import ResourceManagementClient
+    from azure.mgmt.storage import StorageManagementClient
+except ImportError:
+    BatchManagementClient = None
+
 logger = azlogging.get_az_logger(__name__)
 
 # Azure account name constants
@@ -30,6 +41,13 @@ DEFAULT_LOCATION = 'westeurope'
 DEFAULT_STORAGE_SKU = 'Standard_LRS'
 
 DEFAULT_SSH_KEY_DIRECTORY = "private-batch-ssh-keys"
+DEFAULT_BACKEND = "cli"
+
+# Backend used for management calls, set from the command line. With 'sdk',
+# calls go directly to the Azure management SDK clients rather than through
+# APPLICATION.execute(). Creating the service principal always uses the CLI.
+backend = DEFAULT_BACKEND
+sdk_clients = {}
 
 # Set up some exit statuses
 CLEAN_EXIT = 0
@@ -46,7 +64,14 @@ def main():
     parser.add_argument('--name','-n',
         required=True,
         help='Name of batch account. If creating a new batch account, this will also be used as the name of the associated resource group and storage account that will be created.')
+    parser.add_argument('--backend', choices=['cli', 'sdk'],
+        default=DEFAULT_BACKEND,
+        help="How to make Azure management calls: through the Azure CLI command parser ('cli'), or directly with the Azure management SDK clients using the Azure CLI login ('sdk').")
     args = parser.parse_args()
+    if(args.backend == 'sdk' and BatchManagementClient is None):
+        parser.error("The 'sdk' backend requires the Azure management SDK packages (azure-mgmt-batch, azure-mgmt-resource, azure-mgmt-storage).")
+    global backend
+    backend = args.backend
 
     azlogging.configure_logging("")
 
@@ -127,6 +152,8 @@ def ensure_resource_provider_registered(namespace):
 
 def resource_provider_registration_state(namespace):
     name_opt = "--name={0}".format(namespace)
+    if(backend == 'sdk'):
+        return sdk_client(ResourceManagementClient).providers.get(namespace).registration_state
     return APPLICATION.execute(['provider', 'show', name_opt]).result["registrationState"]
 
 def resource_provider_registered(namespace):
@@ -135,6 +162,9 @@ def resource_provider_registered(namespace):
 
 def register_resource_provider(namespace):
     name_opt = "--name={0}".format(namespace)
+    if(backend == 'sdk'):
+        sdk_client(ResourceManagementClient).providers.register(namespace)
+        return
     APPLICATION.execute(['provider', 'register', name_opt]).result
 
 def ensure_exists(directory):
@@ -167,6 +197,8 @@ def create_batch_account(name, resource_group_name, location = DEFAULT_LOCATION)
     name_opt = "--name={0}".format(name)
     location_opt = "--location={0}".format(location)
     resource_group_name_opt = "--resource-group={0}".format(resource_group_name)
+    if(backend == 'sdk'):
+        return sdk_to_dict(sdk_client(BatchManagementClient).batch_account.create(resource_group_name, name, {"location": location}).result())
     return APPLICATION.execute(['batch', 'account', 'create', name_opt, location_opt, resource_group_name_opt]).result
 
 def create_batch_account_group(name, subscription, location = DEFAULT_LOCATION):
@@ -188,6 +220,8 @@ def create_resource_group(name, location = DEFAULT_LOCATION):
     logger.warning("Creating resource group")
     name_opt = "--name={0}".format(name)
     location_opt = "--location={0}".format(location)
+    if(backend == 'sdk'):
+        return sdk_to_dict(sdk_client(ResourceManagementClient).resource_groups.create_or_update(name, {"location": location}))
     return APPLICATION.execute(['group', 'create', name_opt, location_opt]).result
 
 def create_storage_account(name, resource_group_name, location = DEFAULT_LOCATION, sku = DEFAULT_STORAGE_SKU):
@@ -196,6 +230,9 @@ def create_storage_account(name, resource_group_name, location = DEFAULT_LOCATIO
     location_opt = "--location={0}".format(location)
     resource_group_name_opt = "--resource-group={0}".format(resource_group_name)
     sku_opt = "--sku={0}".format(sku)
+    if(backend == 'sdk'):
+        parameters = {"location": location, "sku": {"name": sku}, "kind": "Storage"}
+        return sdk_to_dict(sdk_client(StorageManagementClient).storage_accounts.create(resource_group_name, name, parameters).result())
     return APPLICATION.execute(['storage', 'account', 'create', name_opt, location_opt, resource_group_name_opt, sku_opt]).result
 
 def generate_account_name():
@@ -214,8 +251,21 @@ def link_storage_account_to_batch_account(batch_account_name, storage_account_na
     batch_account_name_opt = "--name={0}".format(batch_account_name)
     storage_account_name_opt = "--storage-account={0}".format(storage_account_name)
     resource_group_name_opt = "--resource-group={0}".format(resource_group_name)
+    if(backend == 'sdk'):
+        storage_account = sdk_client(StorageManagementClient).storage_accounts.get_properties(resource_group_name, storage_account_name)
+        parameters = {"auto_storage": {"storage_account_id": storage_account.id}}
+        return sdk_to_dict(sdk_client(BatchManagementClient).batch_account.update(resource_group_name, batch_account_name, parameters))
     return APPLICATION.execute(['batch', 'account', 'set', batch_account_name_opt, storage_account_name_opt, resource_group_name_opt]).result
 
+def sdk_client(client_class):
+    # Each client is created once, on first use, using the credentials and
+    # default subscription of the Azure CLI login
+    if(client_class not in sdk_clients):
+        subscription = get_default_subscription()
+        credentials, subscription_id, tenant_id = Profile().get_login_credentials(subscription_id=subscription["id"])
+        sdk_clients[client_class] = client_class(credentials, subscription_id)
+    return sdk_clients[client_class]
+
 def is_authenticated():
     # Get subscriptions. This returns an empty list if user is not authenticated.
     subscriptions = APPLICATION.execute(['account','list']).result